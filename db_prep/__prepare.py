@@ -189,8 +189,28 @@ def formula_db_idx_arr():
     joblib.dump(idx_arr, "halogen_db_idx.joblib")
 
 
+def formula_db_iso_arr():
+    """
+    create isotope pattern arrays for formula db, optional columns of the formula db.
+    relative abundances of the first 4 isotope peaks (M+0 to M+3, normalized) of each neutral formula,
+    used for MS1 isotope similarity of precursor candidates
+    :return: np.array, shape=(n, 4), dtype=float32
+    """
+    from msbuddy.cand import iso_pattern_cache
+    from msbuddy.cand import _calc_iso_abundance_arr
+
+    for db_name in ['basic_db', 'halogen_db']:
+        print(db_name + " isotope patterns")
+        formula_arr = joblib.load(db_name + "_formula.joblib").astype(np.int64)
+        power_table = iso_pattern_cache._get_power_table(int(np.max(formula_arr)), 4)
+        abundance_arr = _calc_iso_abundance_arr(formula_arr, power_table, 4)
+        iso_arr = (abundance_arr / np.sum(abundance_arr, axis=1, keepdims=True)).astype(np.float32)
+        joblib.dump(iso_arr, db_name + "_iso.joblib")
+
+
 # test
 if __name__ == '__main__':
     # load_frag_table()
     # load_loss_table()
     formula_db_idx_arr()
+    formula_db_iso_arr()
@@ -19,7 +19,7 @@ from typing import Union, Tuple, List
 import numpy as np
 from numba import njit
 
-from msbuddy.utils import read_formula, form_arr_to_str
+from msbuddy.utils import read_formula, form_arr_to_str, form_arr_to_str_batch
 
 mass_i = 1.0033548  # mass of neutron
 mass_e = 0.0005486  # mass of electron
@@ -38,6 +38,8 @@ class Formula:
     # dbe: float
     # isotope: int # M+0, M+1
 
+    __slots__ = ('array', 'charge', 'isotope', 'dbe', 'mass')
+
     def __init__(self,
                  array: np.array,
                  charge: int,
@@ -45,6 +47,8 @@ class Formula:
                  isotope: int = 0):
         self.array = np.int16(array)
         self.charge = charge
+        # dbe and mass refer to the formula as created, formula arrays may be converted in place later
+        # (e.g. in check_formula_existence)
         self.dbe = calc_formula_dbe(array)
         self.isotope = isotope
 
@@ -76,6 +80,17 @@ def calc_formula_dbe(arr):
     return dbe
 
 
+@njit
+def calc_formula_dbe_arr(form_arr: np.array) -> np.array:
+    """
+    calculate DBE of each formula
+    :param form_arr: 2D array, each row is a formula array
+    :return: 1D array, DBE of each formula
+    """
+    return form_arr[:, 0] + 1 - (form_arr[:, 1] + form_arr[:, 4] + form_arr[:, 3] + form_arr[:, 2] + form_arr[:, 5] +
+                                 form_arr[:, 8] + form_arr[:, 6]) / 2 + (form_arr[:, 7] + form_arr[:, 10]) / 2
+
+
 @njit
 def calc_formula_mass(array, charge, isotope):
     """
@@ -105,6 +120,8 @@ def senior_rules(form_arr: np.array) -> bool:
 
 
 class Spectrum:
+    __slots__ = ('mz_array', 'int_array')
+
     def __init__(self, mz_array: np.array, int_array: np.array):
         """
         :param mz_array: np.array
@@ -696,6 +713,7 @@ class MS2Explanation:
     """
     MS2Explanation class, used for storing MS2 explanation.
     """
+    __slots__ = ('idx_array', 'explanation_list')
 
     def __init__(self, idx_array: np.array,
                  explanation_list: List[Union[Formula, None]]):
@@ -720,6 +738,9 @@ class CandidateFormula:
     CandidateFormula is a class for storing a candidate formula. It's used in MetaFeature.candidate_formula_list.
     precursor formula in CandidateFormula is a neutral formula
     """
+    __slots__ = ('formula', 'charged_formula', 'mz_error', 'estimated_prob', 'normed_estimated_prob',
+                 'estimated_fdr', 'formula_feature_array', 'ms1_isotope_similarity', 'exp_ms2_sum_int',
+                 'ms2_raw_explanation', 'db_existed')
 
     def __init__(self, formula: Formula,
                  charged_formula: Union[Formula, None] = None,
@@ -752,6 +773,277 @@ class CandidateFormula:
         return cf_str
 
 
+class CandidateTable:
+    """
+    CandidateTable is a columnar (struct-of-arrays) store of all candidate formulas of a MetaFeature.
+    Scalar attributes are 1D arrays, formulas are 2D arrays, MS2 explanations are stored in CSR style:
+    explanations of candidate i are entries exp_ptr[i]:exp_ptr[i + 1].
+    Missing float values (None in CandidateFormula) are stored as NaN.
+    """
+
+    # nullable float columns, NaN <-> None
+    float_columns = ('mz_error', 'exp_ms2_sum_int', 'ms1_isotope_similarity',
+                     'estimated_prob', 'normed_estimated_prob', 'estimated_fdr')
+    # CSR columns of MS2 explanation entries
+    exp_columns = ('exp_idx', 'exp_null', 'exp_arr', 'exp_mass', 'exp_charge', 'exp_isotope')
+
+    def __init__(self, n: int, exp_cnt: int = 0):
+        """
+        allocate an empty table
+        :param n: number of candidate formulas
+        :param exp_cnt: total number of MS2 explanation entries
+        """
+        # neutral formula
+        self.formula_arr = np.zeros((n, 12), dtype=np.int16)
+        self.mass = np.zeros(n, dtype=np.float64)
+        self.dbe = np.zeros(n, dtype=np.float64)
+        # charged formula
+        self.has_charged = np.zeros(n, dtype=bool)
+        self.charged_arr = np.zeros((n, 12), dtype=np.int16)
+        self.charged_mass = np.zeros(n, dtype=np.float64)
+        self.charge = np.zeros(n, dtype=np.int8)
+        # scores
+        for col in self.float_columns:
+            setattr(self, col, np.full(n, np.nan, dtype=np.float64))
+        self.db_existed = np.zeros(n, dtype=bool)
+        self.has_feature = np.zeros(n, dtype=bool)
+        self.formula_feature_arr = None  # 2D array, allocated when first filled
+        # MS2 explanations, CSR
+        self.has_exp = np.zeros(n, dtype=bool)
+        self.exp_ptr = np.zeros(n + 1, dtype=np.int64)
+        self._alloc_exp(exp_cnt)
+
+    def _alloc_exp(self, exp_cnt: int):
+        self.exp_idx = np.zeros(exp_cnt, dtype=np.int32)  # indices of peaks in MS2 spectrum
+        self.exp_null = np.zeros(exp_cnt, dtype=bool)  # explanation is None
+        self.exp_arr = np.zeros((exp_cnt, 12), dtype=np.int16)  # fragment formula
+        self.exp_mass = np.zeros(exp_cnt, dtype=np.float32)  # fragment mass, float32 as in subformula enumeration
+        self.exp_charge = np.zeros(exp_cnt, dtype=np.int8)
+        self.exp_isotope = np.zeros(exp_cnt, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.mass)
+
+    @classmethod
+    def from_candidate_list(cls, cf_list: List[CandidateFormula]):
+        """
+        build a CandidateTable from a list of CandidateFormula objects (or views of a CandidateTable)
+        :param cf_list: List[CandidateFormula]
+        :return: CandidateTable
+        """
+        # views of a single table: gather rows
+        if cf_list and all(isinstance(cf, _CandidateFormulaView) for cf in cf_list):
+            table = cf_list[0]._table
+            if all(cf._table is table for cf in cf_list):
+                return table.take(np.array([cf._row for cf in cf_list], dtype=np.int64))
+
+        # explanations of views are copied from their tables, without building MS2Explanation objects
+        exp_list = [None if isinstance(cf, _CandidateFormulaView) else cf.ms2_raw_explanation for cf in cf_list]
+        exp_len = np.array([cf._table.exp_ptr[cf._row + 1] - cf._table.exp_ptr[cf._row]
+                            if isinstance(cf, _CandidateFormulaView) else (len(e) if e is not None else 0)
+                            for cf, e in zip(cf_list, exp_list)], dtype=np.int64)
+        out = cls(len(cf_list), int(np.sum(exp_len)))
+        out.exp_ptr[1:] = np.cumsum(exp_len)
+
+        for i, cf in enumerate(cf_list):
+            out._set_formula(i, cf.formula)
+            out._set_charged_formula(i, cf.charged_formula)
+            for col in cls.float_columns:
+                val = getattr(cf, col)
+                if val is not None:
+                    getattr(out, col)[i] = val
+            out.db_existed[i] = cf.db_existed
+            if cf.formula_feature_array is not None:
+                out._set_feature(i, cf.formula_feature_array)
+            if isinstance(cf, _CandidateFormulaView):
+                out.has_exp[i] = cf._table.has_exp[cf._row]
+                out._copy_exp(out.exp_ptr[i], cf._table, cf._table.exp_ptr[cf._row], exp_len[i])
+            elif exp_list[i] is not None:
+                out.has_exp[i] = True
+                out._fill_exp(out.exp_ptr[i], exp_list[i])
+        return out
+
+    def take(self, idx: np.array):
+        """
+        reorder / subset candidates
+        :param idx: 1D int array, row indices
+        :return: CandidateTable
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        exp_len = self.exp_ptr[idx + 1] - self.exp_ptr[idx]
+        out = CandidateTable(0)
+        for col in ('formula_arr', 'mass', 'dbe', 'has_charged', 'charged_arr', 'charged_mass', 'charge',
+                    'db_existed', 'has_feature', 'has_exp') + self.float_columns:
+            setattr(out, col, getattr(self, col)[idx])
+        if self.formula_feature_arr is not None:
+            out.formula_feature_arr = self.formula_feature_arr[idx]
+        out.exp_ptr = np.zeros(len(idx) + 1, dtype=np.int64)
+        out.exp_ptr[1:] = np.cumsum(exp_len)
+        # gather explanation entries of selected rows
+        exp_sel = np.repeat(self.exp_ptr[idx] - out.exp_ptr[:-1], exp_len) + np.arange(out.exp_ptr[-1])
+        for col in self.exp_columns:
+            setattr(out, col, getattr(self, col)[exp_sel])
+        return out
+
+    def exp_cnt(self) -> np.array:
+        """
+        :return: number of MS2 explanation entries of each candidate (0 if no explanation)
+        """
+        return np.diff(self.exp_ptr)
+
+    def views(self) -> List[CandidateFormula]:
+        """
+        :return: list of CandidateFormula views, one per row
+        """
+        return [_CandidateFormulaView(self, i) for i in range(len(self))]
+
+    def _set_formula(self, i: int, form: Formula):
+        self.formula_arr[i] = form.array
+        self.mass[i] = form.mass
+        self.dbe[i] = form.dbe
+
+    def _set_charged_formula(self, i: int, form: Union[Formula, None]):
+        self.has_charged[i] = form is not None
+        if form is not None:
+            self.charged_arr[i] = form.array
+            self.charged_mass[i] = form.mass
+            self.charge[i] = form.charge
+
+    def _set_feature(self, i: int, feature_arr: Union[np.array, None]):
+        self.has_feature[i] = feature_arr is not None
+        if feature_arr is None:
+            return
+        if self.formula_feature_arr is None or self.formula_feature_arr.shape[1] != len(feature_arr):
+            self.formula_feature_arr = np.zeros((len(self), len(feature_arr)), dtype=np.float64)
+            self.has_feature[:] = False
+            self.has_feature[i] = True
+        self.formula_feature_arr[i] = feature_arr
+
+    def _get_feature(self, i: int) -> Union[np.array, None]:
+        if not self.has_feature[i]:
+            return None
+        return self.formula_feature_arr[i]
+
+    def _fill_exp(self, start: int, exp: MS2Explanation):
+        for j, f in enumerate(exp.explanation_list):
+            k = start + j
+            self.exp_idx[k] = exp.idx_array[j]
+            if f is None:
+                self.exp_null[k] = True
+                continue
+            self.exp_arr[k] = f.array
+            self.exp_mass[k] = f.mass
+            self.exp_charge[k] = f.charge
+            self.exp_isotope[k] = f.isotope
+
+    def _copy_exp(self, start: int, src, src_start: int, cnt: int):
+        for col in self.exp_columns:
+            getattr(self, col)[start:start + cnt] = getattr(src, col)[src_start:src_start + cnt]
+
+    def _get_exp(self, i: int) -> Union[MS2Explanation, None]:
+        if not self.has_exp[i]:
+            return None
+        s, e = self.exp_ptr[i], self.exp_ptr[i + 1]
+        explanation_list = [None if self.exp_null[k] else
+                            Formula(self.exp_arr[k], int(self.exp_charge[k]), self.exp_mass[k],
+                                    int(self.exp_isotope[k])) for k in range(s, e)]
+        return MS2Explanation(idx_array=self.exp_idx[s:e], explanation_list=explanation_list)
+
+    def _set_exp(self, i: int, exp: Union[MS2Explanation, None]):
+        s, e = self.exp_ptr[i], self.exp_ptr[i + 1]
+        new_len = len(exp) if exp is not None else 0
+        if new_len == e - s:
+            # same length, overwrite in place
+            for col in self.exp_columns:
+                getattr(self, col)[s:e] = 0
+        else:
+            # splice CSR arrays
+            for col in self.exp_columns:
+                arr = getattr(self, col)
+                setattr(self, col, np.concatenate((arr[:s], np.zeros((new_len,) + arr.shape[1:], dtype=arr.dtype),
+                                                   arr[e:])))
+            self.exp_ptr[i + 1:] += new_len - (e - s)
+        self.has_exp[i] = exp is not None
+        if exp is not None:
+            self._fill_exp(s, exp)
+
+
+def _float_column(name: str):
+    """
+    property of a nullable float column of CandidateTable, for _CandidateFormulaView
+    """
+
+    def getter(self):
+        val = getattr(self._table, name)[self._row]
+        return None if np.isnan(val) else val
+
+    def setter(self, val):
+        getattr(self._table, name)[self._row] = np.nan if val is None else val
+
+    return property(getter, setter)
+
+
+class _CandidateFormulaView(CandidateFormula):
+    """
+    A CandidateFormula backed by a row of a CandidateTable. Attribute reads and writes go to the table.
+    """
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table: CandidateTable, row: int):
+        self._table = table
+        self._row = row
+
+    mz_error = _float_column('mz_error')
+    exp_ms2_sum_int = _float_column('exp_ms2_sum_int')
+    ms1_isotope_similarity = _float_column('ms1_isotope_similarity')
+    estimated_prob = _float_column('estimated_prob')
+    normed_estimated_prob = _float_column('normed_estimated_prob')
+    estimated_fdr = _float_column('estimated_fdr')
+
+    @property
+    def formula(self) -> Formula:
+        return Formula(self._table.formula_arr[self._row], 0, self._table.mass[self._row])
+
+    @formula.setter
+    def formula(self, form: Formula):
+        self._table._set_formula(self._row, form)
+
+    @property
+    def charged_formula(self) -> Union[Formula, None]:
+        t, i = self._table, self._row
+        if not t.has_charged[i]:
+            return None
+        return Formula(t.charged_arr[i], int(t.charge[i]), t.charged_mass[i])
+
+    @charged_formula.setter
+    def charged_formula(self, form: Union[Formula, None]):
+        self._table._set_charged_formula(self._row, form)
+
+    @property
+    def db_existed(self) -> bool:
+        return bool(self._table.db_existed[self._row])
+
+    @db_existed.setter
+    def db_existed(self, val: bool):
+        self._table.db_existed[self._row] = val
+
+    @property
+    def formula_feature_array(self) -> Union[np.array, None]:
+        return self._table._get_feature(self._row)
+
+    @formula_feature_array.setter
+    def formula_feature_array(self, feature_arr: Union[np.array, None]):
+        self._table._set_feature(self._row, feature_arr)
+
+    @property
+    def ms2_raw_explanation(self) -> Union[MS2Explanation, None]:
+        return self._table._get_exp(self._row)
+
+    @ms2_raw_explanation.setter
+    def ms2_raw_explanation(self, exp: Union[MS2Explanation, None]):
+        self._table._set_exp(self._row, exp)
+
+
 class MetaFeature:
     """
     MetaFeature class, used for storing a metabolic feature.
@@ -788,7 +1080,55 @@ class MetaFeature:
         self.ms1_processed = None  # type: ProcessedMS1 or None
         self.ms2_raw = ms2
         self.ms2_processed = None  # type: ProcessedMS2 or None
-        self.candidate_formula_list = None  # Union[List[CandidateFormula], None]
+        self._cand_table = None  # type: CandidateTable or None
+        self._cand_views = None  # cached views of self._cand_table
+
+    @property
+    def candidate_table(self) -> Union[CandidateTable, None]:
+        """
+        columnar store of candidate formulas
+        """
+        self._sync_cand_table()
+        return self._cand_table
+
+    @candidate_table.setter
+    def candidate_table(self, cand_table: Union[CandidateTable, None]):
+        self._cand_table = cand_table
+        self._cand_views = None
+
+    @property
+    def candidate_formula_list(self) -> Union[List[CandidateFormula], None]:
+        """
+        candidate formulas, as views of rows in self.candidate_table
+        """
+        if self._cand_table is None:
+            return None
+        if self._cand_views is None:
+            self._cand_views = self._cand_table.views()
+        return self._cand_views
+
+    @candidate_formula_list.setter
+    def candidate_formula_list(self, cf_list: Union[List[CandidateFormula], None]):
+        self.candidate_table = None if cf_list is None else CandidateTable.from_candidate_list(cf_list)
+
+    def _sync_cand_table(self):
+        """
+        rebuild the table if the list of views was modified in place (e.g. sorted, items replaced)
+        """
+        views = self._cand_views
+        if views is None:
+            return
+        if len(views) != len(self._cand_table) or \
+                not all(isinstance(cf, _CandidateFormulaView) and cf._table is self._cand_table and cf._row == i
+                        for i, cf in enumerate(views)):
+            self.candidate_formula_list = views
+
+    def __getstate__(self):
+        # only the columnar table is pickled
+        self._sync_cand_table()
+        state = self.__dict__.copy()
+        state['_cand_views'] = None
+        return state
 
     def __str__(self):
         mf_str = "mz " + str(self.mz) + "  adduct " + self.adduct.string
@@ -831,14 +1171,9 @@ class MetaFeature:
                   'formula_rank_4': None, 'formula_rank_5': None}
 
         if self.candidate_formula_list:
-            result['formula_rank_1'] = form_arr_to_str(self.candidate_formula_list[0].formula.array)
             result['estimated_fdr'] = self.candidate_formula_list[0].estimated_fdr
-            if len(self.candidate_formula_list) > 1:
-                result['formula_rank_2'] = form_arr_to_str(self.candidate_formula_list[1].formula.array)
-            if len(self.candidate_formula_list) > 2:
-                result['formula_rank_3'] = form_arr_to_str(self.candidate_formula_list[2].formula.array)
-            if len(self.candidate_formula_list) > 3:
-                result['formula_rank_4'] = form_arr_to_str(self.candidate_formula_list[3].formula.array)
-            if len(self.candidate_formula_list) > 4:
-                result['formula_rank_5'] = form_arr_to_str(self.candidate_formula_list[4].formula.array)
+            # top 5 formula strings, converted in batch
+            top_form_str_arr = form_arr_to_str_batch(self.candidate_table.formula_arr[:5])
+            for i, form_str in enumerate(top_form_str_arr):
+                result['formula_rank_' + str(i + 1)] = str(form_str)
         return result
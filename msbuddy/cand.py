@@ -13,16 +13,23 @@ GitHub: Philipbear
 Description: generate candidate formula space for a metabolic feature; mass search and bottom-up MS/MS interrogation
 """
 
+from collections import OrderedDict
 from typing import Union, List, Tuple
 
 import numpy as np
-from brainpy import isotopic_variants
 from numba import njit
 
-from msbuddy.base import Formula, CandidateFormula, MS2Explanation, MetaFeature, check_adduct, Adduct
+from msbuddy.base import Formula, CandidateFormula, MS2Explanation, MetaFeature, check_adduct, Adduct, \
+    calc_formula_dbe_arr
 from msbuddy.ml import _calc_log_p_norm
-from msbuddy.query import check_common_frag, check_common_nl, query_precursor_mass, query_fragnl_mass
-from msbuddy.utils import form_arr_to_str, enumerate_subformula, read_formula, SubformulaResult, FormulaResult
+from msbuddy.query import check_common_frag, check_common_nl, query_precursor_mass, query_fragnl_mass_batch
+from msbuddy.utils import form_arr_to_key, form_arr_to_key_arr, enumerate_subformula, enumerate_subformula_bounded, \
+    read_formula, SubformulaResult, FormulaResult
+
+# subformula lattices larger than this are enumerated by branch-and-bound within MS2 peak mass windows
+max_full_subform_cnt = 100000
+# max size of the subformula lattice cache in each process, in bytes
+subform_cache_max_bytes = 256 * 1024 ** 2
 
 
 class FragExplanation:
@@ -30,6 +37,7 @@ class FragExplanation:
     FragExplanation is a class for storing all potential fragment/nl explanations for a single MS/MS peak.
     It contains a list of fragment formulas, neutral loss formulas, and the index of the fragment.
     """
+    __slots__ = ('idx', 'frag_list', 'nl_list', 'optim_nl', 'optim_frag')
 
     def __init__(self, idx: int, frag: Formula, nl: Formula):
         self.idx = idx  # raw MS2 peak index
@@ -111,6 +119,45 @@ class FragExplanation:
         return
 
 
+class SubformulaCache:
+    """
+    LRU cache of full subformula lattices, keyed by precursor charged formula and adduct charge.
+    Each value is a tuple of arrays (subformula array, masses, mass-sorting permutation, prefilter mask); entries are
+    evicted by total byte size. One cache lives in each process, so that it is shared by all spectra in a worker.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key) -> Union[tuple, None]:
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value: tuple):
+        value_bytes = sum(arr.nbytes for arr in value)
+        if value_bytes > self.max_bytes:
+            return
+        for arr in value:
+            arr.flags.writeable = False
+        self.entries[key] = value
+        self.cur_bytes += value_bytes
+        # evict least recently used entries
+        while self.cur_bytes > self.max_bytes:
+            _, old_value = self.entries.popitem(last=False)
+            self.cur_bytes -= sum(arr.nbytes for arr in old_value)
+
+    def clear(self):
+        self.entries.clear()
+        self.cur_bytes = 0
+
+
+subform_cache = SubformulaCache(subform_cache_max_bytes)
+
+
 class CandidateSpace:
     """
     CandidateSpace is a class for bottom-up MS/MS interrogation.
@@ -118,13 +165,13 @@ class CandidateSpace:
     """
 
     def __init__(self, pre_neutral_array: np.array, pre_charged_array: np.array,
-                 pre_neutral_form_str: Union[str, None] = None,
+                 pre_neutral_key: Union[int, tuple, None] = None,
                  exp_frag_sum_int: Union[float, None] = None,
                  exp_frag_idx_ls: Union[List[int], None] = None,
                  frag_exp_ls: Union[List[FragExplanation], None] = None):
         self.pre_neutral_array = np.int16(pre_neutral_array)  # precursor neutral array
         self.pre_charged_array = np.int16(pre_charged_array)  # used for ms2 global optim.
-        self.pre_neutral_form_str = pre_neutral_form_str
+        self.pre_neutral_key = pre_neutral_key  # packed formula key, see _form_key
         self.exp_frag_sum_int = exp_frag_sum_int  # during candidate space generation
         self.exp_frag_idx_ls = exp_frag_idx_ls  # during candidate space generation
         self.neutral_mass = float(np.sum(pre_neutral_array * Formula.mass_arr))
@@ -210,39 +257,43 @@ def gen_candidate_formula(mf: MetaFeature, ppm: bool, ms1_tol: float, ms2_tol: f
 
     # if MS2 data missing or non-singly charged species, query precursor mass directly
     if not mf.ms2_processed or abs(mf.adduct.charge) > 1:
-        cf_list, _ = _gen_candidate_formula_from_mz(mf, ppm, ms1_tol,
-                                                    ele_lower_limit, ele_upper_limit, db_mode, gd)
+        cf_list, _, db_iso_arr = _gen_candidate_formula_from_mz(mf, ppm, ms1_tol,
+                                                                ele_lower_limit, ele_upper_limit, db_mode, gd)
 
     else:
         # if MS2 data available, generate candidate space with MS2 data
-        ms2_cand_form_ls, ms2_cand_form_str_ls = _gen_candidate_formula_from_ms2(mf, ppm, ms1_tol, ms2_tol,
+        ms2_cand_form_ls, ms2_cand_form_key_ls = _gen_candidate_formula_from_ms2(mf, ppm, ms1_tol, ms2_tol,
                                                                                  ele_lower_limit,
                                                                                  ele_upper_limit, db_mode, gd)
 
         # query precursor mass, for fill in db_existed
-        ms1_cand_form_ls, ms1_cand_form_str_ls = _gen_candidate_formula_from_mz(mf, ppm, ms1_tol, ele_lower_limit,
-                                                                                ele_upper_limit, db_mode, gd)
+        ms1_cand_form_ls, ms1_cand_form_key_ls, db_iso_arr = _gen_candidate_formula_from_mz(mf, ppm, ms1_tol,
+                                                                                            ele_lower_limit,
+                                                                                            ele_upper_limit,
+                                                                                            db_mode, gd)
 
+        # MS1 candidates come first in the merged list
         cf_list = _merge_cand_form_list(ms1_cand_form_ls, ms2_cand_form_ls,
-                                        ms1_cand_form_str_ls, ms2_cand_form_str_ls)
+                                        ms1_cand_form_key_ls, ms2_cand_form_key_ls)
 
         # if len(mf.ms2_processed) <= 5:
         #     # merge candidate formulas from ms1 and ms2
         #     cf_list = _merge_cand_form_list(ms1_cand_form_ls, ms2_cand_form_ls,
-        #                                     ms1_cand_form_str_ls, ms2_cand_form_str_ls)
+        #                                     ms1_cand_form_key_ls, ms2_cand_form_key_ls)
         # else:
         #     # fill in db_existed
         #     cf_list = _fill_in_db_existence(ms1_cand_form_ls, ms2_cand_form_ls,
-        #                                     ms1_cand_form_str_ls, ms2_cand_form_str_ls)
+        #                                     ms1_cand_form_key_ls, ms2_cand_form_key_ls)
 
     # calculate mz error
     cf_list = _calc_mz_error(cf_list, mf.mz, ppm)
 
     # if MS1 isotope data is available and >1 iso peaks, calculate isotope similarity
     ms1_iso_available = mf.ms1_processed and len(mf.ms1_processed) > 1
-    if ms1_iso_available:
+    if ms1_iso_available and cf_list:
+        ms1_iso_sim_arr = _calc_ms1_iso_sim_batch(cf_list, mf, max_isotope_cnt, db_iso_arr)
         for k, cf in enumerate(cf_list):
-            cf_list[k].ms1_isotope_similarity = _calc_ms1_iso_sim(cf, mf, max_isotope_cnt)
+            cf.ms1_isotope_similarity = ms1_iso_sim_arr[k]
 
     ms2_available = mf.ms2_processed
 
@@ -281,6 +332,205 @@ def _find_closest_mass_idx(mass: float, mass_arr: np.array) -> int:
     return idx
 
 
+# relative abundances of isotopes of each element, indexed by nominal mass shift from the monoisotopic isotope
+# ["C", "H", "Br", "Cl", "F", "I", "K", "N", "Na", "O", "P", "S"], same values as in brainpy
+isotope_abundance_arr = np.array([[0.9893, 0.0107, 0., 0., 0.],
+                                  [0.999885, 0.000115, 0., 0., 0.],
+                                  [0.5069, 0., 0.4931, 0., 0.],
+                                  [0.7576, 0., 0.2424, 0., 0.],
+                                  [1., 0., 0., 0., 0.],
+                                  [1., 0., 0., 0., 0.],
+                                  [0.932581, 0.000117, 0.067302, 0., 0.],
+                                  [0.99636, 0.00364, 0., 0., 0.],
+                                  [1., 0., 0., 0., 0.],
+                                  [0.99757, 0.00038, 0.00205, 0., 0.],
+                                  [1., 0., 0., 0., 0.],
+                                  [0.9499, 0.0075, 0.0425, 0., 0.0001]], dtype=np.float64)
+# max size of the isotope pattern cache, in number of formulas
+iso_pattern_cache_max_size = 100000
+
+
+class IsotopePatternCache:
+    """
+    Isotope pattern engine. Isotope patterns (aggregated by nominal mass shift) are computed by polynomial convolution,
+    using precomputed tables of element abundance polynomials raised to each element count (power_table[e, n] is the
+    polynomial of element e with count n, truncated). Patterns of single formulas are kept in an LRU cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.power_table = np.zeros((len(isotope_abundance_arr), 0, 0), dtype=np.float64)
+
+    def _get_power_table(self, max_cnt: int, iso_peaks: int) -> np.array:
+        """
+        get the power table, covering element counts 0 to max_cnt and iso_peaks isotope peaks
+        """
+        cur_cnt, cur_peaks = self.power_table.shape[1] - 1, self.power_table.shape[2]
+        if max_cnt > cur_cnt or iso_peaks > cur_peaks:
+            self.power_table = _build_iso_power_table(isotope_abundance_arr, max(max_cnt, 2 * cur_cnt, 64),
+                                                      max(iso_peaks, cur_peaks))
+        return self.power_table
+
+    def calc_batch(self, form_arr: np.array, iso_peaks: int) -> Tuple[np.array, np.array]:
+        """
+        calculate isotope patterns of a batch of formulas
+        :param form_arr: 2D array, each row is a 12-dim formula array
+        :param iso_peaks: number of isotope peaks to calculate
+        :return: 2D float32 array of isotope patterns (each row normalized), 1D array of pattern lengths
+        """
+        form_arr = np.asarray(form_arr, dtype=np.int64).reshape(-1, 12)
+        max_cnt = int(np.max(form_arr)) if form_arr.size else 0
+        power_table = self._get_power_table(max_cnt, iso_peaks)
+        return _calc_iso_pattern_arr(form_arr, power_table, iso_peaks)
+
+    def calc_batch_from_abundance(self, abundance_arr: np.array, net_form_arr: np.array,
+                                  iso_peaks: int) -> Tuple[np.array, np.array]:
+        """
+        calculate isotope patterns of a batch of formulas plus a net formula (e.g. an adduct),
+        from the known isotope abundances of the formulas
+        :param abundance_arr: 2D array, isotope abundances (M+0, M+1, ...) of formulas, at least iso_peaks columns
+        :param net_form_arr: 12-dim formula array, non-negative
+        :param iso_peaks: number of isotope peaks to calculate
+        :return: 2D float32 array of isotope patterns (each row normalized), 1D array of pattern lengths
+        """
+        net_form_arr = np.asarray(net_form_arr, dtype=np.int64).reshape(1, 12)
+        power_table = self._get_power_table(int(np.max(net_form_arr)), iso_peaks)
+        net_abundance = _calc_iso_abundance_arr(net_form_arr, power_table, iso_peaks)[0]
+        abundance_arr = np.ascontiguousarray(abundance_arr[:, :iso_peaks])
+        return _finalize_iso_pattern_arr(_add_iso_abundance_arr(abundance_arr, net_abundance))
+
+    def get(self, form_arr: np.array, iso_peaks: int) -> np.array:
+        """
+        isotope pattern of a single formula, cached
+        :param form_arr: 12-dim formula array
+        :param iso_peaks: number of isotope peaks to calculate
+        :return: 1D float32 array
+        """
+        key = (_form_key(np.asarray(form_arr)), iso_peaks)
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            return value
+        pattern_arr, len_arr = self.calc_batch(form_arr, iso_peaks)
+        value = pattern_arr[0, :len_arr[0]]
+        value.flags.writeable = False
+        self.entries[key] = value
+        # evict least recently used entries
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+
+@njit
+def _build_iso_power_table(abundance_arr: np.array, max_cnt: int, iso_peaks: int) -> np.array:
+    """
+    build the power table of element abundance polynomials, truncated to iso_peaks terms
+    :param abundance_arr: 2D array, isotope abundances of each element
+    :param max_cnt: max element count
+    :param iso_peaks: number of isotope peaks
+    :return: 3D array, (element, count, isotope peak)
+    """
+    n_ele, n_iso = abundance_arr.shape
+    power_table = np.zeros((n_ele, max_cnt + 1, iso_peaks), dtype=np.float64)
+    for e in range(n_ele):
+        power_table[e, 0, 0] = 1.
+        for n in range(1, max_cnt + 1):
+            for i in range(iso_peaks):
+                val = 0.
+                for j in range(min(i + 1, n_iso)):
+                    val += power_table[e, n - 1, i - j] * abundance_arr[e, j]
+                power_table[e, n, i] = val
+    return power_table
+
+
+@njit
+def _calc_iso_pattern_arr(form_arr: np.array, power_table: np.array, iso_peaks: int) -> Tuple[np.array, np.array]:
+    """
+    calculate isotope patterns by convolving element polynomials from the power table
+    :param form_arr: 2D int array
+    :param power_table: 3D array, see _build_iso_power_table
+    :param iso_peaks: number of isotope peaks
+    :return: 2D float32 array of isotope patterns, 1D int array of pattern lengths, see _finalize_iso_pattern_arr
+    """
+    return _finalize_iso_pattern_arr(_calc_iso_abundance_arr(form_arr, power_table, iso_peaks))
+
+
+@njit
+def _calc_iso_abundance_arr(form_arr: np.array, power_table: np.array, iso_peaks: int) -> np.array:
+    """
+    calculate isotope abundances (M+0, M+1, ...) of formulas, not normalized
+    :param form_arr: 2D int array
+    :param power_table: 3D array, see _build_iso_power_table
+    :param iso_peaks: number of isotope peaks
+    :return: 2D float64 array
+    """
+    n = form_arr.shape[0]
+    out = np.zeros((n, iso_peaks), dtype=np.float64)
+    for r in range(n):
+        out[r, 0] = 1.
+        for e in range(form_arr.shape[1]):
+            cnt = form_arr[r, e]
+            if cnt > 0:
+                _convolve_iso_abundance(out[r], power_table[e, cnt])
+    return out
+
+
+@njit
+def _convolve_iso_abundance(abundance: np.array, other: np.array):
+    """
+    convolve isotope abundances with another one in place, truncated to the length of abundance
+    """
+    for i in range(len(abundance) - 1, -1, -1):
+        val = 0.
+        for j in range(i + 1):
+            val += abundance[j] * other[i - j]
+        abundance[i] = val
+
+
+@njit
+def _finalize_iso_pattern_arr(abundance_arr: np.array) -> Tuple[np.array, np.array]:
+    """
+    isotope peaks with zero abundance are dropped, and the remaining peaks normalized (as in brainpy)
+    :param abundance_arr: 2D array of isotope abundances
+    :return: 2D float32 array of isotope patterns, 1D int array of pattern lengths
+    """
+    n, iso_peaks = abundance_arr.shape
+    out = np.zeros((n, iso_peaks), dtype=np.float32)
+    len_arr = np.zeros(n, dtype=np.int64)
+    for r in range(n):
+        total = 0.
+        for i in range(iso_peaks):
+            total += abundance_arr[r, i]
+        k = 0
+        for i in range(iso_peaks):
+            if abundance_arr[r, i] > 0:
+                out[r, k] = abundance_arr[r, i] / total
+                k += 1
+        len_arr[r] = k
+    return out, len_arr
+
+
+@njit
+def _add_iso_abundance_arr(abundance_arr: np.array, net_abundance: np.array) -> np.array:
+    """
+    isotope abundances of formulas plus a net formula, by convolution
+    :param abundance_arr: 2D array, isotope abundances of formulas
+    :param net_abundance: 1D array, isotope abundances of the net formula, same length as rows of abundance_arr
+    :return: 2D float64 array
+    """
+    out = abundance_arr.astype(np.float64)
+    for r in range(out.shape[0]):
+        _convolve_iso_abundance(out[r], net_abundance)
+    return out
+
+
+iso_pattern_cache = IsotopePatternCache(iso_pattern_cache_max_size)
+
+
 def calc_isotope_pattern(formula: Formula, iso_peaks: Union[int, None] = 4) -> np.array:
     """
     calculate isotope pattern of a neutral formula with a given adduct
@@ -288,16 +538,7 @@ def calc_isotope_pattern(formula: Formula, iso_peaks: Union[int, None] = 4) -> n
     :param iso_peaks: number of isotope peaks to calculate
     :return: intensity array of isotope pattern
     """
-    # mapping to a dictionary
-    arr_dict = {}
-    for i, element in enumerate(Formula.alphabet):
-        arr_dict[element] = formula.array[i]
-
-    # calculate isotope pattern
-    isotope_pattern = isotopic_variants(arr_dict, npeaks=iso_peaks)
-    int_arr = np.array([iso.intensity for iso in isotope_pattern], dtype=np.float32)
-
-    return int_arr
+    return iso_pattern_cache.get(formula.array, iso_peaks)
 
 
 @njit
@@ -327,6 +568,22 @@ def calc_isotope_similarity(int_arr_x, int_arr_y, iso_num: int) -> float:
     return sim_score
 
 
+@njit
+def calc_isotope_similarity_batch(int_arr_x, int_arr_y_2d, len_arr, iso_num: int) -> np.array:
+    """
+    calculate isotope similarity between an ms1 isotope pattern and a batch of isotope patterns
+    :param int_arr_x: intensity array of isotope pattern
+    :param int_arr_y_2d: 2D array, each row is an intensity array of isotope pattern
+    :param len_arr: lengths of the isotope patterns in int_arr_y_2d
+    :param iso_num: number of isotope peaks to calculate
+    :return: 1D array of isotope similarities
+    """
+    sim_arr = np.zeros(len(len_arr), dtype=np.float64)
+    for r in range(len(len_arr)):
+        sim_arr[r] = calc_isotope_similarity(int_arr_x, int_arr_y_2d[r, :len_arr[r]], iso_num)
+    return sim_arr
+
+
 @njit
 def _element_check(form_array: np.array, lower_limit: np.array, upper_limit: np.array) -> bool:
     """
@@ -413,28 +670,44 @@ def _adduct_loss_check(form: np.array, adduct_loss_form) -> bool:
     return True
 
 
-def _calc_ms1_iso_sim(cand_form, meta_feature, max_isotope_cnt) -> float:
+def _calc_ms1_iso_sim_batch(cf_list: List[CandidateFormula], meta_feature, max_isotope_cnt,
+                            db_iso_arr: Union[np.array, None] = None) -> np.array:
     """
-    calculate isotope similarity for a neutral precursor formula (CandidateFormula object)
-    :param cand_form: CandidateFormula object
+    calculate isotope similarity for a list of candidate formulas (CandidateFormula objects)
+    :param cf_list: list of CandidateFormula objects
     :param meta_feature: MetaFeature object
     :param max_isotope_cnt: maximum isotope count, used for MS1 isotope pattern matching
-    :return: ms1 isotope similarity
+    :param db_iso_arr: precomputed isotope patterns of the neutral formulas of the first len(db_iso_arr) candidates
+    (from the formula database), or None
+    :return: 1D array of ms1 isotope similarities
     """
-    # calculate theoretical isotope pattern
-    theo_isotope_pattern = calc_isotope_pattern(cand_form.charged_formula, max_isotope_cnt)
-
-    # calculate ms1 isotope similarity
-    ms1_isotope_sim = calc_isotope_similarity(meta_feature.ms1_processed.int_array, theo_isotope_pattern,
-                                              max_isotope_cnt)
-
-    return ms1_isotope_sim
+    adduct = meta_feature.adduct
+    # precomputed patterns are used for simple adducts (single M, no loss), charged pattern = neutral * adduct
+    if db_iso_arr is None or adduct.m != 1 or np.any(adduct.net_formula.array < 0) or \
+            max_isotope_cnt > db_iso_arr.shape[1]:
+        db_iso_arr = np.zeros((0, 0))
+
+    n_db = len(db_iso_arr)
+    theo_pattern_arr = np.zeros((len(cf_list), max_isotope_cnt), dtype=np.float32)
+    theo_len_arr = np.zeros(len(cf_list), dtype=np.int64)
+    if n_db > 0:
+        theo_pattern_arr[:n_db], theo_len_arr[:n_db] = \
+            iso_pattern_cache.calc_batch_from_abundance(db_iso_arr, adduct.net_formula.array, max_isotope_cnt)
+    # on-the-fly computation for the others (candidates from MS2 interrogation)
+    if n_db < len(cf_list):
+        charged_form_arr = np.array([cf.charged_formula.array for cf in cf_list[n_db:]])
+        theo_pattern_arr[n_db:], theo_len_arr[n_db:] = iso_pattern_cache.calc_batch(charged_form_arr,
+                                                                                    max_isotope_cnt)
+
+    return calc_isotope_similarity_batch(meta_feature.ms1_processed.int_array, theo_pattern_arr, theo_len_arr,
+                                         max_isotope_cnt)
 
 
 def _gen_candidate_formula_from_mz(meta_feature: MetaFeature,
                                    ppm: bool, ms1_tol: float,
                                    lower_limit: np.array, upper_limit: np.array,
-                                   db_mode: int, gd: dict) -> Tuple[List[CandidateFormula], List[str]]:
+                                   db_mode: int, gd: dict) -> Tuple[List[CandidateFormula], list,
+                                                                    Union[np.array, None]]:
     """
     Generate candidate formulas for a metabolic feature with precursor mz only
     :param meta_feature: MetaFeature object
@@ -444,30 +717,34 @@ def _gen_candidate_formula_from_mz(meta_feature: MetaFeature,
     :param upper_limit: upper limit of each element
     :param db_mode: database mode
     :param gd: global dictionary
-    :return: list of candidate formulas (CandidateFormula), list of candidate formula strings
+    :return: list of candidate formulas (CandidateFormula), list of candidate formula keys,
+    precomputed isotope patterns of the neutral formulas (None if not available in the database)
     """
     # query precursor mz
-    neutral_formulas, charged_formulas = query_precursor_mass(meta_feature.mz, meta_feature.adduct,
-                                                              ms1_tol, ppm, db_mode, gd)
+    neutral_formulas, charged_formulas, iso_arr = query_precursor_mass(meta_feature.mz, meta_feature.adduct,
+                                                                       ms1_tol, ppm, db_mode, gd, iso=True)
     # filter out formulas that exceed element limits
-    neutral_forms, charged_forms = [], []
+    neutral_forms, charged_forms, retained_idx = [], [], []
     for m, f in enumerate(neutral_formulas):
         if _element_check(f.array, lower_limit, upper_limit) and _senior_rules(f.array) and _o_p_check(f.array) \
                 and _dbe_check(f.array) and _adduct_loss_check(f.array, meta_feature.adduct.loss_formula):
             neutral_forms.append(f)
             charged_forms.append(charged_formulas[m])
+            retained_idx.append(m)
+    if iso_arr is not None:
+        iso_arr = iso_arr[np.array(retained_idx, dtype=np.int64)]
 
     # convert neutral formulas into CandidateFormula objects
     cand_form_list = [CandidateFormula(formula=form, charged_formula=charged_form, exp_ms2_sum_int=0.0,
                                        db_existed=True) for form, charged_form in zip(neutral_forms, charged_forms)]
-    cand_form_str_list = [form_arr_to_str(cf.formula.array) for cf in cand_form_list]
+    cand_form_key_list = _form_key_list(np.array([f.array for f in neutral_forms]))
 
-    return cand_form_list, cand_form_str_list
+    return cand_form_list, cand_form_key_list, iso_arr
 
 
 def _gen_candidate_formula_from_ms2(mf: MetaFeature, ppm: bool, ms1_tol: float, ms2_tol: float,
                                     lower_limit: np.array, upper_limit: np.array,
-                                    db_mode: int, gd) -> Tuple[List[CandidateFormula], List[str]]:
+                                    db_mode: int, gd) -> Tuple[List[CandidateFormula], list]:
     """
     Generate candidate formulas for a metabolic feature with MS2 data, then apply element limits
     :param mf: MetaFeature object
@@ -478,7 +755,7 @@ def _gen_candidate_formula_from_ms2(mf: MetaFeature, ppm: bool, ms1_tol: float,
     :param upper_limit: upper limit of each element
     :param db_mode: database mode
     :param gd: global dictionary
-    :return: list of candidate formulas (CandidateFormula), list of candidate formula strings
+    :return: list of candidate formulas (CandidateFormula), list of candidate formula keys
     """
 
     # normalize MS2 intensity
@@ -491,49 +768,54 @@ def _gen_candidate_formula_from_ms2(mf: MetaFeature, ppm: bool, ms1_tol: float,
     # calculate absolute MS1 tolerance
     ms1_abs_tol = ms1_tol if not ppm else ms1_tol * mf.mz * 1e-6
 
+    # query all fragment ions and neutral losses in formula database at once
+    # hits are flat arrays, grouped by MS2 peak index (owner)
+    frag_mz_arr = mf.ms2_processed.mz_array
+    nl_mz_arr = mf.mz - frag_mz_arr
+    frag_form_arr, frag_mass_arr, frag_owner_arr = query_fragnl_mass_batch(frag_mz_arr, True, mf.adduct.pos_mode,
+                                                                           na_bool, k_bool, ms2_tol, ppm, db_mode, gd)
+    nl_form_arr, nl_mass_arr, nl_owner_arr = query_fragnl_mass_batch(nl_mz_arr, False, mf.adduct.pos_mode,
+                                                                     na_bool, k_bool, ms2_tol, ppm, db_mode, gd)
+    frag_dbe_arr = calc_formula_dbe_arr(frag_form_arr)
+    nl_dbe_arr = calc_formula_dbe_arr(nl_form_arr)
+
+    # start index of each MS2 peak in the hit arrays
+    peak_idx_arr = np.arange(len(frag_mz_arr) + 1)
+    frag_start_arr = np.searchsorted(frag_owner_arr, peak_idx_arr)
+    nl_start_arr = np.searchsorted(nl_owner_arr, peak_idx_arr)
+
     candidate_space_list = []
-    existing_cand_str_list = []
-    for i in range(len(mf.ms2_processed.mz_array)):
-        # fragment ion m/z
-        frag_mz = mf.ms2_processed.mz_array[i]
-        # neutral loss m/z
-        nl_mz = mf.mz - frag_mz
-
-        # query mass in formula database
-        frag_form_list, nl_form_list = _query_frag_nl_pair(frag_mz, nl_mz, mf.adduct.pos_mode, na_bool, k_bool,
-                                                           ms2_tol, ppm, db_mode, gd)
-        if frag_form_list is None or nl_form_list is None:
+    existing_cand_dict = dict()  # formula key -> index in candidate_space_list
+    for i in range(len(frag_mz_arr)):
+        frag_start, frag_end = frag_start_arr[i], frag_start_arr[i + 1]
+        nl_start, nl_end = nl_start_arr[i], nl_start_arr[i + 1]
+        if frag_start == frag_end or nl_start == nl_end:
             continue
 
         # frag intensity
         frag_int = mf.ms2_processed.int_array[i]
 
-        # formula stitching
-        # iterate fragment formula list and neutral loss formula list
-        for frag in frag_form_list:
-            for nl in nl_form_list:
-                # DBE check, sum of DBE should be a non-integer
-                if (frag.dbe + nl.dbe) % 1 == 0 or (frag.dbe + nl.dbe) < 0 or frag.dbe < 0:
-                    continue
-                # sum mass check
-                if abs(frag.mass + nl.mass - mf.mz) > ms1_abs_tol:
-                    continue
-
-                # generate precursor formula & check adduct M
-                # NOTE: pre_form_arr is in neutral form
-                pre_form_arr = (frag.array + nl.array - mf.adduct.net_formula.array) / mf.adduct.m
-                valid_pre_form = _valid_precursor_array(pre_form_arr)
-                if not valid_pre_form:
-                    continue
-                # if valid, convert to int16
-                pre_form_arr = np.int16(pre_form_arr)
-
-                # add to candidate space list
-                candidate_space_list, existing_cand_str_list = _add_to_candidate_space_list(candidate_space_list,
-                                                                                            existing_cand_str_list,
-                                                                                            pre_form_arr.astype(int),
-                                                                                            frag.array, nl.array,
-                                                                                            frag_int, i)
+        # formula stitching, all fragment formulas x neutral loss formulas of this peak at once
+        # NOTE: pre_form_arr is in neutral form
+        pre_form_arr, pre_key_ls, frag_idx_arr, nl_idx_arr = _stitch_frag_nl(frag_form_arr[frag_start:frag_end],
+                                                                 frag_mass_arr[frag_start:frag_end],
+                                                                 frag_dbe_arr[frag_start:frag_end],
+                                                                 nl_form_arr[nl_start:nl_end],
+                                                                 nl_mass_arr[nl_start:nl_end],
+                                                                 nl_dbe_arr[nl_start:nl_end],
+                                                                 mf.mz, ms1_abs_tol,
+                                                                 mf.adduct.net_formula.array, mf.adduct.m)
+
+        # add to candidate space list
+        for k in range(len(pre_form_arr)):
+            candidate_space_list, existing_cand_dict = _add_to_candidate_space_list(candidate_space_list,
+                                                                                    existing_cand_dict,
+                                                                                    pre_form_arr[k], pre_key_ls[k],
+                                                                                    frag_form_arr[frag_start +
+                                                                                                  frag_idx_arr[k]],
+                                                                                    nl_form_arr[nl_start +
+                                                                                                nl_idx_arr[k]],
+                                                                                    frag_int, i)
 
     # element limit check, SENIOR rules, O/P check, DBE check
     candidate_list = [cs for cs in candidate_space_list
@@ -549,56 +831,98 @@ def _gen_candidate_formula_from_ms2(mf: MetaFeature, ppm: bool, ms1_tol: float,
     candidate_formula_list = [CandidateFormula(formula=Formula(cs.pre_neutral_array, 0, cs.neutral_mass),
                                                charged_formula=Formula(cs.pre_charged_array, mf.adduct.charge),
                                                exp_ms2_sum_int=cs.exp_frag_sum_int) for cs in candidate_list]
-    cand_form_str_list = [form_arr_to_str(cf.formula.array) for cf in candidate_formula_list]
+    cand_form_key_list = [cs.pre_neutral_key for cs in candidate_list]
 
-    return candidate_formula_list, cand_form_str_list
+    return candidate_formula_list, cand_form_key_list
 
 
-def _query_frag_nl_pair(frag_mz: float, nl_mz: float, pos_mode: bool, na_bool: bool, k_bool: bool,
-                        ms2_tol: float, ppm: bool,
-                        db_mode: int, gd) -> Tuple[Union[List[Formula], None], Union[List[Formula], None]]:
+def _stitch_frag_nl(frag_form_arr: np.array, frag_mass_arr: np.array, frag_dbe_arr: np.array,
+                    nl_form_arr: np.array, nl_mass_arr: np.array, nl_dbe_arr: np.array,
+                    mz: float, ms1_abs_tol: float, net_form_arr: np.array,
+                    m: int) -> Tuple[np.array, list, np.array, np.array]:
     """
-    query fragment and neutral loss formulas from database
-    :param frag_mz: fragment m/z
-    :param nl_mz: neutral loss m/z
-    :param pos_mode: positive mode or negative mode
-    :param na_bool: whether Na is contained in the adduct
-    :param k_bool: whether K is contained in the adduct
-    :param ms2_tol: MS2 tolerance
-    :param ppm: whether to use ppm as the unit of tolerance
-    :param db_mode: database mode
-    :param gd: global dictionary
-    :return: fragment formula list, neutral loss formula list
-    """
-    if nl_mz < frag_mz:
-        # search neutral loss first, for faster search
-        nl_form_list = query_fragnl_mass(nl_mz, False, pos_mode, na_bool, k_bool,
-                                         ms2_tol, ppm, db_mode, gd)
-        if nl_form_list:
-            frag_form_list = query_fragnl_mass(frag_mz, True, pos_mode,
-                                               na_bool, k_bool, ms2_tol, ppm, db_mode, gd)
-        else:
-            return None, None
-    else:
-        frag_form_list = query_fragnl_mass(frag_mz, True, pos_mode, na_bool, k_bool,
-                                           ms2_tol, ppm, db_mode, gd)
-        if frag_form_list:
-            nl_form_list = query_fragnl_mass(nl_mz, False, pos_mode, na_bool, k_bool,
-                                             ms2_tol, ppm, db_mode, gd)
+    stitch all fragment formulas and neutral loss formulas of an MS2 peak into precursor formulas (vectorized)
+    :param frag_form_arr: 2D array, fragment formulas
+    :param frag_mass_arr: fragment masses
+    :param frag_dbe_arr: fragment DBEs
+    :param nl_form_arr: 2D array, neutral loss formulas
+    :param nl_mass_arr: neutral loss masses
+    :param nl_dbe_arr: neutral loss DBEs
+    :param mz: precursor mz
+    :param ms1_abs_tol: absolute MS1 tolerance
+    :param net_form_arr: adduct net formula array
+    :param m: adduct M
+    :return: unique neutral precursor formulas (2D int array), their keys, indices of the fragment and neutral loss
+    that first form each precursor; in the order of fragment-major pair enumeration
+    """
+    # DBE check, sum of DBE should be a non-integer; sum mass check
+    dbe_sum_arr = frag_dbe_arr[:, None] + nl_dbe_arr[None, :]
+    valid_bool_arr = (dbe_sum_arr % 1 != 0) & (dbe_sum_arr >= 0) & (frag_dbe_arr >= 0)[:, None]
+    valid_bool_arr &= np.abs(frag_mass_arr[:, None] + nl_mass_arr[None, :] - mz) <= ms1_abs_tol
+    frag_idx_arr, nl_idx_arr = np.nonzero(valid_bool_arr)
+
+    # generate precursor formula & check adduct M
+    pre_form_arr = (frag_form_arr[frag_idx_arr] + nl_form_arr[nl_idx_arr] - net_form_arr) / m
+    valid_bool_arr = np.all((pre_form_arr >= 0) & (pre_form_arr % 1 == 0), axis=1)
+    pre_form_arr = pre_form_arr[valid_bool_arr].astype(int)
+    frag_idx_arr = frag_idx_arr[valid_bool_arr]
+    nl_idx_arr = nl_idx_arr[valid_bool_arr]
+
+    # unique precursor formulas by packed keys, keep the first occurrence order
+    key_arr = form_arr_to_key_arr(pre_form_arr)
+    if len(pre_form_arr) > 1:
+        if np.all(key_arr >= 0):
+            _, first_idx_arr = np.unique(key_arr, return_index=True)
         else:
-            return None, None
+            _, first_idx_arr = np.unique(pre_form_arr, axis=0, return_index=True)
+        first_idx_arr.sort()
+        pre_form_arr = pre_form_arr[first_idx_arr]
+        key_arr = key_arr[first_idx_arr]
+        frag_idx_arr = frag_idx_arr[first_idx_arr]
+        nl_idx_arr = nl_idx_arr[first_idx_arr]
+
+    return pre_form_arr, _key_arr_to_list(key_arr, pre_form_arr), frag_idx_arr, nl_idx_arr
+
+
+def _form_key(form_arr: np.array) -> Union[int, tuple]:
+    """
+    hashable key of a formula array, used for candidate deduplication
+    :param form_arr: formula array
+    :return: packed integer key; tuple of element counts if out of the packable range
+    """
+    key = form_arr_to_key(form_arr)
+    return key if key >= 0 else tuple(form_arr.tolist())
+
 
-    return frag_form_list, nl_form_list
+def _form_key_list(form_arr: np.array) -> list:
+    """
+    hashable keys of formula arrays, vectorized version of _form_key
+    :param form_arr: 2D array, each row is a formula array
+    :return: list of keys
+    """
+    return _key_arr_to_list(form_arr_to_key_arr(form_arr), form_arr)
 
 
-def _add_to_candidate_space_list(candidate_space_list: List[CandidateSpace], existing_cand_str_list: List[str],
-                                 pre_form_arr: np.array, frag_arr: np.array, nl_arr: np.array,
-                                 fragment_intensity: float, frag_idx: int) -> Tuple[List[CandidateSpace], List[str]]:
+def _key_arr_to_list(key_arr: np.array, form_arr: np.array) -> list:
+    """
+    convert packed keys into a list of hashable keys, rows out of the packable range fall back to tuples
+    """
+    key_ls = key_arr.tolist()
+    for i in np.flatnonzero(key_arr < 0):
+        key_ls[i] = tuple(form_arr[i].tolist())
+    return key_ls
+
+
+def _add_to_candidate_space_list(candidate_space_list: List[CandidateSpace], existing_cand_dict: dict,
+                                 pre_form_arr: np.array, pre_key: Union[int, tuple], frag_arr: np.array,
+                                 nl_arr: np.array, fragment_intensity: float,
+                                 frag_idx: int) -> Tuple[List[CandidateSpace], dict]:
     """
     add a new candidate formula to the candidate space list
     :param candidate_space_list: candidate space list
-    :param existing_cand_str_list: existing candidate formula string list
+    :param existing_cand_dict: dict, formula key -> index in candidate space list
     :param pre_form_arr: precursor formula array
+    :param pre_key: precursor formula key, see _form_key
     :param frag_arr: fragment formula array
     :param nl_arr: neutral loss formula array
     :param fragment_intensity: fragment intensity
@@ -606,18 +930,15 @@ def _add_to_candidate_space_list(candidate_space_list: List[CandidateSpace], exi
     :return: updated candidate space list
     """
     # check whether the precursor formula is already in the candidate space list
-    this_pre_str = form_arr_to_str(pre_form_arr)
-    candidate_exist = True if this_pre_str in existing_cand_str_list else False
+    idx = existing_cand_dict.get(pre_key)
     # this precursor formula has not been added to the candidate space list
-    if not candidate_exist:
+    if idx is None:
+        existing_cand_dict[pre_key] = len(candidate_space_list)
         candidate_space_list.append(CandidateSpace(pre_form_arr, frag_arr + nl_arr,
-                                                   pre_neutral_form_str=this_pre_str,
+                                                   pre_neutral_key=pre_key,
                                                    exp_frag_sum_int=fragment_intensity,
                                                    exp_frag_idx_ls=[frag_idx]))
-        existing_cand_str_list.append(this_pre_str)
     else:
-        # find the index of the existing candidate space
-        idx = existing_cand_str_list.index(this_pre_str)
         # if the fragment is already in the exp_frag_idx_ls
         if frag_idx in candidate_space_list[idx].exp_frag_idx_ls:
             pass
@@ -627,63 +948,40 @@ def _add_to_candidate_space_list(candidate_space_list: List[CandidateSpace], exi
             # add fragment idx
             candidate_space_list[idx].exp_frag_idx_ls.append(frag_idx)
 
-    return candidate_space_list, existing_cand_str_list
-
-
-@njit
-def _valid_precursor_array(pre_arr: np.array) -> bool:
-    """
-    check adduct M
-    :param pre_arr: precursor formula array
-    :return: precursor formula array or None
-    """
-    for i in range(len(pre_arr)):
-        if pre_arr[i] < 0 or pre_arr[i] % 1 != 0:
-            return False
-    return True
+    return candidate_space_list, existing_cand_dict
 
 
 def _merge_cand_form_list(ms1_cand_list: List[CandidateFormula], ms2_cand_list: List[CandidateFormula],
-                          ms1_cand_str_list: List[str], ms2_cand_str_list: List[str]) -> List[CandidateFormula]:
+                          ms1_cand_key_list: list, ms2_cand_key_list: list) -> List[CandidateFormula]:
     """
     Merge MS1 and MS2 candidate formula lists.
     Map MS2 candidate formulas to MS1 candidate formulas (db_existed=True)
     :param ms1_cand_list: candidate formula list from MS1 mz search
     :param ms2_cand_list: candidate formula list from MS2 interrogation
-    :param ms1_cand_str_list: candidate formula string list from MS1 mz search
-    :param ms2_cand_str_list: candidate formula string list from MS2 interrogation
+    :param ms1_cand_key_list: candidate formula key list from MS1 mz search
+    :param ms2_cand_key_list: candidate formula key list from MS2 interrogation
     :return: merged candidate formula list, remove duplicates
     """
+    ms1_cand_key_set = set(ms1_cand_key_list)
     out_list = ms1_cand_list.copy()
-    for m, cf in enumerate(ms2_cand_list):
-        found = False
-        for n, cf2 in enumerate(ms1_cand_list):
-            if ms1_cand_str_list[n] == ms2_cand_str_list[m]:
-                found = True
-                break
-        if not found:
-            out_list.append(cf)
+    out_list.extend([cf for cf, key in zip(ms2_cand_list, ms2_cand_key_list) if key not in ms1_cand_key_set])
 
     return out_list
 
 
 def _fill_in_db_existence(ms1_cand_list: List[CandidateFormula], ms2_cand_list: List[CandidateFormula],
-                          ms1_cand_str_list: List[str], ms2_cand_str_list: List[str]) -> List[CandidateFormula]:
+                          ms1_cand_key_list: list, ms2_cand_key_list: list) -> List[CandidateFormula]:
     """
     Fill in DB existence for MS2 candidate formulas.
     :param ms1_cand_list: candidate formula list from MS1 mz search
     :param ms2_cand_list: candidate formula list from MS2 interrogation
-    :param ms1_cand_str_list: candidate formula string list from MS1 mz search
-    :param ms2_cand_str_list: candidate formula string list from MS2 interrogation
+    :param ms1_cand_key_list: candidate formula key list from MS1 mz search
+    :param ms2_cand_key_list: candidate formula key list from MS2 interrogation
     :return: ms2 candidate formula list with db_existed filled in
     """
-    for m, cf in enumerate(ms2_cand_list):
-        found = False
-        for n, cf2 in enumerate(ms1_cand_list):
-            if ms1_cand_str_list[n] == ms2_cand_str_list[m]:
-                found = True
-                break
-        if found:
+    ms1_cand_key_set = set(ms1_cand_key_list)
+    for m, key in enumerate(ms2_cand_key_list):
+        if key in ms1_cand_key_set:
             ms2_cand_list[m].db_existed = True
 
     return ms2_cand_list
@@ -739,19 +1037,188 @@ def assign_subformula_cand_form(mf: MetaFeature, ppm: bool, ms2_tol: float) -> M
     :return: MetaFeature object
     """
 
-    for k, cf in enumerate(mf.candidate_formula_list):
-        # enumerate all subformulas
-        subform_arr = enumerate_subformula(cf.charged_formula.array)
-
-        # mono mass
-        mass_arr = _calc_subform_mass(subform_arr, mf.adduct.charge)
+    # superset lattice shared by candidate formulas of this MetaFeature
+    superset = _gen_superset_lattice([cf.charged_formula.array for cf in mf.candidate_formula_list],
+                                     mf.adduct.charge)
+
+    cf_list = []
+    for cf in mf.candidate_formula_list:
+        # enumerate subformulas, with mono mass and prefilter mask
+        subform_arr, mass_arr, order_arr, valid_bool_arr = _get_subform_lattice(cf.charged_formula.array,
+                                                                                mf.adduct.charge,
+                                                                                mf.ms2_processed.mz_array,
+                                                                                ppm, ms2_tol, superset)
         # assign ms2 explanation
-        mf.candidate_formula_list[k] = _assign_ms2_explanation(mf, cf, cf.charged_formula.array, subform_arr, mass_arr,
-                                                               ppm, ms2_tol)
+        cf_list.append(_assign_ms2_explanation(mf, cf, cf.charged_formula.array, subform_arr, mass_arr,
+                                               order_arr, valid_bool_arr, ppm, ms2_tol))
+    mf.candidate_formula_list = cf_list
 
     return mf
 
 
+def _gen_subform_arr(pre_charged_arr: np.array, adduct_charge: int, mz_arr: np.array,
+                     ppm: bool, ms2_tol: float) -> Tuple[np.array, np.array]:
+    """
+    Enumerate subformulas of a precursor and calculate their masses.
+    Small lattices are fully enumerated; for large lattices, only subformulas within tolerance of MS2 peaks are
+    enumerated (branch-and-bound), so that memory and time scale with the hits rather than the lattice size.
+    :param pre_charged_arr: precursor charged array
+    :param adduct_charge: adduct charge
+    :param mz_arr: MS2 m/z array
+    :param ppm: whether to use ppm as the unit of tolerance
+    :param ms2_tol: mz tolerance for fragment ions
+    :return: 2D array, each row is a subformula array; 1D array, mass of each subformula;
+    1D array, permutation sorting the masses
+    """
+    if _calc_lattice_size(pre_charged_arr) <= max_full_subform_cnt:
+        subform_arr = enumerate_subformula(pre_charged_arr)
+    else:
+        # mass windows of MS2 peaks, with a margin for float32 mass calculation
+        mz_arr = np.asarray(mz_arr, dtype=np.float64)
+        tol_arr = ms2_tol * mz_arr * 1e-6 if ppm else np.full(len(mz_arr), ms2_tol)
+        lower_arr, upper_arr = _merge_mass_windows(mz_arr - tol_arr - 0.01, mz_arr + tol_arr + 0.01)
+        subform_arr = enumerate_subformula_bounded(pre_charged_arr, lower_arr, upper_arr, adduct_charge)
+
+    mass_arr = _calc_subform_mass(subform_arr, adduct_charge)
+    return subform_arr, mass_arr, np.argsort(mass_arr, kind='stable')
+
+
+def _get_subform_lattice(pre_charged_arr: np.array, adduct_charge: int, mz_arr: np.array,
+                         ppm: bool, ms2_tol: float,
+                         superset: Union[tuple, None] = None) -> Tuple[np.array, np.array, np.array, np.array]:
+    """
+    Get subformulas of a precursor, with masses, mass-sorting permutation and prefilter mask (DBE >= 0, SENIOR rules,
+    valid subformula check). Full lattices are cached in subform_cache, and derived from the superset lattice if given.
+    :param pre_charged_arr: precursor charged array
+    :param adduct_charge: adduct charge
+    :param mz_arr: MS2 m/z array
+    :param ppm: whether to use ppm as the unit of tolerance
+    :param ms2_tol: mz tolerance for fragment ions
+    :param superset: superset lattice from _gen_superset_lattice, or None
+    :return: subformula array, mass array, permutation sorting the masses, prefilter boolean array
+    """
+    cache_key = (_form_key(pre_charged_arr), adduct_charge)
+    value = subform_cache.get(cache_key)
+    if value is not None:
+        return value
+
+    full_lattice = _calc_lattice_size(pre_charged_arr) <= max_full_subform_cnt
+    # the precursor may not be covered by the superset, e.g. if it was cached when the superset was built,
+    # then evicted
+    if full_lattice and superset is not None and np.all(pre_charged_arr <= superset[4]):
+        value = _derive_subform_lattice(pre_charged_arr, superset)
+    else:
+        subform_arr, mass_arr, order_arr = _gen_subform_arr(pre_charged_arr, adduct_charge, mz_arr, ppm, ms2_tol)
+        valid_bool_arr = _dbe_subform_filter(subform_arr, 0) & _senior_subform_filter(subform_arr) & \
+            _valid_subform_check(subform_arr, pre_charged_arr)
+        value = (subform_arr, mass_arr, order_arr, valid_bool_arr)
+
+    # only full lattices are independent of MS2 peaks
+    if full_lattice:
+        subform_cache.put(cache_key, value)
+    return value
+
+
+def _calc_lattice_size(pre_charged_arr: np.array) -> int:
+    """
+    Number of subformulas of a precursor (full lattice).
+    :param pre_charged_arr: precursor charged array
+    :return: lattice size
+    """
+    return int(np.prod(np.asarray(pre_charged_arr, dtype=np.int64) + 1))
+
+
+def _gen_superset_lattice(pre_charged_arr_list: List[np.array],
+                          adduct_charge: int) -> Union[Tuple[np.array, np.array, np.array, np.array, np.array],
+                                                       None]:
+    """
+    Enumerate the superset lattice of candidate precursors, i.e., the lattice of their element-wise maximum.
+    Only precursors with uncached full lattices are considered. The superset is used only if it is not larger than
+    the sum of their individual lattices.
+    :param pre_charged_arr_list: list of precursor charged arrays
+    :param adduct_charge: adduct charge
+    :return: superset subformula array, mass array, permutation sorting the masses, DBE & SENIOR mask,
+    superset precursor array (element-wise maximum); or None
+    """
+    arr_list = [arr for arr in pre_charged_arr_list
+                if _calc_lattice_size(arr) <= max_full_subform_cnt
+                and subform_cache.get((_form_key(arr), adduct_charge)) is None]
+    if len(arr_list) < 2:
+        return None
+
+    max_arr = np.max(np.array(arr_list), axis=0)
+    superset_size = _calc_lattice_size(max_arr)
+    if superset_size > max_full_subform_cnt or superset_size > sum(_calc_lattice_size(arr) for arr in arr_list):
+        return None
+
+    subform_arr = enumerate_subformula(max_arr)
+    mass_arr = _calc_subform_mass(subform_arr, adduct_charge)
+    order_arr = np.argsort(mass_arr, kind='stable')
+    # DBE and SENIOR filters are independent of the precursor
+    base_bool_arr = _dbe_subform_filter(subform_arr, 0) & _senior_subform_filter(subform_arr)
+    return subform_arr, mass_arr, order_arr, base_bool_arr, max_arr
+
+
+def _derive_subform_lattice(pre_charged_arr: np.array,
+                            superset: tuple) -> Tuple[np.array, np.array, np.array, np.array]:
+    """
+    Derive the full subformula lattice of a precursor from a superset lattice, by masking rows exceeding its counts.
+    The precursor must be covered by the superset, i.e. no count exceeds the superset precursor.
+    Rows keep the enumeration order of enumerate_subformula, and the permutation is that of a stable mass sort.
+    :param pre_charged_arr: precursor charged array
+    :param superset: superset lattice from _gen_superset_lattice
+    :return: subformula array, mass array, permutation sorting the masses, prefilter boolean array
+    """
+    super_subform_arr, super_mass_arr, super_order_arr, super_base_bool_arr, _ = superset
+    sub_bool_arr = np.all(super_subform_arr <= pre_charged_arr, axis=1)
+    sub_idx_arr = np.nonzero(sub_bool_arr)[0]
+
+    subform_arr = super_subform_arr[sub_idx_arr]
+    mass_arr = super_mass_arr[sub_idx_arr]
+    # superset order restricted to the subset, mapped to positions in the subset
+    pos_arr = np.cumsum(sub_bool_arr) - 1
+    order_arr = pos_arr[super_order_arr[sub_bool_arr[super_order_arr]]]
+    valid_bool_arr = super_base_bool_arr[sub_idx_arr] & _valid_subform_check(subform_arr, pre_charged_arr)
+    return subform_arr, mass_arr, order_arr, valid_bool_arr
+
+
+def _search_subform_mass(mass_arr: np.array, order_arr: np.array, mz_arr: np.array,
+                         ppm: bool, ms2_tol: float) -> Tuple[np.array, np.array]:
+    """
+    Find subformula candidates of all MS2 peaks by binary search in sorted masses.
+    windows are slightly widened; exact tolerance check is done on the returned slices
+    :param mass_arr: 1D array, mass of each subformula
+    :param order_arr: 1D array, permutation sorting the masses
+    :param mz_arr: MS2 m/z array
+    :param ppm: whether to use ppm as the unit of tolerance
+    :param ms2_tol: mz tolerance for fragment ions
+    :return: start and end positions in sorted masses (order_arr) of each peak
+    """
+    mz_arr = np.asarray(mz_arr, dtype=np.float64)
+    tol_arr = ms2_tol * mz_arr * 1e-6 if ppm else np.full(len(mz_arr), ms2_tol)
+    sorted_mass_arr = mass_arr[order_arr]
+    start_arr = np.searchsorted(sorted_mass_arr, (mz_arr - tol_arr - 1e-3).astype(np.float32), side='left')
+    end_arr = np.searchsorted(sorted_mass_arr, (mz_arr + tol_arr + 1e-3).astype(np.float32), side='right')
+    return start_arr, end_arr
+
+
+def _merge_mass_windows(lower_arr: np.array, upper_arr: np.array) -> Tuple[np.array, np.array]:
+    """
+    Sort and merge overlapping mass windows.
+    :param lower_arr: lower bounds
+    :param upper_arr: upper bounds
+    :return: sorted, non-overlapping lower bounds and upper bounds
+    """
+    if len(lower_arr) == 0:
+        return lower_arr, upper_arr
+    order = np.argsort(lower_arr)
+    lower_arr = lower_arr[order]
+    upper_arr = np.maximum.accumulate(upper_arr[order])
+    start_bool_arr = np.concatenate(([True], lower_arr[1:] > upper_arr[:-1]))
+    end_bool_arr = np.concatenate((start_bool_arr[1:], [True]))
+    return lower_arr[start_bool_arr], upper_arr[end_bool_arr]
+
+
 @njit
 def _calc_subform_mass(subform_arr: np.array, adduct_charge: int) -> np.array:
     """
@@ -824,8 +1291,8 @@ def _valid_subform_check(subform_arr: np.array, pre_charged_arr: np.array) -> np
 
 
 def _assign_ms2_explanation(mf: MetaFeature, cf: CandidateFormula, pre_charged_arr: np.array,
-                            subform_arr: np.array, mass_arr: np.array,
-                            ppm: bool, ms2_tol: float) -> CandidateFormula:
+                            subform_arr: np.array, mass_arr: np.array, order_arr: np.array,
+                            valid_bool_arr: np.array, ppm: bool, ms2_tol: float) -> CandidateFormula:
     """
     Assign MS2 explanation to a candidate formula.
     :param mf: MetaFeature object
@@ -833,42 +1300,34 @@ def _assign_ms2_explanation(mf: MetaFeature, cf: CandidateFormula, pre_charged_a
     :param pre_charged_arr: precursor charged array
     :param subform_arr: 2D array, each row is a subformula array
     :param mass_arr: 1D array, mass of each subformula
+    :param order_arr: 1D array, permutation sorting the masses
+    :param valid_bool_arr: 1D array, prefilter mask of each subformula (DBE, SENIOR rules, valid subformula check)
     :param ppm: whether to use ppm as the unit of tolerance
     :param ms2_tol: mz tolerance for fragment ions / neutral losses
     :return: CandidateFormula object
     """
     candidate_space = None
     ion_mode_int = 1 if mf.adduct.pos_mode else -1
+    # candidate index ranges of all peaks
+    start_arr, end_arr = _search_subform_mass(mass_arr, order_arr, mf.ms2_processed.mz_array, ppm, ms2_tol)
     for i in range(len(mf.ms2_processed.mz_array)):
-        # retrieve all indices of mass within tolerance
+        if start_arr[i] == end_arr[i]:
+            continue
+        # retrieve all indices of mass within tolerance, in enumeration order
         this_ms2_tol = ms2_tol if not ppm else ms2_tol * mf.ms2_processed.mz_array[i] * 1e-6
-        idx_list = np.where(abs(mf.ms2_processed.mz_array[i] - mass_arr) <= this_ms2_tol)[0]
+        idx_list = np.sort(order_arr[start_arr[i]:end_arr[i]])
+        # prefilter: dbe filter (DBE >= 0), SENIOR rules filter (a soft version), valid subformula check
+        idx_list = idx_list[(abs(mf.ms2_processed.mz_array[i] - mass_arr[idx_list]) <= this_ms2_tol) &
+                            valid_bool_arr[idx_list]]
 
+        # if no valid subformula, skip
         if len(idx_list) == 0:
             continue
 
-        # retrieve all subformulas within tolerance
+        # retrieve all valid subformulas within tolerance
         this_subform_arr = subform_arr[idx_list, :]
         this_mass = mass_arr[idx_list]
 
-        # dbe filter (DBE >= 0)
-        bool_arr_1 = _dbe_subform_filter(this_subform_arr, 0)
-
-        # SENIOR rules filter, a soft version
-        bool_arr_2 = _senior_subform_filter(this_subform_arr)
-
-        # valid subformula check
-        bool_arr_3 = _valid_subform_check(this_subform_arr, pre_charged_arr)
-
-        # combine filters
-        bool_arr = bool_arr_1 & bool_arr_2 & bool_arr_3
-        this_subform_arr = this_subform_arr[bool_arr, :]
-        this_mass = this_mass[bool_arr]
-
-        # if no valid subformula, skip
-        if this_subform_arr.shape[0] == 0:
-            continue
-
         frag_exp = FragExplanation(mf.ms2_processed.idx_array[i],
                                    Formula(this_subform_arr[0, :], ion_mode_int, this_mass[0]),
                                    Formula(pre_charged_arr - this_subform_arr[0, :], 0))
@@ -927,19 +1386,19 @@ def assign_subformula(ms2_mz: List, precursor_formula: str, adduct: str,
     ion = Adduct(adduct, pos_mode)
     ion_mode_int = 1 if pos_mode else -1
 
-    # enumerate all subformulas
+    # enumerate subformulas, with mono mass
     pre_charged_arr = form_arr * ion.m + ion.net_formula.array
-    subform_arr = enumerate_subformula(pre_charged_arr)
-
-    # mono mass
-    mass_arr = _calc_subform_mass(subform_arr, ion.charge)
+    subform_arr, mass_arr, order_arr = _gen_subform_arr(pre_charged_arr, ion.charge, np.array(ms2_mz), ppm, ms2_tol)
+    # candidate index ranges of all peaks
+    start_arr, end_arr = _search_subform_mass(mass_arr, order_arr, np.array(ms2_mz), ppm, ms2_tol)
 
     # assign ms2 explanation
     out_list = []
     for k, mz in enumerate(ms2_mz):
         # retrieve all indices of mass within tolerance
         this_ms2_tol = ms2_tol if not ppm else ms2_tol * mz * 1e-6
-        idx_list = np.where(abs(mz - mass_arr) <= this_ms2_tol)[0]
+        idx_list = np.sort(order_arr[start_arr[k]:end_arr[k]])
+        idx_list = idx_list[abs(mz - mass_arr[idx_list]) <= this_ms2_tol]
 
         if len(idx_list) == 0:
             out_list.append(SubformulaResult(k, []))
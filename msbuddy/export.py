@@ -15,8 +15,11 @@ Description: export results to files
 
 import pathlib
 
+import numpy as np
 import pandas as pd
 
+from msbuddy.utils import form_arr_to_str_batch
+
 
 def write_batch_results_cmd(buddy_data, output_path: pathlib.Path, write_details: bool,
                             start_idx: int, end_idx: int) -> pd.DataFrame:
@@ -80,13 +83,19 @@ def write_batch_results_cmd(buddy_data, output_path: pathlib.Path, write_details
                 })
                 continue
 
+            # formula strings of all candidates and explanations, converted in batch
+            cand_table = mf.candidate_table
+            form_str_arr = form_arr_to_str_batch(cand_table.formula_arr)
+            exp_str_arr = _exp_str_arr(cand_table)
+
             for m, cf in enumerate(mf.candidate_formula_list):
                 # strings for explained ms2 peak
                 if mf.ms2_processed:
-                    if cf.ms2_raw_explanation:
-                        exp_ms2_peak = len(cf.ms2_raw_explanation)
-                        ms2_explan_idx = ','.join([str(x) for x in cf.ms2_raw_explanation.idx_array])
-                        ms2_explan_str = ','.join([x.__str__() for x in cf.ms2_raw_explanation.explanation_list])
+                    exp_start, exp_end = cand_table.exp_ptr[m], cand_table.exp_ptr[m + 1]
+                    if cand_table.has_exp[m] and exp_end > exp_start:
+                        exp_ms2_peak = int(exp_end - exp_start)
+                        ms2_explan_idx = ','.join([str(x) for x in cand_table.exp_idx[exp_start:exp_end]])
+                        ms2_explan_str = ','.join(exp_str_arr[exp_start:exp_end])
                     else:
                         exp_ms2_peak = '0'
                         ms2_explan_idx = 'None'
@@ -101,7 +110,7 @@ def write_batch_results_cmd(buddy_data, output_path: pathlib.Path, write_details
                 mz_error_ppm = (mf.mz - theo_mass) / theo_mass * 1e6
                 all_candidates_df_rows.append({
                     'rank': str(m + 1),
-                    'formula': cf.formula.__str__(),
+                    'formula': form_str_arr[m] if form_str_arr[m] else 'Null',
                     'ms1_isotope_similarity': round(cf.ms1_isotope_similarity,
                                                     5) if cf.ms1_isotope_similarity is not None else 'NA',
                     'mz_error_ppm': round(mz_error_ppm, 5),
@@ -142,6 +151,18 @@ def write_batch_results_cmd(buddy_data, output_path: pathlib.Path, write_details
     return result_df
 
 
+def _exp_str_arr(cand_table) -> np.array:
+    """
+    strings of all MS2 explanation entries of a CandidateTable, same as str() of each explanation formula
+    :param cand_table: CandidateTable
+    :return: 1D str array
+    """
+    exp_str_arr = form_arr_to_str_batch(cand_table.exp_arr).astype(object)
+    exp_str_arr[exp_str_arr == ''] = 'Null'
+    exp_str_arr[cand_table.exp_null] = 'None'
+    return exp_str_arr
+
+
 def round_to_sci(number, decimals):
     """
     Round a number to a given number of decimals in scientific notation.
@@ -14,9 +14,11 @@ Description: load databases and data files
 """
 
 import logging
+import os
+import shutil
 from json import loads as loads
 from pathlib import Path
-from typing import List, Union
+from typing import Iterator, List, Tuple, Union
 
 import numpy as np
 from gdown import download as download
@@ -24,12 +26,23 @@ from joblib import load as j_load
 from requests import get
 
 from msbuddy.base import MetaFeature, Spectrum
+from msbuddy.query import build_common_frag_index, build_common_nl_index, build_fragnl_table, fragnl_table_max_mass, \
+    FragNLMemo, fragnl_memo_max_entries
 
 logging.basicConfig(level=logging.INFO)
 
 current_db_version = 'v0.2.4'
 current_model_version = 'v0.3.0'
 
+# formula database columns, saved as .npy files and loaded as memory-mapped arrays
+# (mass buckets, the idx column of the joblib database, are not converted; queries use binary search on the sorted
+# mass columns)
+formula_db_keys = ['basic_db_mass', 'basic_db_formula', 'halogen_db_mass', 'halogen_db_formula']
+# optional columns, precomputed isotope patterns of neutral formulas (built by db_prep), loaded if present
+formula_db_optional_keys = ['basic_db_iso', 'halogen_db_iso']
+# columns of each database in the joblib formula database, in order; None: not converted
+formula_db_columns = ['mass', 'formula', None, 'iso']
+
 
 def check_download_joblibload(url: str, path):
     """
@@ -44,9 +57,128 @@ def check_download_joblibload(url: str, path):
     return j_load(path)
 
 
-def init_db() -> dict:
+def _formula_db_npy_exists(db_dir: Path) -> bool:
+    """
+    check whether the formula database has been converted into .npy files
+    :param db_dir: directory of .npy files
+    :return: True if all .npy files exist
+    """
+    return all((db_dir / (key + '.npy')).exists() for key in formula_db_keys)
+
+
+def _convert_formula_db_to_npy(formula_db, db_dir: Path):
+    """
+    one-time conversion of the joblib formula database into raw .npy files, which can be memory-mapped
+    files are written into a temporary folder first, then renamed, so that concurrent processes never see partial data
+    :param formula_db: loaded formula database, [basic_db, halogen_db], each as [mass, formula, idx] or
+    [mass, formula, idx, iso]
+    :param db_dir: directory to save .npy files
+    :return: None
+    """
+    tmp_dir = db_dir.parent / (db_dir.name + '_tmp_' + str(os.getpid()))
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    for db_name, db in zip(['basic', 'halogen'], formula_db):
+        for col, arr in zip(formula_db_columns, db):
+            if col is None:
+                continue
+            np.save(tmp_dir / (db_name + '_db_' + col + '.npy'), np.ascontiguousarray(arr))
+
+    # remove incomplete files left by an interrupted conversion
+    if db_dir.exists() and not _formula_db_npy_exists(db_dir):
+        shutil.rmtree(db_dir, ignore_errors=True)
+    try:
+        os.replace(tmp_dir, db_dir)
+    except OSError:
+        # converted by another process in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not _formula_db_npy_exists(db_dir):
+            raise
+
+
+def _add_optional_formula_db_npy(db_dir: Path, joblib_path: Path):
+    """
+    write missing optional columns into an already converted formula database, if the joblib source has them
+    each version (size, mtime) of the joblib source is checked only once, recorded in a stamp file
+    nothing is written if the database folder is read-only (e.g. site-packages installs); optional columns are
+    then not used
+    :param db_dir: directory of .npy files
+    :param joblib_path: path of the joblib formula database
+    :return: None
+    """
+    missing_keys = [key for key in formula_db_optional_keys if not (db_dir / (key + '.npy')).exists()]
+    if not missing_keys or not joblib_path.exists() or not os.access(db_dir, os.W_OK):
+        return
+    stamp_path = db_dir / 'optional_source_stamp.txt'
+    stat = joblib_path.stat()
+    stamp = str(stat.st_size) + ' ' + str(stat.st_mtime_ns)
+    if stamp_path.exists() and stamp_path.read_text() == stamp:
+        return
+
+    formula_db = j_load(joblib_path)
+    try:
+        for db_name, db in zip(['basic', 'halogen'], formula_db):
+            n_rows = len(np.load(db_dir / (db_name + '_db_mass.npy'), mmap_mode='r'))
+            for col, arr in zip(formula_db_columns, db):
+                # rows must match the converted columns
+                if col is None or db_name + '_db_' + col not in missing_keys or len(arr) != n_rows:
+                    continue
+                key = db_name + '_db_' + col
+                # written into a temporary file first, then renamed
+                tmp_path = db_dir / (key + '_tmp_' + str(os.getpid()) + '.npy')
+                np.save(tmp_path, np.ascontiguousarray(arr))
+                os.replace(tmp_path, db_dir / (key + '.npy'))
+        stamp_path.write_text(stamp)
+    except OSError as e:
+        # database is used without the missing optional columns
+        logging.warning(f"Optional formula database columns are not written: {e}")
+
+
+class SharedDBHandle:
+    """
+    picklable handle of the memory-mapped formula database, for multiprocessing workers
+    only the database folder path is pickled (plus the small common frag/loss tables),
+    workers attach to the same .npy files, so they share physical pages instead of receiving a private copy
+    the low-mass fragment / neutral loss lookup table is small, and rebuilt in each process on attach
+    """
+    def __init__(self, db_dir: Path, common_loss_db: np.array, common_frag_db: np.array,
+                 fragnl_table_mass: float = fragnl_table_max_mass):
+        self.db_dir = Path(db_dir)
+        self.fragnl_table_mass = fragnl_table_mass
+        self.common_loss_db = common_loss_db
+        self.common_frag_db = common_frag_db
+        # hash indices for O(1) common loss / fragment lookup
+        self.common_loss_index = build_common_nl_index(common_loss_db)
+        self.common_frag_index = build_common_frag_index(common_frag_db)
+
+    def attach(self) -> dict:
+        """
+        open the memory-mapped database in the current process
+        :return: global_dict
+        """
+        global_dict = dict()
+        global_dict['common_loss_db'] = self.common_loss_db
+        global_dict['common_frag_db'] = self.common_frag_db
+        global_dict['common_loss_index'] = self.common_loss_index
+        global_dict['common_frag_index'] = self.common_frag_index
+        for key in formula_db_keys:
+            global_dict[key] = np.load(self.db_dir / (key + '.npy'), mmap_mode='r')
+        for key in formula_db_optional_keys:
+            if (self.db_dir / (key + '.npy')).exists():
+                global_dict[key] = np.load(self.db_dir / (key + '.npy'), mmap_mode='r')
+        # low-mass fragment / neutral loss lookup table
+        fragnl_table = build_fragnl_table(global_dict, self.fragnl_table_mass)
+        if fragnl_table is not None:
+            global_dict['fragnl_table'] = fragnl_table
+        # memo of fragment / neutral loss database hits, empty for each attached database
+        global_dict['fragnl_memo'] = FragNLMemo(fragnl_memo_max_entries)
+        global_dict['db_handle'] = self
+        return global_dict
+
+
+def init_db(fragnl_table_mass: float = fragnl_table_max_mass) -> dict:
     """
     init databases used in the project
+    :param fragnl_table_mass: mass threshold of the low-mass fragment / neutral loss lookup table, 0 to disable
     :return: global_dict
     """
     # get root path
@@ -65,17 +197,21 @@ def init_db() -> dict:
             'https://github.com/Philipbear/msbuddy/releases/download/msbuddy_data_v0.2.4/common_db_v0.2.4.joblib',
             data_path / db_name))
 
-    # formula_db
+    # formula_db, memory-mapped .npy columns (converted from joblib on first use)
+    db_dir = data_path / ('formula_db_' + current_db_version)
     db_name = 'formula_db_' + current_db_version + '.joblib'
-    basic_db, halogen_db = (
-        check_download_joblibload(
+    if not _formula_db_npy_exists(db_dir):
+        formula_db = check_download_joblibload(
             'https://github.com/Philipbear/msbuddy/releases/download/msbuddy_data_v0.2.4/formula_db_v0.2.4.joblib',
-            data_path / db_name))
-
-    global_dict['basic_db_mass'], global_dict['basic_db_formula'], global_dict['basic_db_idx'] = basic_db
-    global_dict['halogen_db_mass'], global_dict['halogen_db_formula'], global_dict['halogen_db_idx'] = halogen_db
+            data_path / db_name)
+        _convert_formula_db_to_npy(formula_db, db_dir)
+    else:
+        # optional columns missing from an earlier conversion, written from a local joblib source if it has them
+        _add_optional_formula_db_npy(db_dir, data_path / db_name)
 
-    return global_dict
+    db_handle = SharedDBHandle(db_dir, global_dict['common_loss_db'], global_dict['common_frag_db'],
+                               fragnl_table_mass)
+    return db_handle.attach()
 
 
 def init_ml_models(global_dict) -> dict:
@@ -108,16 +244,14 @@ def init_ml_models(global_dict) -> dict:
     return global_dict
 
 
-def load_mgf(file_path) -> List[MetaFeature]:
+def _iter_mgf_spec(file_path) -> Iterator[tuple]:
     """
-    read mgf file
+    read mgf file block by block
     :param file_path: path to mgf file
-    :return: list of MetaFeature
+    :return: generator of (identifier, precursor_mz, charge, rt, adduct_str, ms2_spec, mz_arr, int_arr);
+    identifier is None if not provided
     """
     with open(file_path, 'r') as file:
-        # create meta_feature_list
-        meta_feature_list = []
-        cnt = 0
         for line in file:
             # empty line
             _line = line.strip()  # remove leading and trailing whitespace
@@ -125,8 +259,7 @@ def load_mgf(file_path) -> List[MetaFeature]:
                 continue
             elif line.startswith('BEGIN IONS'):
                 # initialize a new spectrum entry
-                mz_arr = np.array([])
-                int_arr = np.array([])
+                peak_lines = []  # peak lines are buffered and parsed at once
                 precursor_mz = None
                 identifier = None
                 charge = None
@@ -135,11 +268,8 @@ def load_mgf(file_path) -> List[MetaFeature]:
                 rt = None
                 adduct_str = None
             elif line.startswith('END IONS'):
-                # create a new MetaFeature
                 if precursor_mz is None:
                     raise ValueError('No precursor mz found.')
-                if identifier is None:
-                    identifier = cnt
                 if charge is None:
                     charge = 1 if pos_mode else -1
                 elif charge == 0:
@@ -151,53 +281,22 @@ def load_mgf(file_path) -> List[MetaFeature]:
                 # if mz_arr.size == 0:
                 #     continue
 
-                # create MetaFeature object if the same identifier does not exist
-                mf_idx = None
-                for idx, mf in enumerate(meta_feature_list):
-                    if mf.identifier == identifier:
-                        mf_idx = idx
-                        break
-
-                # if the same identifier exists, add to the existing MetaFeature
-                if mf_idx is not None:
-                    if ms2_spec and meta_feature_list[mf_idx].ms2_raw is None:
-                        meta_feature_list[mf_idx].ms2_raw = Spectrum(mz_arr, int_arr) if mz_arr.size > 0 else None
-                    elif ms2_spec is False and meta_feature_list[mf_idx].ms1_raw is None:
-                        meta_feature_list[mf_idx].ms1_raw = Spectrum(mz_arr, int_arr) if mz_arr.size > 0 else None
-                    continue
-                # if the same identifier does not exist, create a new MetaFeature
-                else:
-                    if ms2_spec:
-                        mf = MetaFeature(mz=precursor_mz,
-                                         charge=charge,
-                                         rt=rt,
-                                         adduct=adduct_str,
-                                         ms2=Spectrum(mz_arr, int_arr) if mz_arr.size > 0 else None,
-                                         identifier=identifier)
-                    else:
-                        mf = MetaFeature(mz=precursor_mz,
-                                         charge=charge,
-                                         rt=rt,
-                                         adduct=adduct_str,
-                                         ms1=Spectrum(mz_arr, int_arr) if mz_arr.size > 0 else None,
-                                         identifier=identifier)
-                    meta_feature_list.append(mf)
-                    cnt += 1
-                continue
+                mz_arr, int_arr = _parse_peak_lines(peak_lines)
+                yield identifier, precursor_mz, charge, rt, adduct_str, ms2_spec, mz_arr, int_arr
             else:
                 # if line contains '=', it is a key-value pair
                 if '=' in _line:
                     # split by first '=', in case of multiple '=' in the line
                     key, value = _line.split('=', 1)
-                    key, value = key.strip(), value.strip()
+                    key, value = key.strip().upper(), value.strip()
                     # if key (into all upper case) is 'PEPMASS', it is precursor mz
-                    if key.upper() in ['PEPMASS', 'PRECURSOR_MZ', 'PRECURSORMZ']:
+                    if key in ['PEPMASS', 'PRECURSOR_MZ', 'PRECURSORMZ']:
                         precursor_mz = float(value)
                     # identifier
-                    elif key.upper() in ['TITLE', 'FEATURE_ID', 'SPECTRUMID', 'SPECTRUM_ID']:
+                    elif key in ['TITLE', 'FEATURE_ID', 'SPECTRUMID', 'SPECTRUM_ID']:
                         identifier = value.strip()
                     # if key is 'CHARGE' and charge is not set, it is charge
-                    elif key.upper() == 'CHARGE':
+                    elif key == 'CHARGE':
                         if '-' in value:
                             pos_mode = False
                             value = value.replace('-', '')
@@ -207,32 +306,146 @@ def load_mgf(file_path) -> List[MetaFeature]:
                             value = value.replace('+', '')
                             charge = int(value)
                     # if key is 'ION', it is adduct type
-                    elif key.upper() in ['ION', 'IONTYPE', 'ION_TYPE', 'ADDUCT', 'ADDUCTTYPE', 'ADDUCT_TYPE']:
+                    elif key in ['ION', 'IONTYPE', 'ION_TYPE', 'ADDUCT', 'ADDUCTTYPE', 'ADDUCT_TYPE']:
                         adduct_str = value
                     # if key is 'IONMODE', it is ion mode
-                    elif key.upper() in ['IONMODE', 'ION_MODE']:
+                    elif key in ['IONMODE', 'ION_MODE']:
                         if value.upper() in ['POSITIVE', 'POS', 'P']:
                             pos_mode = True
                         elif value.upper() in ['NEGATIVE', 'NEG', 'N']:
                             pos_mode = False
                     # if key is 'MSLEVEL', it is ms level
-                    elif key.upper() == 'MSLEVEL':
+                    elif key == 'MSLEVEL':
                         if value == '1':
                             ms2_spec = False
                     # if key is 'RTINSECONDS', it is rt
-                    elif key.upper() == 'RTINSECONDS' and value != '':
+                    elif key == 'RTINSECONDS' and value != '':
                         rt = float(value)
-                    elif key.upper() == 'RTINMINUTES' and value != '':
+                    elif key == 'RTINMINUTES' and value != '':
                         rt = float(value) * 60
                 else:
-                    # if no '=', it is a spectrum pair, split by '\t' or ' '
-                    this_mz, this_int = _line.split()
-                    mz_arr = np.append(mz_arr, float(this_mz))
-                    int_arr = np.append(int_arr, float(this_int))
+                    # if no '=', it is a spectrum pair
+                    peak_lines.append(_line)
+
+
+def _parse_peak_lines(peak_lines: List[str]) -> Tuple[np.array, np.array]:
+    """
+    parse buffered peak lines of a mgf spectrum block into mz and intensity arrays
+    :param peak_lines: list of peak lines, each as 'mz intensity', split by '\t' or ' '
+    :return: mz array, intensity array
+    """
+    if not peak_lines:
+        return np.array([]), np.array([])
+
+    # vectorized parse of the whole numeric block, if every line has exactly 2 tokens
+    token_ls = [_line.split() for _line in peak_lines]
+    if all(len(tokens) == 2 for tokens in token_ls):
+        peak_arr = np.array(token_ls, dtype=np.float64)
+        return peak_arr[:, 0].copy(), peak_arr[:, 1].copy()
+
+    # malformed line exists, parse line by line (raises ValueError)
+    mz_arr = np.empty(len(peak_lines))
+    int_arr = np.empty(len(peak_lines))
+    for i, tokens in enumerate(token_ls):
+        this_mz, this_int = tokens
+        mz_arr[i] = float(this_mz)
+        int_arr[i] = float(this_int)
+    return mz_arr, int_arr
+
+
+def _add_spec_to_meta_feature(mf: MetaFeature, ms2_spec: bool, mz_arr: np.array, int_arr: np.array):
+    """
+    add a spectrum to an existing MetaFeature sharing the same identifier, if its MS1 / MS2 is not yet filled
+    :param mf: MetaFeature object
+    :param ms2_spec: whether this is an MS2 spectrum
+    :param mz_arr: mz array
+    :param int_arr: intensity array
+    :return: None
+    """
+    if ms2_spec and mf.ms2_raw is None:
+        mf.ms2_raw = Spectrum(mz_arr, int_arr) if mz_arr.size > 0 else None
+    elif ms2_spec is False and mf.ms1_raw is None:
+        mf.ms1_raw = Spectrum(mz_arr, int_arr) if mz_arr.size > 0 else None
+
+
+def _new_meta_feature(identifier, precursor_mz: float, charge: int, rt, adduct_str, ms2_spec: bool,
+                      mz_arr: np.array, int_arr: np.array) -> MetaFeature:
+    """
+    create a new MetaFeature from a mgf spectrum block
+    :param identifier: identifier
+    :param precursor_mz: precursor mz
+    :param charge: charge
+    :param rt: retention time in seconds
+    :param adduct_str: adduct string
+    :param ms2_spec: whether this is an MS2 spectrum
+    :param mz_arr: mz array
+    :param int_arr: intensity array
+    :return: MetaFeature object
+    """
+    spec = Spectrum(mz_arr, int_arr) if mz_arr.size > 0 else None
+    if ms2_spec:
+        return MetaFeature(mz=precursor_mz, charge=charge, rt=rt, adduct=adduct_str, ms2=spec,
+                           identifier=identifier)
+    return MetaFeature(mz=precursor_mz, charge=charge, rt=rt, adduct=adduct_str, ms1=spec,
+                       identifier=identifier)
+
+
+def load_mgf(file_path) -> List[MetaFeature]:
+    """
+    read mgf file
+    :param file_path: path to mgf file
+    :return: list of MetaFeature
+    """
+    # create meta_feature_list
+    meta_feature_list = []
+    mf_idx_dict = dict()  # identifier -> index in meta_feature_list
+    cnt = 0
+    for identifier, precursor_mz, charge, rt, adduct_str, ms2_spec, mz_arr, int_arr in _iter_mgf_spec(file_path):
+        if identifier is None:
+            identifier = cnt
+
+        # create MetaFeature object if the same identifier does not exist
+        mf_idx = mf_idx_dict.get(identifier)
+
+        # if the same identifier exists, add to the existing MetaFeature
+        if mf_idx is not None:
+            _add_spec_to_meta_feature(meta_feature_list[mf_idx], ms2_spec, mz_arr, int_arr)
+        # if the same identifier does not exist, create a new MetaFeature
+        else:
+            mf_idx_dict[identifier] = len(meta_feature_list)
+            meta_feature_list.append(_new_meta_feature(identifier, precursor_mz, charge, rt, adduct_str, ms2_spec,
+                                                       mz_arr, int_arr))
+            cnt += 1
 
     return meta_feature_list
 
 
+def iter_mgf(file_path) -> Iterator[MetaFeature]:
+    """
+    read mgf file as a stream of MetaFeature, for annotating large files with bounded memory
+    MS1 / MS2 blocks sharing the same identifier are merged if they are adjacent in the file
+    :param file_path: path to mgf file
+    :return: generator of MetaFeature
+    """
+    mf = None  # pending MetaFeature, yielded once a block with another identifier is read
+    cnt = 0
+    for identifier, precursor_mz, charge, rt, adduct_str, ms2_spec, mz_arr, int_arr in _iter_mgf_spec(file_path):
+        if identifier is None:
+            identifier = cnt
+
+        if mf is not None and mf.identifier == identifier:
+            _add_spec_to_meta_feature(mf, ms2_spec, mz_arr, int_arr)
+            continue
+
+        if mf is not None:
+            yield mf
+        mf = _new_meta_feature(identifier, precursor_mz, charge, rt, adduct_str, ms2_spec, mz_arr, int_arr)
+        cnt += 1
+
+    if mf is not None:
+        yield mf
+
+
 def _load_usi(usi: str, adduct: Union[str, None] = None) -> MetaFeature:
     """
     Read from a USI string and return a MetaFeature object.
@@ -336,9 +549,12 @@ if __name__ == '__main__':
     # halogen_db_mass = j_load('../db_prep/halogen_db_mass.joblib')
     # halogen_db_formula = j_load('../db_prep/halogen_db_formula.joblib')
     # halogen_db_idx = j_load('../db_prep/halogen_db_idx.joblib')
+    # # optional, precomputed isotope patterns
+    # basic_db_iso = j_load('../db_prep/basic_db_iso.joblib')
+    # halogen_db_iso = j_load('../db_prep/halogen_db_iso.joblib')
     #
-    # basic_db = [basic_db_mass, basic_db_formula, basic_db_idx]
-    # halogen_db = [halogen_db_mass, halogen_db_formula, halogen_db_idx]
+    # basic_db = [basic_db_mass, basic_db_formula, basic_db_idx, basic_db_iso]
+    # halogen_db = [halogen_db_mass, halogen_db_formula, halogen_db_idx, halogen_db_iso]
     # formula_db = [basic_db, halogen_db]
     #
     # joblib.dump(formula_db, "data/formula_db.joblib")
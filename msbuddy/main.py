@@ -16,8 +16,9 @@ Description: main class for msbuddy
 import logging
 import pathlib
 import sys
+import weakref
 from multiprocessing import Pool, cpu_count
-from typing import Tuple, Union, List
+from typing import Iterator, Tuple, Union, List
 
 import numpy as np
 import pandas as pd
@@ -26,7 +27,7 @@ from tqdm import tqdm
 from msbuddy.base import MetaFeature, Adduct, check_adduct, senior_rules
 from msbuddy.cand import gen_candidate_formula, assign_subformula_cand_form
 from msbuddy.export import write_batch_results_cmd
-from msbuddy.load import init_db, init_ml_models, load_usi, load_mgf
+from msbuddy.load import init_db, init_ml_models, load_usi, load_mgf, iter_mgf, SharedDBHandle
 from msbuddy.ml import predict_formula_probability, calc_fdr
 from msbuddy.query import query_neutral_mass, query_precursor_mass
 from msbuddy.utils import form_arr_to_str, FormulaResult
@@ -64,7 +65,10 @@ class MsbuddyConfig:
                  i_range: Tuple[int, int] = (0, 10),
                  isotope_bin_mztol: float = 0.02, max_isotope_cnt: int = 4,
                  rel_int_denoise_cutoff: float = 0.01,
-                 top_n_per_50_da: int = 6):
+                 top_n_per_50_da: int = 6,
+                 fused_pipeline: bool = False,
+                 top_k: Union[int, None] = None,
+                 max_precursor_mz: float = 1500.):
         """
         :param ms_instr: mass spectrometry instrument, one of "orbitrap, "fticr", "qtof".
         :param ppm: whether ppm is used for m/z tolerance
@@ -89,6 +93,10 @@ class MsbuddyConfig:
         :param max_isotope_cnt: maximum isotope count, used for MS1 isotope pattern
         :param rel_int_denoise_cutoff: relative intensity cutoff, used for MS2 denoise
         :param top_n_per_50_da: top n peaks to keep in each 50 Da, used for MS2 denoise
+        :param fused_pipeline: whether each worker runs the whole annotation pipeline for a chunk of spectra;
+        only used for parallel processing
+        :param top_k: number of top candidate formulas kept for each spectrum in the fused pipeline; None keeps all
+        :param max_precursor_mz: spectra with precursor m/z above this value are removed before annotation
         """
         if ms_instr is None or ms_instr == "None":
             self.ppm = ppm
@@ -169,6 +177,19 @@ class MsbuddyConfig:
         else:
             self.top_n_per_50_da = int(top_n_per_50_da)
 
+        self.fused_pipeline = fused_pipeline
+        if top_k is not None and top_k < 1:
+            self.top_k = None
+            logging.warning("Top k is set to None, all candidate formulas are kept.")
+        else:
+            self.top_k = None if top_k is None else int(top_k)
+
+        if max_precursor_mz <= 1:
+            self.max_precursor_mz = 1500.
+            logging.warning(f"Maximum precursor m/z is set to {self.max_precursor_mz}.")
+        else:
+            self.max_precursor_mz = float(max_precursor_mz)
+
 
 class Msbuddy:
     """
@@ -197,10 +218,64 @@ class Msbuddy:
 
         self.data = None  # List[MetabolicFeature]
 
+        # persistent worker pool for parallel processing, created on first use
+        # without a with block, the pool is closed at the end of each annotation call
+        # singleton: close the pool of the previous initialization, if any
+        if getattr(self, '_pool', None) is not None:
+            self.close()
+        self._pool = None
+        self._pool_finalizer = None
+        self._in_context = False
+
+    def __enter__(self):
+        # keep the pool across annotation calls until the with block exits
+        self._in_context = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._in_context = False
+        self.close()
+
     def update_config(self, **kwargs):
         self.config = MsbuddyConfig(**kwargs)
         global shared_data_dict  # Declare it as a global variable
         shared_data_dict = init_db()  # database initialization
+        # worker number may change, restart the pool on next use
+        self.close()
+
+    def close(self):
+        """
+        shut down the worker pool, if started
+        :return: None
+        """
+        if self._pool is not None:
+            self._pool_finalizer.detach()
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._pool_finalizer = None
+
+    def _release_pool(self):
+        """
+        close the worker pool at the end of an annotation call, unless used as a context manager
+        :return: None
+        """
+        if not self._in_context:
+            self.close()
+
+    def _get_pool(self) -> Pool:
+        """
+        get the persistent worker pool, start it if not started
+        each worker attaches to the shared database and loads ML models once, the pool is reused for all batches
+        and pipeline stages of an annotation call (of all calls in a with block), until close() is called
+        :return: Pool object
+        """
+        if self._pool is None:
+            self._pool = Pool(processes=int(self.config.n_cpu), initializer=_init_pool,
+                              initargs=(shared_data_dict['db_handle'],))
+            # terminate workers if the pool is never closed, e.g. at interpreter exit
+            self._pool_finalizer = weakref.finalize(self, self._pool.terminate)
+        return self._pool
 
     def load_usi(self, usi_list: Union[str, List[str]],
                  adduct_list: Union[None, str, List[str]] = None):
@@ -246,24 +321,28 @@ class Msbuddy:
 
         # data preprocessing and candidate space generation
         if self.config.parallel:
-            with Pool(processes=int(self.config.n_cpu), initializer=_init_pool,
-                      initargs=(shared_data_dict,)) as pool:
-                async_results = [pool.apply_async(_preprocess_and_gen_cand_parallel,
-                                                  (mf, self.config)) for mf in batch_data]
-                # Initialize tqdm progress bar
-                pbar = tqdm(total=len(batch_data), colour="green", desc="Candidate space generation",
-                            file=sys.stdout)
-                for i, async_result in enumerate(async_results):
-                    pbar.update(1)  # Update tqdm progress bar
-                    try:
-                        modified_mf = async_result.get(timeout=self.config.timeout_secs)
-                        modified_mf_ls.append(modified_mf)
-                    except:
-                        mf = batch_data[i]
-                        logging.warning(f"Timeout for spectrum {mf.identifier}, mz={mf.mz}, rt={mf.rt}, skipped.")
-                        modified_mf_ls.append(mf)
+            pool = self._get_pool()
+            async_results = [pool.apply_async(_preprocess_and_gen_cand_parallel,
+                                              (mf, self.config)) for mf in batch_data]
+            # Initialize tqdm progress bar
+            pbar = tqdm(total=len(batch_data), colour="green", desc="Candidate space generation",
+                        file=sys.stdout)
+            timeout_bool = False
+            for i, async_result in enumerate(async_results):
+                pbar.update(1)  # Update tqdm progress bar
+                try:
+                    modified_mf = async_result.get(timeout=self.config.timeout_secs)
+                    modified_mf_ls.append(modified_mf)
+                except:
+                    timeout_bool = True
+                    mf = batch_data[i]
+                    logging.warning(f"Timeout for spectrum {mf.identifier}, mz={mf.mz}, rt={mf.rt}, skipped.")
+                    modified_mf_ls.append(mf)
             pbar.close()  # Close tqdm progress bar
             del async_results
+            # timed-out tasks keep occupying workers, restart the pool
+            if timeout_bool:
+                self.close()
         else:
             # normal loop, timeout implemented using timeout_decorator
             for mf in tqdm(batch_data, file=sys.stdout, colour="green", desc="Candidate space generation"):
@@ -289,15 +368,15 @@ class Msbuddy:
         modified_mf_ls = []  # modified metabolic feature list
 
         if self.config.parallel:
-            with Pool(processes=int(self.config.n_cpu)) as pool:
-                async_results = [pool.apply_async(_gen_subformula,
-                                                  (mf, self.config)) for mf in batch_data]
-
-                pbar = tqdm(total=len(batch_data), colour="green", desc="Subformula assignment: ", file=sys.stdout)
-                for i, async_result in enumerate(async_results):
-                    pbar.update(1)  # Update tqdm progress bar
-                    modified_mf = async_result.get()
-                    modified_mf_ls.append(modified_mf)
+            pool = self._get_pool()
+            async_results = [pool.apply_async(_gen_subformula,
+                                              (mf, self.config)) for mf in batch_data]
+
+            pbar = tqdm(total=len(batch_data), colour="green", desc="Subformula assignment: ", file=sys.stdout)
+            for i, async_result in enumerate(async_results):
+                pbar.update(1)  # Update tqdm progress bar
+                modified_mf = async_result.get()
+                modified_mf_ls.append(modified_mf)
             pbar.close()  # Close tqdm progress bar
             del async_results
         else:
@@ -310,6 +389,73 @@ class Msbuddy:
         self.data[batch_start_idx:batch_end_idx] = modified_mf_ls
         del modified_mf_ls
 
+    def _annotate_formula_fused(self, batch_start_idx: int, batch_end_idx: int):
+        """
+        annotate formula in the fused pipeline: each worker runs candidate generation, subformula assignment,
+        ML prediction and FDR calculation for a chunk of spectra, and returns the annotated chunk (top k candidates)
+        :param batch_start_idx: start index of batch
+        :param batch_end_idx: end index of batch
+        :return: None. Update self.data
+        """
+        batch_data = self.data[batch_start_idx:batch_end_idx]
+        modified_mf_ls = list(batch_data)  # modified metabolic feature list
+
+        # split batch into chunks, several chunks per worker for load balancing
+        n_chunk = min(len(batch_data), int(self.config.n_cpu) * 4)
+        chunk_ls = [chunk.tolist() for chunk in np.array_split(np.arange(len(batch_data)), n_chunk)]
+
+        pool = self._get_pool()
+        async_results = [pool.apply_async(_annotate_chunk_parallel,
+                                          ([batch_data[i] for i in chunk], self.config)) for chunk in chunk_ls]
+
+        pbar = tqdm(total=len(batch_data), colour="green", desc="Formula annotation", file=sys.stdout)
+        retry_idx_ls = []  # spectra of timed-out chunks
+        for chunk, async_result in zip(chunk_ls, async_results):
+            pbar.update(len(chunk))  # Update tqdm progress bar
+            try:
+                for i, mf in zip(chunk, async_result.get(timeout=self.config.timeout_secs * len(chunk))):
+                    modified_mf_ls[i] = mf
+            except:
+                retry_idx_ls.extend(chunk)
+        pbar.close()  # Close tqdm progress bar
+        del async_results
+
+        if retry_idx_ls:
+            # timed-out tasks keep occupying workers, restart the pool
+            self.close()
+            # retry spectra of timed-out chunks one at a time, so that only the slow spectra are skipped
+            self._annotate_formula_fused_single(batch_data, retry_idx_ls, modified_mf_ls)
+
+        # update data
+        self.data[batch_start_idx:batch_end_idx] = modified_mf_ls
+        del modified_mf_ls
+
+    def _annotate_formula_fused_single(self, batch_data: List[MetaFeature], idx_ls: List[int],
+                                       modified_mf_ls: List[MetaFeature]):
+        """
+        annotate spectra one per task in the fused pipeline, with the per-spectrum timeout
+        :param batch_data: list of MetaFeature objects of the batch
+        :param idx_ls: indices of spectra to annotate
+        :param modified_mf_ls: modified metabolic feature list of the batch, updated in place
+        :return: None
+        """
+        pool = self._get_pool()
+        async_results = [pool.apply_async(_annotate_chunk_parallel, ([batch_data[i]], self.config)) for i in idx_ls]
+
+        timeout_bool = False
+        for i, async_result in zip(idx_ls, async_results):
+            try:
+                modified_mf_ls[i] = async_result.get(timeout=self.config.timeout_secs)[0]
+            except:
+                timeout_bool = True
+                mf = batch_data[i]
+                logging.warning(f"Timeout for spectrum {mf.identifier}, mz={mf.mz}, rt={mf.rt}, skipped.")
+                modified_mf_ls[i] = mf
+        del async_results
+        # timed-out tasks keep occupying workers, restart the pool
+        if timeout_bool:
+            self.close()
+
     def annotate_formula(self):
         """
         annotate formula for loaded data
@@ -323,8 +469,11 @@ class Msbuddy:
         n_batch = self._annotate_formula_prepare()
 
         # loop over batches
-        for n in range(n_batch):
-            self._annotate_formula_main_batch(n, n_batch)
+        try:
+            for n in range(n_batch):
+                self._annotate_formula_main_batch(n, n_batch)
+        finally:
+            self._release_pool()
 
         tqdm.write("Job finished.")
 
@@ -345,29 +494,80 @@ class Msbuddy:
         result_summary_df_all = pd.DataFrame()
 
         # loop over batches
-        for n in range(n_batch):
-            start_idx, end_idx = self._annotate_formula_main_batch(n, n_batch)
-            tqdm.write("Writing batch results...")
-            result_summary_df = write_batch_results_cmd(self.data, output_path, write_details,
-                                                        start_idx, end_idx)
-            result_summary_df_all = pd.concat([result_summary_df_all, result_summary_df], ignore_index=True, axis=0)
-            # clear computed data to save memory, convert to None of the same size
-            self.data[start_idx:end_idx] = [None] * (end_idx - start_idx)
+        try:
+            for n in range(n_batch):
+                start_idx, end_idx = self._annotate_formula_main_batch(n, n_batch)
+                tqdm.write("Writing batch results...")
+                result_summary_df = write_batch_results_cmd(self.data, output_path, write_details,
+                                                            start_idx, end_idx)
+                result_summary_df_all = pd.concat([result_summary_df_all, result_summary_df], ignore_index=True,
+                                                  axis=0)
+                # clear computed data to save memory, convert to None of the same size
+                self.data[start_idx:end_idx] = [None] * (end_idx - start_idx)
+        finally:
+            self._release_pool()
 
         tqdm.write("Writing summary results to tsv file...")
         result_summary_df_all.to_csv(output_path / 'msbuddy_result_summary.tsv', sep="\t", index=False)
 
+    def annotate_stream(self, file_path, output_path: pathlib.Path, write_details: bool = False):
+        """
+        annotate formula for a mgf file in a streaming manner: read, annotate and write results chunk by chunk
+        the chunk size is the batch size; peak memory depends on the batch size rather than the file size
+        loaded data (self.data) is not used and is cleared
+        :param file_path: path to mgf file
+        :param output_path: output path
+        :param write_details: whether to write out detailed results
+        :return: None
+        """
+        global shared_data_dict  # Declare it as a global variable
+        shared_data_dict = init_ml_models(shared_data_dict)  # ml models initialization
+
+        output_path.mkdir(parents=True, exist_ok=True)
+        summary_path = output_path / 'msbuddy_result_summary.tsv'
+
+        n = 0
+        cnt_all = 0
+        try:
+            for chunk in _iter_chunk(iter_mgf(file_path), self.config.batch_size):
+                # select MetaFeatures with precursor 1 < mass < max_precursor_mz
+                max_mz = self.config.max_precursor_mz
+                self.data = [mf for mf in chunk if 1 < mf.mz < max_mz]
+                if len(self.data) != len(chunk):
+                    tqdm.write(f"{len(chunk) - len(self.data)} spectra with precursor mz > {max_mz} are removed.")
+                del chunk
+                if not self.data:
+                    continue
+
+                tqdm.write(f"Chunk {n + 1}, {len(self.data)} queries:")
+                self._annotate_formula_batch(0, len(self.data))
+
+                tqdm.write("Writing chunk results...")
+                result_summary_df = write_batch_results_cmd(self.data, output_path, write_details, 0, len(self.data))
+                result_summary_df.to_csv(summary_path, sep="\t", index=False, mode='w' if n == 0 else 'a',
+                                         header=n == 0)
+                cnt_all += len(self.data)
+                n += 1
+                self.data = None
+        finally:
+            self._release_pool()
+
+        if cnt_all == 0:
+            raise ValueError("No data loaded.")
+        tqdm.write(f"Job finished. {cnt_all} queries annotated.")
+
     def _annotate_formula_prepare(self) -> int:
         """
         prepare for formula annotation
         :return: batch number
         """
         cnt_pre = len(self.data)
-        # select MetaFeatures with precursor 1 < mass < 1500
-        self.data = [mf for mf in self.data if 1 < mf.mz < 1500]
+        # select MetaFeatures with precursor 1 < mass < max_precursor_mz
+        max_mz = self.config.max_precursor_mz
+        self.data = [mf for mf in self.data if 1 < mf.mz < max_mz]
         cnt_post = len(self.data)
         if cnt_pre != cnt_post:
-            tqdm.write(f"{cnt_pre - cnt_post} spectra with precursor mz > 1500 are removed.")
+            tqdm.write(f"{cnt_pre - cnt_post} spectra with precursor mz > {max_mz} are removed.")
 
         if not self.data:
             raise ValueError("No data loaded.")
@@ -395,6 +595,20 @@ class Msbuddy:
         tqdm.write(f"Batch {n + 1}/{n_batch}:")
         # get batch data
         start_idx, end_idx = _get_batch(self.data, self.config.batch_size, n)
+        self._annotate_formula_batch(start_idx, end_idx)
+        return start_idx, end_idx
+
+    def _annotate_formula_batch(self, start_idx: int, end_idx: int):
+        """
+        annotate formula for data in [start_idx, end_idx)
+        :param start_idx: start index of batch
+        :param end_idx: end index of batch
+        :return: None. Update self.data
+        """
+        # fused pipeline, each worker annotates a chunk of spectra from end to end
+        if self.config.parallel and self.config.fused_pipeline:
+            self._annotate_formula_fused(start_idx, end_idx)
+            return
 
         # data preprocessing and candidate space generation
         self._preprocess_and_generate_candidate_formula(start_idx, end_idx)
@@ -408,8 +622,6 @@ class Msbuddy:
         # FDR calculation
         calc_fdr(self.data, start_idx, end_idx)
 
-        return start_idx, end_idx
-
     def get_summary(self) -> List[dict]:
         """
         summarize results
@@ -429,7 +641,7 @@ class Msbuddy:
                         integer_dbe: bool = True) -> List[FormulaResult]:
         """
         convert mass to formula, return list of formula strings
-        :param mass: target mass, should be <1500 Da
+        :param mass: target mass
         :param mass_tol: mass tolerance
         :param ppm: whether mass_tol is in ppm
         :param halogen: whether to include halogen atoms
@@ -456,7 +668,7 @@ class Msbuddy:
                       dbe_cutoff: float = 0.0, integer_dbe: bool = True) -> List[FormulaResult]:
         """
         convert mz to formula, return list of formula strings
-        :param mz: target mz, should be <1500 Da
+        :param mz: target mz
         :param adduct: adduct string
         :param mz_tol: mz tolerance
         :param ppm: whether mz_tol is in ppm
@@ -493,6 +705,23 @@ class Msbuddy:
         return out
 
 
+def _iter_chunk(iterable, chunk_size: int) -> Iterator[list]:
+    """
+    split an iterable into lists of chunk_size
+    :param iterable: iterable
+    :param chunk_size: chunk size
+    :return: generator of lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def _get_batch(data: List[MetaFeature], batch_size: int, n: int):
     """
     get batch data
@@ -506,14 +735,14 @@ def _get_batch(data: List[MetaFeature], batch_size: int, n: int):
     return start_idx, end_idx
 
 
-def _init_pool(the_dict):
+def _init_pool(db_handle: SharedDBHandle):
     """
-    initialize pool for parallel processing
-    :param the_dict: global dictionary containing shared data
+    initialize pool for parallel processing, attach to the shared memory-mapped database and load ML models
+    :param db_handle: SharedDBHandle object
     :return: None
     """
     global shared_data_dict
-    shared_data_dict = the_dict
+    shared_data_dict = init_ml_models(db_handle.attach())
 
 
 def _preprocess_and_gen_cand_parallel(meta_feature: MetaFeature, ps: MsbuddyConfig) -> MetaFeature:
@@ -527,6 +756,33 @@ def _preprocess_and_gen_cand_parallel(meta_feature: MetaFeature, ps: MsbuddyConf
     return mf
 
 
+def _annotate_chunk_parallel(mf_ls: List[MetaFeature], ps: MsbuddyConfig) -> List[MetaFeature]:
+    """
+    a wrapper function for the fused pipeline, annotate a chunk of spectra in a worker
+    :param mf_ls: list of MetaFeature objects
+    :param ps: MsbuddyConfig object
+    :return: list of MetaFeature objects, with top k candidate formulas
+    """
+    for i, mf in enumerate(mf_ls):
+        try:
+            mf_ls[i] = _generate_candidate_formula(mf, ps, shared_data_dict)
+        except:
+            logging.warning(f"Candidate generation failed for spectrum {mf.identifier}, mz={mf.mz}, rt={mf.rt}, "
+                            f"skipped.")
+            continue
+        mf_ls[i] = _gen_subformula(mf_ls[i], ps)
+
+    predict_formula_probability(mf_ls, 0, len(mf_ls), ps, shared_data_dict)
+    calc_fdr(mf_ls, 0, len(mf_ls), progress_bar=False)
+
+    # only return top k candidate formulas, FDR is calculated using all candidates
+    if ps.top_k is not None:
+        for mf in mf_ls:
+            if mf.candidate_formula_list:
+                mf.candidate_formula_list = mf.candidate_formula_list[:ps.top_k]
+    return mf_ls
+
+
 def _gen_subformula(mf: MetaFeature, ps: MsbuddyConfig) -> MetaFeature:
     """
     a wrapper function for subformula generation
@@ -544,14 +800,10 @@ def _gen_subformula(mf: MetaFeature, ps: MsbuddyConfig) -> MetaFeature:
     mf = assign_subformula_cand_form(mf, ps.ppm, ps.ms2_tol)
 
     # retain candidate formula with subformula annotations if there is any candidate formula with annotations
-    cand_form_exp_ms2_peak_list = []
-    for cf in mf.candidate_formula_list:
-        if cf.ms2_raw_explanation:
-            cand_form_exp_ms2_peak_list.append(len(cf.ms2_raw_explanation))
-        else:
-            cand_form_exp_ms2_peak_list.append(0)
-    if min(cand_form_exp_ms2_peak_list) > 0:
-        mf.candidate_formula_list = [cf for cf in mf.candidate_formula_list if len(cf.ms2_raw_explanation) > 0]
+    cand_table = mf.candidate_table
+    exp_cnt_arr = cand_table.exp_cnt()
+    if np.min(exp_cnt_arr) > 0:
+        mf.candidate_table = cand_table.take(np.flatnonzero(exp_cnt_arr > 0))
 
     return mf
 
@@ -28,6 +28,10 @@ def main():
     parser.add_argument('-csv', type=str,
                         help='Path to the CSV file containing USI strings in the first column (no header row).')
     parser.add_argument('-output', '-o', type=str, help='The output file path.')
+    parser.add_argument('-stream', action='store_true',
+                        help='Store true. Whether to read, annotate and write the MGF file batch by batch, '
+                             'so that memory usage depends on batch size rather than file size. '
+                             'MGF input only. Default: disabled.')
     parser.add_argument('-details', '-d', action='store_true',
                         help='Store true. Whether to write detailed results. Default: detailed results are not written.')
     parser.add_argument('-ms_instr', '-ms', type=str, default=None,
@@ -72,9 +76,14 @@ def main():
                         help='Relative intensity cutoff, used for MS2 denoise. Default: 0.01.')
     parser.add_argument('-top_n_per_50_da', type=int, default=6,
                         help='Top n peaks per 50 Da, used for MS2 denoise. Default: 6.')
+    parser.add_argument('-max_precursor_mz', type=float, default=1500.,
+                        help='Spectra with precursor m/z above this value are removed. Default: 1500.')
 
     args = parser.parse_args()
 
+    if args.stream and not args.mgf:
+        raise ValueError('Streaming mode (-stream) is only supported for MGF input (-mgf).')
+
     # run msbuddy
     # create a MsbuddyConfig object
     msb_config = MsbuddyConfig(
@@ -88,7 +97,8 @@ def main():
         f_range=(args.f_min, args.f_max), cl_range=(args.cl_min, args.cl_max), br_range=(args.br_min, args.br_max),
         i_range=(args.i_min, args.i_max),
         isotope_bin_mztol=args.isotope_bin_mztol, max_isotope_cnt=args.max_isotope_cnt,
-        rel_int_denoise_cutoff=args.rel_int_denoise_cutoff, top_n_per_50_da=args.top_n_per_50_da
+        rel_int_denoise_cutoff=args.rel_int_denoise_cutoff, top_n_per_50_da=args.top_n_per_50_da,
+        max_precursor_mz=args.max_precursor_mz
     )
 
     if args.output:
@@ -101,6 +111,13 @@ def main():
 
     engine = Msbuddy(msb_config)
 
+    # streaming mode
+    if args.stream:
+        engine.annotate_stream(args.mgf, output_path, write_details=args.details)
+        engine.close()
+        print('Job finished.')
+        return
+
     if args.mgf:
         engine.load_mgf(args.mgf)
     elif args.usi:
@@ -118,6 +135,7 @@ def main():
         raise ValueError('Please specify the input data source.')
 
     engine.annotate_formula_cmd(output_path, write_details=args.details)
+    engine.close()
 
     print('Job finished.')
 
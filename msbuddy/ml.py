@@ -22,7 +22,8 @@ from numba import njit
 from scipy.stats import norm
 from tqdm import tqdm
 
-from msbuddy.query import common_nl_from_array, check_formula_existence
+from msbuddy.base import calc_formula_dbe_arr
+from msbuddy.query import common_nl_from_index, check_formula_existence, check_formula_existence_batch
 
 # ignore warnings
 warnings.filterwarnings('ignore')
@@ -34,19 +35,14 @@ def _gen_arr_from_buddy_data(buddy_data) -> (np.array, np.array, np.array):
     :param buddy_data: List of MetaFeature objects
     :return: all_cand_form_arr, dbe_arr, mass_arr
     """
-    all_cand_form_arr = np.empty((0, 12))  # formula array of all candidate formulas
-    dbe_arr = np.array([])
-    mass_arr = np.array([])
+    cand_table_ls = [mf.candidate_table for mf in buddy_data if mf.candidate_formula_list]
+    if not cand_table_ls:
+        return np.empty((0, 12)), np.array([]), np.array([])
 
-    for mf in buddy_data:
-        if not mf.candidate_formula_list:
-            continue
-        # generate ML features for each candidate formula
-        for cf in mf.candidate_formula_list:
-            # add formula array to all_cand_form_arr
-            all_cand_form_arr = np.append(all_cand_form_arr, [cf.formula.array], axis=0)
-            dbe_arr = np.append(dbe_arr, cf.formula.dbe)
-            mass_arr = np.append(mass_arr, cf.formula.mass)
+    # formula array of all candidate formulas
+    all_cand_form_arr = np.concatenate([t.formula_arr for t in cand_table_ls]).astype(np.float64)
+    dbe_arr = np.concatenate([t.dbe for t in cand_table_ls])
+    mass_arr = np.concatenate([t.mass for t in cand_table_ls])
 
     return all_cand_form_arr, dbe_arr, mass_arr
 
@@ -139,44 +135,49 @@ def _fill_form_feature_arr_in_batch_data(batch_data, feature_arr) -> None:
     for mf in batch_data:
         if not mf.candidate_formula_list:
             continue
-        # fill in ML features for each candidate formula
-        for cf in mf.candidate_formula_list:
-            cf.formula_feature_array = feature_arr[cnt, :]
-            cnt += 1
+        # fill in ML features for all candidate formulas
+        cand_table = mf.candidate_table
+        cand_table.formula_feature_arr = feature_arr[cnt:cnt + len(cand_table), :]
+        cand_table.has_feature[:] = True
+        cnt += len(cand_table)
     return
 
 
 def gen_ml_feature(meta_feature_list, ppm: bool, ms1_tol: float, ms2_tol: float, gd) -> np.array:
     """
     generate ML features for all metabolic features
+    features of all candidate formulas are filled into a preallocated array, using the columns of candidate tables
     :param meta_feature_list: List of MetaFeature objects
     :param ppm: whether to use ppm error
     :param ms1_tol: m/z tolerance for MS1
     :param ms2_tol: m/z tolerance for MS2
     :param gd: global dependencies
-    :return: numpy array of ML features
+    :return: numpy array of ML features, 3 + 26 + 24 columns
     """
-    # generate feature array and group size array
-    total_X_arr = np.array([])
-
-    for mf in meta_feature_list:
-        if not mf.candidate_formula_list:
-            continue
-
-        # generate ML features for each candidate formula
-        for cf in mf.candidate_formula_list:
-            # get ML features
-            ml_feature_arr = gen_ml_feature_single(mf, cf, ppm, ms1_tol, ms2_tol, gd)
-
-            # add to feature array
-            if total_X_arr.size == 0:
-                total_X_arr = ml_feature_arr
-            else:
-                total_X_arr = np.vstack((total_X_arr, ml_feature_arr))
+    mf_ls = [mf for mf in meta_feature_list if mf.candidate_formula_list]
+    total_cnt = sum(len(mf.candidate_table) for mf in mf_ls)
+    if total_cnt == 0:
+        return np.array([])
 
-    # ensure 2d array
-    if len(total_X_arr.shape) == 1:
-        total_X_arr = np.expand_dims(total_X_arr, axis=0)
+    total_X_arr = np.empty((total_cnt, 53))
+    cnt = 0
+    for mf in mf_ls:
+        cand_table = mf.candidate_table
+        X_arr = total_X_arr[cnt:cnt + len(cand_table)]
+        cnt += len(cand_table)
+
+        # MS1 isotope similarity
+        X_arr[:, 0] = np.nan_to_num(cand_table.ms1_isotope_similarity, nan=0)
+        # mz error in ppm
+        theo_mass = cand_table.charged_mass / abs(mf.adduct.charge)
+        mz_error = (mf.mz - theo_mass) / theo_mass * 1e6 if ppm else mf.mz - theo_mass
+        X_arr[:, 1] = _calc_log_p_norm_arr(mz_error, ms1_tol / 3)
+        # pos mode bool
+        X_arr[:, 2] = 1 if mf.adduct.charge > 0 else 0
+        # formula features, 26
+        X_arr[:, 3:29] = cand_table.formula_feature_arr
+        # MS/MS-related features, 24
+        X_arr[:, 29:] = _gen_ms2_feature_arr(mf, cand_table, ppm, ms2_tol, gd)
 
     return total_X_arr
 
@@ -337,6 +338,169 @@ def _gen_ms2_feature(meta_feature, cand_form, pre_dbe: float, pre_h2c: float,
     return out_arr
 
 
+def _gen_ms2_feature_arr(meta_feature, cand_table, ppm: bool, ms2_tol: float, gd) -> np.array:
+    """
+    generate MS/MS-related features for all candidate formulas of a metabolic feature, same as _gen_ms2_feature
+    explanation entries of all candidates (CSR arrays of the candidate table) are processed together
+    :param meta_feature: MetaFeature object
+    :param cand_table: CandidateTable object
+    :param ppm: whether to use ppm error
+    :param ms2_tol: m/z tolerance for MS2
+    :param gd: global dependencies
+    :return: 2D numpy array of MS/MS-related features
+    """
+    out = np.zeros((len(cand_table), 24))
+    exp_len = np.diff(cand_table.exp_ptr)
+    # candidates with valid MS2 explanation
+    cand_idx = np.flatnonzero(exp_len > 0)
+    if not meta_feature.ms2_processed or len(cand_idx) == 0:
+        return out
+
+    seg_start = cand_table.exp_ptr[cand_idx]
+    seg_len = exp_len[cand_idx]
+    owner = np.repeat(np.arange(len(cand_table)), exp_len)  # candidate index of each explanation entry
+
+    # explained fragment ion
+    exp_idx_arr = cand_table.exp_idx
+    exp_int_arr = meta_feature.ms2_raw.int_array[exp_idx_arr]
+    exp_mz_arr = meta_feature.ms2_raw.mz_array[exp_idx_arr]
+    frag_arr = cand_table.exp_arr
+    # valid fragment ion after MS2 processing
+    valid_cnt = len(meta_feature.ms2_processed.idx_array)
+    valid_int_sum = np.sum(meta_feature.ms2_raw.int_array[meta_feature.ms2_processed.idx_array])
+
+    def seg_sum(arr, mask=None):
+        # sum of each segment, optionally only masked entries; summation order is the same as np.sum
+        if mask is None:
+            return _segment_sum(arr, seg_start, seg_len)
+        mask_len = np.add.reduceat(mask.astype(np.int64), seg_start)
+        return _segment_sum(arr[mask], np.cumsum(mask_len) - mask_len, mask_len)
+
+    # explained fragment ion count / intensity percentage
+    exp_int_sum = seg_sum(exp_int_arr)
+    exp_frag_cnt_pct = seg_len / valid_cnt
+    exp_frag_int_pct = exp_int_sum / valid_int_sum
+
+    # fragment DBEs before conversion, as Formula.dbe in _gen_ms2_feature
+    frag_dbe_arr = calc_formula_dbe_arr(frag_arr)
+
+    # check db existence of all explained fragments and neutral losses
+    # fragment arrays are converted in place (Na/K, neutral form), as in _gen_ms2_feature
+    pos_mode = meta_feature.adduct.pos_mode
+    frag_db_existed, frag_common = check_formula_existence_batch(frag_arr, pos_mode, True, gd)
+    nl_db_existed, nl_common = check_formula_existence_batch(cand_table.charged_arr[owner] - frag_arr,
+                                                             pos_mode, False, gd)
+
+    # logical OR of fragment/nl
+    fragnl_db_existed = np.logical_or(frag_db_existed, nl_db_existed)
+    fragnl_common = np.logical_or(frag_common, nl_common)
+
+    # explained and db existed / common fragment/nl ion count and intensity percentage
+    bool_feature_ls = []
+    for bool_ls in [(frag_db_existed, nl_db_existed, fragnl_db_existed), (frag_common, nl_common, fragnl_common)]:
+        bool_feature_ls += [np.add.reduceat(b.astype(np.int64), seg_start) / valid_cnt for b in bool_ls]
+        bool_feature_ls += [seg_sum(exp_int_arr, b) / valid_int_sum for b in bool_ls]
+
+    # subformula count: how many frags are subformula of other frags
+    subform_score = np.zeros(len(cand_idx))
+    subform_common_loss_score = np.zeros(len(cand_idx))
+    for m in range(len(cand_idx)):
+        s, e = seg_start[m], seg_start[m] + seg_len[m]
+        subform_score[m], subform_common_loss_score[m] = _calc_subformula_score_arr(frag_arr[s:e],
+                                                                                     cand_table.exp_isotope[s:e], gd)
+
+    # radical ion count percentage (out of all explained fragment ions)
+    radical_cnt_pct = np.add.reduceat((frag_dbe_arr % 1 == 0).astype(np.int64), seg_start) / seg_len
+
+    # normalized explained intensity array
+    normed_exp_int_arr = exp_int_arr / np.repeat(exp_int_sum, seg_len)
+
+    # weighted average of fragment DBEs
+    frag_dbe_wavg = seg_sum(frag_dbe_arr * normed_exp_int_arr)
+
+    # weighted average of fragment H/C ratios, precursor H/C for fragments without carbon
+    pre_charged_arr = cand_table.charged_arr
+    pre_h2c = np.zeros(len(cand_table))
+    c_bool = pre_charged_arr[:, 0] > 0
+    pre_h2c[c_bool] = pre_charged_arr[c_bool, 1] / pre_charged_arr[c_bool, 0]
+    frag_h2c = pre_h2c[owner]
+    c_bool = frag_arr[:, 0] > 0
+    frag_h2c[c_bool] = frag_arr[c_bool, 1] / frag_arr[c_bool, 0]
+    frag_h2c_wavg = seg_sum(frag_h2c * normed_exp_int_arr)
+
+    # weighted average of fragment m/z ppm errors
+    frag_mass_arr = cand_table.exp_mass
+    if ppm:
+        frag_mz_err = (frag_mass_arr - exp_mz_arr) / frag_mass_arr * 1e6
+    else:
+        frag_mz_err = frag_mass_arr - exp_mz_arr
+    frag_mz_err_wavg = seg_sum(_calc_log_p_norm_arr(frag_mz_err, ms2_tol / 3) * normed_exp_int_arr)
+
+    # weighted average of fragment-nl DBE difference
+    pre_dbe = calc_formula_dbe_arr(pre_charged_arr)[owner]
+    frag_nl_dbe_diff_wavg = seg_sum((frag_dbe_arr - (pre_dbe - frag_dbe_arr + 1)) * normed_exp_int_arr)
+
+    out[cand_idx, :] = np.column_stack([exp_frag_cnt_pct, exp_frag_int_pct] + bool_feature_ls +
+                                       [subform_score, subform_common_loss_score,
+                                        radical_cnt_pct, frag_dbe_wavg, frag_h2c_wavg, frag_mz_err_wavg,
+                                        frag_nl_dbe_diff_wavg, np.full(len(cand_idx), valid_cnt),
+                                        np.sqrt(exp_frag_cnt_pct),
+                                        np.sqrt(exp_frag_int_pct.astype(np.float64))])
+    return out
+
+
+@njit
+def _segment_sum(arr: np.array, seg_start: np.array, seg_len: np.array) -> np.array:
+    """
+    sum of each segment of an array, summation order is the same as np.sum (pairwise summation)
+    :param arr: 1D array
+    :param seg_start: start index of each segment
+    :param seg_len: length of each segment
+    :return: 1D array, same dtype as arr
+    """
+    out = np.zeros(len(seg_start), dtype=arr.dtype)
+    for i in range(len(seg_start)):
+        if seg_len[i] > 0:
+            out[i] = _pairwise_sum(arr, seg_start[i], seg_len[i])
+    return out
+
+
+@njit
+def _pairwise_sum(arr: np.array, start: int, n: int):
+    """
+    pairwise summation of arr[start:start + n], as implemented in numpy
+    """
+    if n < 8:
+        res = arr[start] - arr[start]
+        for i in range(start, start + n):
+            res += arr[i]
+        return res
+    elif n <= 128:
+        # 8 partial sums
+        r0, r1, r2, r3 = arr[start], arr[start + 1], arr[start + 2], arr[start + 3]
+        r4, r5, r6, r7 = arr[start + 4], arr[start + 5], arr[start + 6], arr[start + 7]
+        i = 8
+        while i < n - n % 8:
+            r0 += arr[start + i]
+            r1 += arr[start + i + 1]
+            r2 += arr[start + i + 2]
+            r3 += arr[start + i + 3]
+            r4 += arr[start + i + 4]
+            r5 += arr[start + i + 5]
+            r6 += arr[start + i + 6]
+            r7 += arr[start + i + 7]
+            i += 8
+        res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+        while i < n:
+            res += arr[start + i]
+            i += 1
+        return res
+    else:
+        n2 = n // 2
+        n2 -= n2 % 8
+        return _pairwise_sum(arr, start, n2) + _pairwise_sum(arr, start + n2, n - n2)
+
+
 def _calc_subformula_score(frag_form_arr, gd) -> (float, float):
     """
     calculate how many formulas are subformula of other formulas, generate corresponding scores
@@ -347,20 +511,31 @@ def _calc_subformula_score(frag_form_arr, gd) -> (float, float):
     if len(frag_form_arr) <= 1:
         return 0, 0
 
-    exp_frag_cnt = 0  # explained fragment count, except for isotope peaks
-    # loop through all fragment formulas, stack formula arrays that are not isotope peaks
-    all_frag_arr = frag_form_arr[0].array
-    for i in range(1, len(frag_form_arr)):
-        if frag_form_arr[i].isotope > 0:
-            continue
-        all_frag_arr = np.vstack((all_frag_arr, frag_form_arr[i].array))
-        exp_frag_cnt += 1
+    return _calc_subformula_score_arr(np.array([f.array for f in frag_form_arr]),
+                                      np.array([f.isotope for f in frag_form_arr]), gd)
+
+
+def _calc_subformula_score_arr(all_frag_arr: np.array, isotope_arr: np.array, gd) -> (float, float):
+    """
+    calculate how many formulas are subformula of other formulas, generate corresponding scores
+    :param all_frag_arr: 2D array, fragment formula arrays
+    :param isotope_arr: 1D array, isotope of each fragment
+    :return: subformula count, subformula count with common loss
+    """
+    # 0 or 1 frag explanation
+    if len(all_frag_arr) <= 1:
+        return 0, 0
+
+    # fragment formulas that are not isotope peaks (the first one is always kept)
+    keep_bool = isotope_arr <= 0
+    keep_bool[0] = True
+    exp_frag_cnt = np.sum(keep_bool[1:])  # explained fragment count, except for isotope peaks
 
     if exp_frag_cnt <= 1:
         return 0, 0
 
     # subformula check & subformula common loss check
-    subform_cnt, subform_common_loss_cnt = _subformula_check(all_frag_arr, gd['common_loss_db'])
+    subform_cnt, subform_common_loss_cnt = _subformula_check(all_frag_arr[keep_bool], gd['common_loss_index'])
 
     # generate scores, normalized by the number of all possible combinations
     subform_score = 2 * subform_cnt / (exp_frag_cnt * (exp_frag_cnt - 1))
@@ -370,11 +545,11 @@ def _calc_subformula_score(frag_form_arr, gd) -> (float, float):
 
 
 @njit
-def _subformula_check(all_frag_arr: np.array, nl_db: np.array):
+def _subformula_check(all_frag_arr: np.array, nl_index: np.array):
     """
     check if a formula is subformula of another formula
     :param all_frag_arr: array of fragment formulas, array of formula arrays
-    :param nl_db: common loss database
+    :param nl_index: common loss hash index
     :return: subformula count, subformula count with common loss
     """
     subform_cnt = 0
@@ -387,7 +562,7 @@ def _subformula_check(all_frag_arr: np.array, nl_db: np.array):
             if np.all(delta_arr >= 0) and np.sum(delta_arr[1:]) > 0 and (np.sum(delta_arr) - delta_arr[7]) > 0:
                 subform_cnt += 1
                 # check if there is common loss
-                if common_nl_from_array(delta_arr, nl_db):
+                if common_nl_from_index(delta_arr, nl_index):
                     subform_common_loss_cnt += 1
 
     return subform_cnt, subform_common_loss_cnt
@@ -404,6 +579,30 @@ def _calc_log_p_norm(arr: np.array, sigma: float) -> np.array:
     return _calc_log_p_norm_helper(arr_norm_p)
 
 
+def _calc_log_p_norm_arr(arr: np.array, sigma: float) -> np.array:
+    """
+    calculate log(p) for each element in an array, vectorized version of _calc_log_p_norm
+    :param arr: numpy array
+    :param sigma: sigma for normal distribution
+    :return: numpy array
+    """
+    arr_norm_p = norm.cdf(arr, loc=0, scale=sigma)
+    return _calc_log_p_norm_helper_arr(np.asarray(arr_norm_p, dtype=np.float64))
+
+
+@njit
+def _calc_log_p_norm_helper_arr(arr_norm_p: np.array) -> np.array:
+    """
+    calculate log(p) for each element of an array of probabilities
+    :param arr_norm_p: array of probabilities
+    :return: numpy array of log(p)
+    """
+    out = np.empty(len(arr_norm_p))
+    for i in range(len(arr_norm_p)):
+        out[i] = _calc_log_p_norm_helper(arr_norm_p[i])
+    return out
+
+
 @njit
 def _calc_log_p_norm_helper(arr_norm_p) -> np.array:
     """
@@ -515,9 +714,9 @@ def predict_formula_probability(buddy_data, batch_start_idx: int, batch_end_idx:
         # add prediction results to candidate formula objects in the list
         cnt = 0
         for j in group_dict[i]:
-            for candidate_formula in batch_data[j].candidate_formula_list:
-                candidate_formula.estimated_prob = prob_arr[cnt]
-                cnt += 1
+            cand_table = batch_data[j].candidate_table
+            cand_table.estimated_prob[:] = prob_arr[cnt:cnt + len(cand_table)]
+            cnt += len(cand_table)
 
     # update buddy data
     buddy_data[batch_start_idx:batch_end_idx] = batch_data
@@ -536,34 +735,34 @@ def _platt_calibrated_probability(score, a, b):
     return probability
 
 
-def calc_fdr(buddy_data, batch_start_idx: int, batch_end_idx: int):
+def calc_fdr(buddy_data, batch_start_idx: int, batch_end_idx: int, progress_bar: bool = True):
     """
     calculate FDR for candidate formulas
     :param buddy_data: buddy data
     :param batch_start_idx: batch start index
     :param batch_end_idx: batch end index
+    :param progress_bar: whether to show progress bar
     :return: fill in FDR in candidate formula objects
     """
     batch_data = buddy_data[batch_start_idx:batch_end_idx]
 
     # sort candidate formula list for each metabolic feature
-    for meta_feature in tqdm(batch_data, desc="FDR calculation: ", file=sys.stdout, colour="green"):
+    for meta_feature in tqdm(batch_data, desc="FDR calculation: ", file=sys.stdout, colour="green",
+                             disable=not progress_bar):
         if not meta_feature.candidate_formula_list:
             continue
-        # sort candidate formula list by estimated probability, in descending order
-        meta_feature.candidate_formula_list.sort(key=lambda x: x.estimated_prob, reverse=True)
+        # sort candidate formulas by estimated probability, in descending order (stable)
+        cand_table = meta_feature.candidate_table
+        cand_table = cand_table.take(np.argsort(-cand_table.estimated_prob, kind='stable'))
 
         # sum of estimated probabilities
-        prob_sum = np.sum([cand_form.estimated_prob for cand_form in meta_feature.candidate_formula_list])
+        prob_sum = np.sum(cand_table.estimated_prob)
 
         # calculate normed estimated prob and FDR considering all candidate formulas
-        sum_normed_estimated_prob = 0
-        for i, cand_form in enumerate(meta_feature.candidate_formula_list):
-            this_normed_estimated_prob = cand_form.estimated_prob / prob_sum
-            sum_normed_estimated_prob += this_normed_estimated_prob
-
-            cand_form.normed_estimated_prob = this_normed_estimated_prob
-            cand_form.estimated_fdr = 1 - (sum_normed_estimated_prob / (i + 1))
+        cand_table.normed_estimated_prob = cand_table.estimated_prob / prob_sum
+        cand_table.estimated_fdr = 1 - np.cumsum(cand_table.normed_estimated_prob) / \
+            np.arange(1, len(cand_table) + 1)
+        meta_feature.candidate_table = cand_table
 
         # if meta_feature.candidate_formula_list[0].estimated_prob > 0.1:
         #     # calculate normed estimated prob and FDR considering all candidate formulas
@@ -13,48 +13,42 @@ GitHub: Philipbear
 Description: query mass in database
 """
 
-from math import ceil
+from collections import OrderedDict
 from typing import List, Tuple, Union
 
 import numpy as np
 from numba import njit
 
 from msbuddy.base import Adduct, Formula, calc_formula_mass, calc_formula_dbe
+from msbuddy.utils import form_arr_to_key, build_key_index, key_index_contains
 
 # constants
+db_iso_peaks = 4  # number of isotope peaks in the precomputed isotope pattern column of the formula database
+# fragment / neutral loss masses below this are searched via the memo of quantized mass bins
+fragnl_memo_max_mass = 500.
+fragnl_memo_bin_width = 0.01
+fragnl_memo_max_entries = 50000
+# fragment / neutral loss masses well below this are searched via the precomputed low-mass lookup table (fragnl_table)
+fragnl_table_max_mass = 200.
+fragnl_table_bin_width = 0.001
 na_h_delta = 22.989769 - 1.007825
 k_h_delta = 38.963707 - 1.007825
 
 
-def _get_formula_db_idx(start_idx, end_idx, db_mode: int, gd) -> Tuple[int, int]:
+def _get_formula_db_window(target_mass: float, mass_tol: float, db_mode: int, gd) -> Tuple[int, int]:
     """
-    get formula database index
-    :param start_idx: start index of candidate space
-    :param end_idx: end index of candidate space
+    get the formula database slice within the mass tolerance window, by binary search on the sorted mass column
+    :param target_mass: target mass
+    :param mass_tol: mass tolerance
     :param db_mode: database label (0: basic, 1: halogen)
     :param gd: global dependencies dictionary
     :return: database start index, database end index
     """
-    if db_mode == 0:
-        if start_idx >= 15000:
-            db_start_idx = gd['basic_db_idx'][-1]
-        else:
-            db_start_idx = gd['basic_db_idx'][start_idx]
-        if end_idx >= 15000:
-            db_end_idx = len(gd['basic_db_idx']) - 1
-        else:
-            db_end_idx = gd['basic_db_idx'][end_idx]
-    else:
-        if start_idx >= 15000:
-            db_start_idx = gd['halogen_db_idx'][-1]
-        else:
-            db_start_idx = gd['halogen_db_idx'][start_idx]
-        if end_idx >= 15000:
-            db_end_idx = len(gd['halogen_db_idx']) - 1
-        else:
-            db_end_idx = gd['halogen_db_idx'][end_idx]
-
-    return int(db_start_idx), int(db_end_idx)
+    db_mass = gd['basic_db_mass'] if db_mode == 0 else gd['halogen_db_mass']
+    # slightly widened window, exact mass filter is applied on the slice
+    db_start_idx = int(np.searchsorted(db_mass, target_mass - mass_tol - 1e-6, side='left'))
+    db_end_idx = int(np.searchsorted(db_mass, target_mass + mass_tol + 1e-6, side='right'))
+    return db_start_idx, db_end_idx
 
 
 def query_neutral_mass(mass: float, mz_tol: float, ppm: bool, halogen: bool, gd) -> List[Formula]:
@@ -74,19 +68,15 @@ def query_neutral_mass(mass: float, mz_tol: float, ppm: bool, halogen: bool, gd)
     # formulas to return
     formulas = []
 
-    # query database, quick filter by in-memory index array
-    # quick filter by in-memory index array
-    start_idx = int((target_mass - mass_tol) * 10)
-    end_idx = ceil((target_mass + mass_tol) * 10)
-
-    db_start_idx, db_end_idx = _get_formula_db_idx(start_idx, end_idx, 0, gd)
+    # query database, binary search in the sorted mass column
+    db_start_idx, db_end_idx = _get_formula_db_window(target_mass, mass_tol, 0, gd)
     results_basic_mass = gd['basic_db_mass'][db_start_idx:db_end_idx]
     results_basic_formula = gd['basic_db_formula'][db_start_idx:db_end_idx]
     forms_basic = _func_a(results_basic_mass, results_basic_formula, target_mass, mass_tol, None)
     formulas.extend(forms_basic)
 
     if halogen:
-        db_start_idx, db_end_idx = _get_formula_db_idx(start_idx, end_idx, 1, gd)
+        db_start_idx, db_end_idx = _get_formula_db_window(target_mass, mass_tol, 1, gd)
         results_halogen_mass = gd['halogen_db_mass'][db_start_idx:db_end_idx]
         results_halogen_formula = gd['halogen_db_formula'][db_start_idx:db_end_idx]
         forms_halogen = _func_a(results_halogen_mass, results_halogen_formula, target_mass, mass_tol, None)
@@ -121,10 +111,7 @@ def check_formula_existence(form_arr, pos_mode: bool, frag: bool, gd) -> Tuple[b
     # query database, use a tiny mass tolerance (1e-5)
     mass_tol = 1e-4
     db_mode = 0 if not halogen_bool else 1
-    start_idx = int((target_mass - mass_tol) * 10)
-    end_idx = ceil((target_mass + mass_tol) * 10)
-
-    db_start_idx, db_end_idx = _get_formula_db_idx(start_idx, end_idx, db_mode, gd)
+    db_start_idx, db_end_idx = _get_formula_db_window(target_mass, mass_tol, db_mode, gd)
     if db_mode == 0:
         results_mass = gd['basic_db_mass'][db_start_idx:db_end_idx]
         results_formula = gd['basic_db_formula'][db_start_idx:db_end_idx]
@@ -136,15 +123,83 @@ def check_formula_existence(form_arr, pos_mode: bool, frag: bool, gd) -> Tuple[b
     db_existed_bool = len(forms) > 0
 
     if frag and form_arr[0] == 0:
-        common_bool = common_frag_from_array(form_arr, gd['common_frag_db'])
+        common_bool = common_frag_from_index(form_arr, gd['common_frag_index'])
     else:
-        common_bool = common_nl_from_array(form_arr, gd['common_loss_db'])
+        common_bool = common_nl_from_index(form_arr, gd['common_loss_index'])
 
     return db_existed_bool, common_bool
 
 
+def check_formula_existence_batch(form_arr: np.array, pos_mode: bool, frag: bool, gd) -> Tuple[np.array, np.array]:
+    """
+    check whether formulas exist in the database, batch version of check_formula_existence
+    formula arrays are converted in place (Na K into H, neutral form for fragments), as in check_formula_existence
+    :param form_arr: 2D array, each row is a 12-dim formula array
+    :param pos_mode: whether these are frags in positive ion mode
+    :param frag: whether these are fragment ions or neutral losses
+    :param gd: global dependencies dictionary
+    :return: db existed bool array, common frag/nl bool array
+    """
+    halogen_bool_arr = np.sum(form_arr[:, 2:6], axis=1) > 0
+
+    # convert formulas, recalculate target masses
+    target_mass_arr = _convert_existence_arr(form_arr, pos_mode, frag)
+
+    # query database, use a tiny mass tolerance
+    db_existed_arr = np.zeros(len(form_arr), dtype=bool)
+    for db_mode, db_mass in enumerate([gd['basic_db_mass'], gd['halogen_db_mass']]):
+        idx_arr = np.flatnonzero(halogen_bool_arr == bool(db_mode))
+        if len(idx_arr) == 0:
+            continue
+        _, owner_arr = _query_db_window(db_mass, target_mass_arr[idx_arr], np.full(len(idx_arr), 1e-4))
+        db_existed_arr[idx_arr[owner_arr]] = True
+
+    common_arr = _common_existence_arr(form_arr, frag, gd['common_frag_index'], gd['common_loss_index'])
+
+    return db_existed_arr, common_arr
+
+
+@njit
+def _convert_existence_arr(form_arr: np.array, pos_mode: bool, frag: bool) -> np.array:
+    """
+    convert formulas in place for existence check, a helper function for check_formula_existence_batch
+    :param form_arr: 2D array, each row is a 12-dim formula array
+    :param pos_mode: whether these are frags in positive ion mode
+    :param frag: whether these are fragment ions or neutral losses
+    :return: target mass array
+    """
+    target_mass_arr = np.empty(len(form_arr))
+    for i in range(len(form_arr)):
+        # Na, K => H
+        convert_na_k(form_arr[i])
+        # if not a radical fragment, convert to neutral form
+        if frag and calc_formula_dbe(form_arr[i]) % 2 != 0:
+            convert_neutral(form_arr[i], pos_mode)
+        target_mass_arr[i] = calc_formula_mass(form_arr[i], 0, 0)
+    return target_mass_arr
+
+
+@njit
+def _common_existence_arr(form_arr: np.array, frag: bool, frag_index: np.array, nl_index: np.array) -> np.array:
+    """
+    check whether converted formulas are common fragments / neutral losses
+    :param form_arr: 2D array, each row is a converted 12-dim formula array
+    :param frag: whether these are fragment ions or neutral losses
+    :param frag_index: common fragment hash index
+    :param nl_index: common neutral loss hash index
+    :return: bool array
+    """
+    common_arr = np.zeros(len(form_arr), dtype=np.bool_)
+    for i in range(len(form_arr)):
+        if frag and form_arr[i, 0] == 0:
+            common_arr[i] = common_frag_from_index(form_arr[i], frag_index)
+        else:
+            common_arr[i] = common_nl_from_index(form_arr[i], nl_index)
+    return common_arr
+
+
 def query_precursor_mass(mass: float, adduct: Adduct, mz_tol: float,
-                         ppm: bool, db_mode: int, gd) -> Tuple[List[Formula], List[Formula]]:
+                         ppm: bool, db_mode: int, gd, iso: bool = False) -> tuple:
     """
     search precursor mass in neutral database
     :param mass: mass to search
@@ -153,7 +208,9 @@ def query_precursor_mass(mass: float, adduct: Adduct, mz_tol: float,
     :param ppm: whether ppm is used
     :param db_mode: database label (0: basic, 1: halogen)
     :param gd: global dependencies dictionary
-    :return: list of Formula
+    :param iso: whether to also return the precomputed isotope patterns of the neutral formulas
+    :return: list of neutral Formula, list of charged Formula; if iso, also a 2D array of isotope patterns
+    (see db_iso_peaks), None if the database has no isotope pattern column
     """
     # calculate mass tolerance
     mass_tol = mass * mz_tol / 1e6 if ppm else mz_tol
@@ -164,31 +221,27 @@ def query_precursor_mass(mass: float, adduct: Adduct, mz_tol: float,
     # formulas to return
     neutral_formulas = []
     charged_formulas = []
-
-    # query database, quick filter by in-memory index array
-    # quick filter by in-memory index array
-    start_idx = int((target_mass - mass_tol) * 10)
-    end_idx = ceil((target_mass + mass_tol) * 10)
-
-    db_start_idx, db_end_idx = _get_formula_db_idx(start_idx, end_idx, 0, gd)
-    results_basic_mass = gd['basic_db_mass'][db_start_idx:db_end_idx]
-    results_basic_formula = gd['basic_db_formula'][db_start_idx:db_end_idx]
-    forms_basic = _func_a(results_basic_mass, results_basic_formula, target_mass, mass_tol, adduct.loss_formula)
-    neutral_formulas.extend(forms_basic)
-    charged_formulas.extend([Formula(adduct.m * f.array + adduct.net_formula.array,
-                                     charge=adduct.charge) for f in forms_basic])
-
-    if db_mode > 0:
-        db_start_idx, db_end_idx = _get_formula_db_idx(start_idx, end_idx, 1, gd)
-        results_halogen_mass = gd['halogen_db_mass'][db_start_idx:db_end_idx]
-        results_halogen_formula = gd['halogen_db_formula'][db_start_idx:db_end_idx]
-        forms_halogen = _func_a(results_halogen_mass, results_halogen_formula,
-                                target_mass, mass_tol, adduct.loss_formula)
-        neutral_formulas.extend(forms_halogen)
+    iso_arr_list = []
+    iso_available = iso and all(db + '_db_iso' in gd for db in ['basic', 'halogen'][:db_mode + 1])
+
+    # query database, binary search in the sorted mass column
+    for mode, db in enumerate(['basic', 'halogen'][:db_mode + 1]):
+        db_start_idx, db_end_idx = _get_formula_db_window(target_mass, mass_tol, mode, gd)
+        results_mass = gd[db + '_db_mass'][db_start_idx:db_end_idx]
+        results_formula = gd[db + '_db_formula'][db_start_idx:db_end_idx]
+        hit_idx = _func_a_idx(results_mass, results_formula, target_mass, mass_tol, adduct.loss_formula)
+        forms = [Formula(results_formula[idx], charge=0, mass=results_mass[idx]) for idx in hit_idx]
+        neutral_formulas.extend(forms)
         charged_formulas.extend([Formula(adduct.m * f.array + adduct.net_formula.array,
-                                         charge=adduct.charge) for f in forms_halogen])
+                                         charge=adduct.charge) for f in forms])
+        if iso_available:
+            iso_arr_list.append(gd[db + '_db_iso'][db_start_idx:db_end_idx][hit_idx])
 
-    return neutral_formulas, charged_formulas
+    if not iso:
+        return neutral_formulas, charged_formulas
+    if not iso_available:
+        return neutral_formulas, charged_formulas, None
+    return neutral_formulas, charged_formulas, np.concatenate(iso_arr_list).reshape(-1, db_iso_peaks)
 
 
 def query_fragnl_mass(mass: float, fragment: bool, pos_mode: bool, na_contain: bool, k_contain: bool,
@@ -208,43 +261,284 @@ def query_fragnl_mass(mass: float, fragment: bool, pos_mode: bool, na_contain: b
     :param gd: global dependencies dictionary
     :return: list of Formula
     """
+    form_arr, mass_arr, _ = query_fragnl_mass_batch(np.array([mass]), fragment, pos_mode, na_contain, k_contain,
+                                                    mz_tol, ppm, db_mode, gd)
+    charge = (1 if pos_mode else -1) if fragment else 0
+    return [Formula(form_arr[i], charge=charge, mass=mass_arr[i]) for i in range(len(mass_arr))]
+
+
+def query_fragnl_mass_batch(mass_arr: np.array, fragment: bool, pos_mode: bool, na_contain: bool, k_contain: bool,
+                            mz_tol: float, ppm: bool, db_mode: int, gd) -> Tuple[np.array, np.array, np.array]:
+    """
+    search an array of fragment or neutral loss masses in neutral database, vectorized version of query_fragnl_mass
+    by default, both radical and non-radical formulas are searched
+    for fragments, return charged formulas; for neutral losses, return neutral formulas
+    low masses are served from the precomputed lookup table (gd['fragnl_table']) if available,
+    masses below fragnl_memo_max_mass from the memo of this database (gd['fragnl_memo'])
+    :param mass_arr: masses to search
+    :param fragment: whether these are fragments or neutral losses
+    :param pos_mode: whether these are frags in positive ion mode
+    :param na_contain: whether Na is contained in the adduct form
+    :param k_contain: whether K is contained in the adduct form
+    :param mz_tol: mass tolerance
+    :param ppm: whether ppm is used
+    :param db_mode: database label (0: basic, 1: halogen)
+    :param gd: global dependencies dictionary
+    :return: formula array (n, 12), mass array (n,), owner array (n,), i.e. the index of the searched mass each hit
+             belongs to. Hits are grouped by owner, in the same order as query_fragnl_mass returns them
+    """
+    mass_arr = np.asarray(mass_arr)
     # calculate mass tolerance
-    mass_tol = mass * mz_tol / 1e6 if ppm else mz_tol
+    tol_arr = mass_arr * mz_tol / 1e6 if ppm else np.full(len(mass_arr), mz_tol)
 
-    # formulas to return
-    formulas = []
+    # search variants, in order: non-radical and radical ions (even- and odd-electron), then Na and K
+    variants = [(False, False, False), (True, False, False)]
+    if na_contain:
+        variants.extend([(False, True, False), (True, True, False)])
+    if k_contain:
+        variants.extend([(False, False, True), (True, False, True)])
+
+    # route each mass to one search path: lookup table, memo or direct search
+    table = gd.get('fragnl_table')
+    table_bool_arr = _fragnl_table_bool_arr(mass_arr, tol_arr, table)
+    memo_bool_arr = ~table_bool_arr & (mass_arr < fragnl_memo_max_mass)
+    direct_bool_arr = ~table_bool_arr & ~memo_bool_arr
+
+    form_ls, mass_ls, owner_ls = [], [], []
+    for path, path_bool_arr in [('table', table_bool_arr), ('memo', memo_bool_arr), ('direct', direct_bool_arr)]:
+        if not np.any(path_bool_arr):
+            continue
+        idx_arr = np.flatnonzero(path_bool_arr)
+        if path == 'table':
+            forms, masses, owners = _query_fragnl_table(mass_arr[idx_arr], tol_arr[idx_arr], fragment, pos_mode,
+                                                        variants, db_mode, table)
+        elif path == 'memo':
+            forms, masses, owners = _query_fragnl_memo(mass_arr[idx_arr], tol_arr[idx_arr], fragment, pos_mode,
+                                                       na_contain, k_contain, variants, mz_tol, ppm, db_mode, gd)
+        else:
+            forms, masses, _, owners, _ = _query_fragnl_blocks(mass_arr[idx_arr], tol_arr[idx_arr], fragment,
+                                                               pos_mode, variants, db_mode, gd)
+        form_ls.append(forms)
+        mass_ls.append(masses)
+        owner_ls.append(idx_arr[owners])
 
-    # search in database
-    # consider non-radical ions (even-electron)
-    t_mass, start_idx, end_idx = _calc_t_mass_db_idx(mass, fragment, False, 0, pos_mode, mass_tol)
-    formulas.extend(_func_b(t_mass, mass_tol, start_idx, end_idx, fragment, False,
-                            False, False, pos_mode, db_mode, gd))
+    if not form_ls:
+        return np.empty((0, 12), dtype=np.int16), np.empty(0), np.empty(0, dtype=np.int64)
+    # hits of each owner come from one path only
+    form_arr, mass_out_arr, owner_arr = np.concatenate(form_ls), np.concatenate(mass_ls), np.concatenate(owner_ls)
 
-    # consider radical ions (odd-electron)
-    t_mass, start_idx, end_idx = _calc_t_mass_db_idx(mass, fragment, True, 0, pos_mode, mass_tol)
-    formulas.extend(_func_b(t_mass, mass_tol, start_idx, end_idx, fragment, True,
-                            False, False, pos_mode, db_mode, gd))
+    # group hits by owner, stable sort keeps the variant order within each owner
+    order = np.argsort(owner_arr, kind='stable')
+    return form_arr[order], mass_out_arr[order], owner_arr[order]
 
-    # consider Na and K
-    if na_contain:
-        t_mass, start_idx, end_idx = _calc_t_mass_db_idx(mass, fragment, False, na_h_delta, pos_mode, mass_tol)
-        formulas.extend(_func_b(t_mass, mass_tol, start_idx, end_idx, fragment, False,
-                                True, False, pos_mode, db_mode, gd))
 
-        t_mass, start_idx, end_idx = _calc_t_mass_db_idx(mass, fragment, True, na_h_delta, pos_mode, mass_tol)
-        formulas.extend(_func_b(t_mass, mass_tol, start_idx, end_idx, fragment, True,
-                                True, False, pos_mode, db_mode, gd))
+def _query_fragnl_blocks(mass_arr: np.array, tol_arr: np.array, fragment: bool, pos_mode: bool, variants: list,
+                         db_mode: int, gd) -> Tuple[np.array, np.array, np.array, np.array, np.array]:
+    """
+    a helper function for query_fragnl_mass_batch
+    search all variants in all databases, hits are in blocks of (variant, database)
+    :param mass_arr: masses to search
+    :param tol_arr: mass tolerance array
+    :param fragment: whether these are fragments or neutral losses
+    :param pos_mode: whether these are frags in positive ion mode
+    :param variants: list of (radical, Na, K) variants to search
+    :param db_mode: database label (0: basic, 1: halogen)
+    :param gd: global dependencies dictionary
+    :return: formula array, mass array, database mass array, owner array, variant index array
+    """
+    form_ls, mass_ls, db_mass_ls, owner_ls, variant_ls = [], [], [], [], []
+    for v, (radical, na_bool, k_bool) in enumerate(variants):
+        t_mass_arr = _calc_t_mass_arr(mass_arr, fragment, radical, na_bool, k_bool, pos_mode)
+        for mode in ([0, 1] if db_mode > 0 else [0]):
+            db_mass = gd['basic_db_mass'] if mode == 0 else gd['halogen_db_mass']
+            db_formula = gd['basic_db_formula'] if mode == 0 else gd['halogen_db_formula']
+            row_arr, owner_arr = _query_db_window(db_mass, t_mass_arr, tol_arr)
+            forms, masses = _convert_fragnl(db_formula[row_arr], db_mass[row_arr], fragment, radical,
+                                            na_bool, k_bool, pos_mode)
+            form_ls.append(forms)
+            mass_ls.append(masses)
+            db_mass_ls.append(np.asarray(db_mass[row_arr]))
+            owner_ls.append(owner_arr)
+            variant_ls.append(np.full(len(row_arr), v, dtype=np.int8))
+
+    return (np.concatenate(form_ls), np.concatenate(mass_ls), np.concatenate(db_mass_ls),
+            np.concatenate(owner_ls), np.concatenate(variant_ls))
+
+
+def _query_fragnl_memo(mass_arr: np.array, tol_arr: np.array, fragment: bool, pos_mode: bool, na_contain: bool,
+                       k_contain: bool, variants: list, mz_tol: float, ppm: bool, db_mode: int,
+                       gd) -> Tuple[np.array, np.array, np.array]:
+    """
+    a helper function for query_fragnl_mass_batch, search masses via the memo of quantized mass bins
+    each memo entry holds all hits of a mass bin widened by the max mass tolerance in the bin; the exact mass filter
+    is then applied for each searched mass, so that results are the same as a direct search
+    :return: formula array, mass array, owner array; grouped by owner
+    """
+    fragnl_memo = _get_fragnl_memo(gd)
+    bin_arr = np.floor(mass_arr / fragnl_memo_bin_width).astype(np.int64)
+    flag_key = (fragment, pos_mode, na_contain, k_contain, mz_tol, ppm, db_mode)
+
+    # search missing bins at once
+    missing_bin_arr = np.array([b for b in np.unique(bin_arr).tolist()
+                                if fragnl_memo.get((b,) + flag_key) is None], dtype=np.int64)
+    if len(missing_bin_arr) > 0:
+        center_arr = (missing_bin_arr + 0.5) * fragnl_memo_bin_width
+        max_tol_arr = (missing_bin_arr + 1) * fragnl_memo_bin_width * mz_tol / 1e6 if ppm \
+            else np.full(len(missing_bin_arr), mz_tol)
+        # widened by a small margin for rounding errors
+        hit_arrs = _query_fragnl_blocks(center_arr, 0.5 * fragnl_memo_bin_width + max_tol_arr + 1e-6,
+                                        fragment, pos_mode, variants, db_mode, gd)
+        # group by bin, stable sort keeps the block order
+        order = np.argsort(hit_arrs[3], kind='stable')
+        form_arr, mass_out_arr, db_mass_arr, owner_arr, variant_arr = [arr[order] for arr in hit_arrs]
+        start_arr = np.searchsorted(owner_arr, np.arange(len(missing_bin_arr) + 1))
+        for m, b in enumerate(missing_bin_arr.tolist()):
+            s, e = start_arr[m], start_arr[m + 1]
+            fragnl_memo.put((b,) + flag_key, (form_arr[s:e], mass_out_arr[s:e], db_mass_arr[s:e], variant_arr[s:e]))
+
+    # gather memo entries of all searched masses
+    entries = [fragnl_memo.get((b,) + flag_key) for b in bin_arr.tolist()]
+    cnt_arr = np.array([len(entry[1]) for entry in entries], dtype=np.int64)
+    form_arr = np.concatenate([entry[0] for entry in entries])
+    mass_out_arr = np.concatenate([entry[1] for entry in entries])
+    db_mass_arr = np.concatenate([entry[2] for entry in entries])
+    variant_arr = np.concatenate([entry[3] for entry in entries])
+    owner_arr = np.repeat(np.arange(len(mass_arr)), cnt_arr)
+
+    # exact mass filter, as in _query_db_window
+    valid_bool_arr = np.zeros(len(owner_arr), dtype=bool)
+    for v, (radical, na_bool, k_bool) in enumerate(variants):
+        v_idx_arr = np.flatnonzero(variant_arr == v)
+        if len(v_idx_arr) == 0:
+            continue
+        t_mass_arr = _calc_t_mass_arr(mass_arr, fragment, radical, na_bool, k_bool, pos_mode)
+        v_owner_arr = owner_arr[v_idx_arr]
+        valid_bool_arr[v_idx_arr] = np.abs(db_mass_arr[v_idx_arr] - t_mass_arr[v_owner_arr]) <= tol_arr[v_owner_arr]
+
+    return form_arr[valid_bool_arr], mass_out_arr[valid_bool_arr], owner_arr[valid_bool_arr]
+
+
+class FragNLMemo:
+    """
+    LRU memo of fragment / neutral loss database hits, keyed by quantized mass bin and query flags.
+    Entries are evicted by entry count. One memo lives in each global dependencies dictionary (gd['fragnl_memo']),
+    i.e. per database and process, so that it is shared by all spectra in a worker and never mixes databases.
+    """
 
-    if k_contain:
-        t_mass, start_idx, end_idx = _calc_t_mass_db_idx(mass, fragment, False, k_h_delta, pos_mode, mass_tol)
-        formulas.extend(_func_b(t_mass, mass_tol, start_idx, end_idx, fragment, False,
-                                False, True, pos_mode, db_mode, gd))
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
 
-        t_mass, start_idx, end_idx = _calc_t_mass_db_idx(mass, fragment, True, k_h_delta, pos_mode, mass_tol)
-        formulas.extend(_func_b(t_mass, mass_tol, start_idx, end_idx, fragment, True,
-                                False, True, pos_mode, db_mode, gd))
+    def get(self, key) -> Union[tuple, None]:
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
 
-    return formulas
+    def put(self, key, value: tuple):
+        for arr in value:
+            arr.flags.writeable = False
+        self.entries[key] = value
+        # evict least recently used entries
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def _get_fragnl_memo(gd) -> FragNLMemo:
+    """
+    get the memo of fragment / neutral loss database hits of this database, create it if not exists
+    :param gd: global dependencies dictionary
+    :return: FragNLMemo object
+    """
+    fragnl_memo = gd.get('fragnl_memo')
+    if fragnl_memo is None:
+        fragnl_memo = gd['fragnl_memo'] = FragNLMemo(fragnl_memo_max_entries)
+    return fragnl_memo
+
+
+def build_fragnl_table(gd, max_mass: float = fragnl_table_max_mass,
+                       bin_width: float = fragnl_table_bin_width) -> Union[dict, None]:
+    """
+    build the low-mass fragment / neutral loss lookup table
+    database rows below max_mass are indexed by fine mass bins, and converted into fragment ions / neutral losses of
+    all search variants in advance (as _convert_fragnl does), so that low masses are searched without conversion
+    :param gd: global dependencies dictionary, with formula database columns loaded
+    :param max_mass: mass threshold of the table; no table if <= 0
+    :param bin_width: mass bin width
+    :return: lookup table dict, or None
+    """
+    if max_mass <= 0:
+        return None
+
+    n_bins = int(np.ceil(max_mass / bin_width))
+    table = {'max_mass': max_mass, 'bin_width': bin_width, 'n_bins': n_bins,
+             'db_mass': [], 'bin_start': [], 'blocks': dict()}
+    for mode, db_label in enumerate(['basic', 'halogen']):
+        db_mass = gd[db_label + '_db_mass']
+        n_low = int(np.searchsorted(db_mass, max_mass, side='right'))
+        low_mass = np.array(db_mass[:n_low])
+        low_formula = np.array(gd[db_label + '_db_formula'][:n_low])
+        # first row of each bin, the rows of bin b are [bin_start[b], bin_start[b + 1])
+        table['db_mass'].append(low_mass)
+        table['bin_start'].append(np.searchsorted(low_mass, np.arange(n_bins + 1) * bin_width, side='left'))
+        for fragment in [True, False]:
+            for pos_mode in [True, False]:
+                for radical in [False, True]:
+                    for na_bool, k_bool in [(False, False), (True, False), (False, True)]:
+                        forms, masses = _convert_fragnl(low_formula, low_mass, fragment, radical,
+                                                        na_bool, k_bool, pos_mode)
+                        forms.flags.writeable = False
+                        masses.flags.writeable = False
+                        table['blocks'][(fragment, pos_mode, radical, na_bool, k_bool, mode)] = (forms, masses)
+    return table
+
+
+def _fragnl_table_bool_arr(mass_arr: np.array, tol_arr: np.array, table: Union[dict, None]) -> np.array:
+    """
+    whether each mass can be searched via the low-mass lookup table
+    target masses of all variants are at most ~1.01 Da above the searched mass, a margin of 2 Da is used
+    :param mass_arr: masses to search
+    :param tol_arr: mass tolerance array
+    :param table: lookup table dict, or None
+    :return: bool array
+    """
+    if table is None:
+        return np.zeros(len(mass_arr), dtype=bool)
+    return mass_arr + tol_arr + 2. < table['max_mass']
+
+
+def _query_fragnl_table(mass_arr: np.array, tol_arr: np.array, fragment: bool, pos_mode: bool, variants: list,
+                        db_mode: int, table: dict) -> Tuple[np.array, np.array, np.array]:
+    """
+    a helper function for query_fragnl_mass_batch, search low masses via the lookup table
+    the candidate rows of each target mass are read from the bin index, then the exact mass filter is applied,
+    so that results are the same as a direct search
+    :return: formula array, mass array, owner array; in blocks of (variant, database)
+    """
+    bin_width = table['bin_width']
+    n_bins = table['n_bins']
+    form_ls, mass_ls, owner_ls = [], [], []
+    for radical, na_bool, k_bool in variants:
+        t_mass_arr = _calc_t_mass_arr(mass_arr, fragment, radical, na_bool, k_bool, pos_mode)
+        # slightly widened window (in float64, inputs may be float32), as in _query_db_window
+        lower_bin_arr = np.floor((np.float64(t_mass_arr) - tol_arr - 1e-6) / bin_width).astype(np.int64)
+        upper_bin_arr = np.floor((np.float64(t_mass_arr) + tol_arr + 1e-6) / bin_width).astype(np.int64) + 1
+        lower_bin_arr = np.clip(lower_bin_arr, 0, n_bins)
+        upper_bin_arr = np.clip(upper_bin_arr, 0, n_bins)
+        for mode in ([0, 1] if db_mode > 0 else [0]):
+            db_mass = table['db_mass'][mode]
+            bin_start = table['bin_start'][mode]
+            row_arr, owner_arr = _filter_db_window(db_mass, bin_start[lower_bin_arr], bin_start[upper_bin_arr],
+                                                   t_mass_arr, tol_arr)
+            forms, masses = table['blocks'][(fragment, pos_mode, radical, na_bool, k_bool, mode)]
+            form_ls.append(forms[row_arr])
+            mass_ls.append(masses[row_arr])
+            owner_ls.append(owner_arr)
+
+    return np.concatenate(form_ls), np.concatenate(mass_ls), np.concatenate(owner_ls)
 
 
 def check_common_frag(formula: Formula, gd) -> bool:
@@ -261,7 +555,7 @@ def check_common_frag(formula: Formula, gd) -> bool:
 
     # Na, K => H
     form_arr = convert_na_k(form_arr)
-    return common_frag_from_array(form_arr, gd['common_frag_db'])
+    return common_frag_from_index(form_arr, gd['common_frag_index'])
 
 
 def check_common_nl(formula: Formula, gd) -> bool:
@@ -275,215 +569,151 @@ def check_common_nl(formula: Formula, gd) -> bool:
 
     # Na, K => H
     form_arr = convert_na_k(form_arr)
-    return common_nl_from_array(form_arr, gd['common_loss_db'])
+    return common_nl_from_index(form_arr, gd['common_loss_index'])
 
 
-def _calc_t_mass_db_idx(mass: float, fragment: bool, radical: bool, convert_mass: float, pos_mode: bool,
-                        mass_tol: float) -> Tuple[float, int, int]:
+def _calc_t_mass_arr(mass_arr: np.array, fragment: bool, radical: bool, na_contain: bool, k_contain: bool,
+                     pos_mode: bool) -> np.array:
     """
-    calculate target mass and calculate database index
-    :param mass: mass to search
-    :param fragment: whether this is a fragment ion or neutral loss
-    :param radical: whether this is a radical ion
-    :param convert_mass: mass to convert
-    :param pos_mode: whether this is a frag in positive ion mode
-    :param mass_tol: mass tolerance
-    :return: target mass, database indices
+    calculate target masses of neutral database formulas
+    :param mass_arr: masses to search
+    :param fragment: whether these are fragment ions or neutral losses
+    :param radical: whether these are radical ions
+    :param na_contain: whether one H is converted into Na
+    :param k_contain: whether one H is converted into K
+    :param pos_mode: whether these are frags in positive ion mode
+    :return: target mass array
     """
+    convert_mass = na_h_delta if na_contain else (k_h_delta if k_contain else 0)
     if fragment:
         if not radical:
-            t_mass = mass - convert_mass - 1.007276 if pos_mode else mass - convert_mass + 1.007276
+            t_mass = mass_arr - convert_mass - 1.007276 if pos_mode else mass_arr - convert_mass + 1.007276
         else:
-            t_mass = mass - convert_mass + 0.00054858 if pos_mode else mass - convert_mass - 0.00054858
+            t_mass = mass_arr - convert_mass + 0.00054858 if pos_mode else mass_arr - convert_mass - 0.00054858
     else:
         if not radical:
-            t_mass = mass - convert_mass
+            t_mass = mass_arr - convert_mass
         else:
-            t_mass = mass - convert_mass - 1.007825 if pos_mode else mass - convert_mass + 1.007825
+            t_mass = mass_arr - convert_mass - 1.007825 if pos_mode else mass_arr - convert_mass + 1.007825
+    return t_mass
 
-    start_idx = int((t_mass - mass_tol) * 10)
-    end_idx = ceil((t_mass + mass_tol) * 10)
-    return t_mass, start_idx, end_idx
 
+def _query_db_window(db_mass: np.array, t_mass_arr: np.array, tol_arr: np.array) -> Tuple[np.array, np.array]:
+    """
+    search multiple target masses in a sorted database mass array, binary search instead of scanning the buckets
+    :param db_mass: sorted database mass array
+    :param t_mass_arr: target mass array
+    :param tol_arr: mass tolerance array
+    :return: database row indices of all hits, owner indices (index of the target mass each hit belongs to)
+    """
+    # slightly widened window (in float64, inputs may be float32), exact mass filter below
+    lower_arr = np.float64(t_mass_arr) - tol_arr - 1e-6
+    upper_arr = np.float64(t_mass_arr) + tol_arr + 1e-6
+    start_arr = np.searchsorted(db_mass, lower_arr, side='left')
+    end_arr = np.searchsorted(db_mass, upper_arr, side='right')
+    return _filter_db_window(db_mass, start_arr, end_arr, t_mass_arr, tol_arr)
 
-def _func_a(results_mass, results_formula, target_mass: float, mass_tol: float,
-            adduct_loss_form: Union[Formula, None]) -> List[Formula]:
+
+def _filter_db_window(db_mass: np.array, start_arr: np.array, end_arr: np.array, t_mass_arr: np.array,
+                      tol_arr: np.array) -> Tuple[np.array, np.array]:
+    """
+    expand database row ranges of multiple target masses, and apply the exact mass filter
+    :param db_mass: sorted database mass array
+    :param start_arr: start row of each target mass
+    :param end_arr: end row (exclusive) of each target mass
+    :param t_mass_arr: target mass array
+    :param tol_arr: mass tolerance array
+    :return: database row indices of all hits, owner indices (index of the target mass each hit belongs to)
+    """
+    cnt_arr = end_arr - start_arr
+
+    # expand [start, end) ranges into flat row indices
+    owner_arr = np.repeat(np.arange(len(t_mass_arr)), cnt_arr)
+    row_arr = np.arange(owner_arr.size) + np.repeat(start_arr - np.cumsum(cnt_arr) + cnt_arr, cnt_arr)
+
+    # filter by mass
+    valid_bool_arr = np.abs(db_mass[row_arr] - t_mass_arr[owner_arr]) <= tol_arr[owner_arr]
+    return row_arr[valid_bool_arr], owner_arr[valid_bool_arr]
+
+
+def _func_a_idx(results_mass, results_formula, target_mass: float, mass_tol: float,
+                adduct_loss_form: Union[Formula, None]) -> np.array:
     """
     a helper function for query_precursor_mass
-    filter and convert the sql query results to Formula objects
+    filter the database query results by mass and adduct loss
     :param results_mass: mass array
     :param results_formula: formula array
     :param target_mass: target mass
     :param mass_tol: mass tolerance
     :param adduct_loss_form: adduct loss formula
-    :return: list of Formula
+    :return: indices of the retained results
     """
-    # filter by mass
     all_idx = np.where(np.abs(results_mass - target_mass) <= mass_tol)[0]
+    if adduct_loss_form is not None and len(all_idx) > 0:
+        all_idx = all_idx[np.all(results_formula[all_idx] >= adduct_loss_form.array, axis=1)]
+    return all_idx
 
-    if len(all_idx) == 0:
-        return []
-
-    # convert to Formula in neutral form
-    formulas = []
-    # if adduct has loss formula
-    if adduct_loss_form is not None:
-        l_arr = adduct_loss_form.array
-        for idx in all_idx:
-            if np.all(results_formula[idx] >= l_arr):
-                formulas.append(Formula(results_formula[idx], charge=0, mass=results_mass[idx]))
-    # if adduct has no loss formula
-    else:
-        for idx in all_idx:
-            formulas.append(Formula(results_formula[idx], charge=0, mass=results_mass[idx]))
-    return formulas
 
-
-def _func_b(target_mass, mass_tol, start_idx, end_idx, fragment: bool, radical: bool,
-            na_contain: bool, k_contain: bool, pos_mode: bool, db_mode: int, gd) -> List[Formula]:
+def _func_a(results_mass, results_formula, target_mass: float, mass_tol: float,
+            adduct_loss_form: Union[Formula, None]) -> List[Formula]:
     """
-    a helper function for "query_fragnl_mass"
-    first query the database, then convert the results to Formula objects
+    a helper function for query_precursor_mass
+    filter and convert the sql query results to Formula objects
+    :param results_mass: mass array
+    :param results_formula: formula array
     :param target_mass: target mass
     :param mass_tol: mass tolerance
-    :param start_idx: database start index
-    :param end_idx: database end index
-    :param fragment: whether this is a fragment ion or neutral loss
-    :param radical: whether this is a radical ion
-    :param na_contain: whether Na is contained in the adduct form
-    :param k_contain: whether K is contained in the adduct form
-    :param pos_mode: whether this is a frag in positive ion mode
-    :param db_mode: database label (0: basic, 1: halogen, 2: all)
-    :param gd: global dependencies dictionary
+    :param adduct_loss_form: adduct loss formula
     :return: list of Formula
     """
-
-    forms = []
-    forms_basic = _func_c(target_mass, mass_tol, start_idx, end_idx, fragment, radical, na_contain,
-                          k_contain, pos_mode, 0, gd)
-    forms.extend(forms_basic)
-    if db_mode > 0:
-        forms_halogen = _func_c(target_mass, mass_tol, start_idx, end_idx, fragment, radical, na_contain,
-                                k_contain, pos_mode, 1, gd)
-        forms.extend(forms_halogen)
-    return forms
+    # convert to Formula in neutral form
+    return [Formula(results_formula[idx], charge=0, mass=results_mass[idx])
+            for idx in _func_a_idx(results_mass, results_formula, target_mass, mass_tol, adduct_loss_form)]
 
 
-def _func_c(target_mass, mass_tol, start_idx, end_idx, fragment: bool, radical: bool,
-            na_contain: bool, k_contain: bool, pos_mode: bool, db_mode: int, gd) -> List[Formula]:
+def _convert_fragnl(results_formula, results_mass, fragment: bool, radical: bool,
+                    na_contain: bool, k_contain: bool, pos_mode: bool) -> Tuple[np.array, np.array]:
     """
-    a helper function for _func_b
-    query the database
-    :param target_mass: target mass
-    :param mass_tol: mass tolerance
-    :param start_idx: database start index
-    :param end_idx: database end index
-    :param fragment: whether this is a fragment ion or neutral loss
-    :param radical: whether this is a radical ion
-    :param na_contain: whether Na is contained in the adduct form
-    :param k_contain: whether K is contained in the adduct form
-    :param pos_mode: whether this is a frag in positive ion mode
-    :param db_mode: database label (0: basic, 1: halogen)
-    :param gd: global dependencies dictionary
-    :return: list of Formula
+    a helper function for query_fragnl_mass_batch
+    convert neutral database formulas into fragment ions (charged) or neutral losses
+    :param results_formula: formula array of database hits
+    :param results_mass: mass array of database hits
+    :param fragment: whether these are fragment ions or neutral losses
+    :param radical: whether these are radical ions
+    :param na_contain: whether one H is converted into Na
+    :param k_contain: whether one H is converted into K
+    :param pos_mode: whether these are frags in positive ion mode
+    :return: formula array, mass array
     """
-    db_start_idx, db_end_idx = _get_formula_db_idx(start_idx, end_idx, db_mode, gd)
-    if db_mode == 0:
-        results_mass = gd['basic_db_mass'][db_start_idx:db_end_idx]
-        results_formula = gd['basic_db_formula'][db_start_idx:db_end_idx]
-    else:
-        results_mass = gd['halogen_db_mass'][db_start_idx:db_end_idx]
-        results_formula = gd['halogen_db_formula'][db_start_idx:db_end_idx]
-
-    all_idx = np.where(np.abs(results_mass - target_mass) <= mass_tol)[0]
-
-    forms = []
-    if len(all_idx) == 0:
-        return forms
-
     ion_mode_int = 1 if pos_mode else -1
+    arr = np.array(results_formula, dtype=np.int16)
+
+    convert_mass = 0.
+    if na_contain:
+        arr[:, 8] += 1
+        arr[:, 1] -= 1
+        convert_mass = na_h_delta
+    elif k_contain:
+        arr[:, 6] += 1
+        arr[:, 1] -= 1
+        convert_mass = k_h_delta
 
     if fragment:
-        if na_contain:
-            if radical:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[8] += 1
-                    arr[1] -= 1
-                    forms.append(Formula(arr, charge=ion_mode_int,
-                                         mass=results_mass[idx] - ion_mode_int * 0.00054858 + na_h_delta))
-            else:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[8] += 1
-                    arr[1] = arr[1] - 1 + ion_mode_int
-                    forms.append(Formula(arr, charge=ion_mode_int,
-                                         mass=results_mass[idx] + ion_mode_int * 1.007276 + na_h_delta))
-        elif k_contain:
-            if radical:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[6] += 1
-                    arr[1] -= 1
-                    forms.append(Formula(arr, charge=ion_mode_int,
-                                         mass=results_mass[idx] - ion_mode_int * 0.00054858 + k_h_delta))
-            else:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[6] += 1
-                    arr[1] = arr[1] - 1 + ion_mode_int
-                    forms.append(Formula(arr, charge=ion_mode_int,
-                                         mass=results_mass[idx] + ion_mode_int * 1.007276 + k_h_delta))
+        if radical:
+            mass = results_mass - ion_mode_int * 0.00054858
         else:
-            if radical:
-                for idx in all_idx:
-                    forms.append(Formula(results_formula[idx], charge=ion_mode_int,
-                                         mass=results_mass[idx] - ion_mode_int * 0.00054858))
-            else:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[1] += ion_mode_int
-                    forms.append(Formula(arr, charge=ion_mode_int, mass=results_mass[idx] + ion_mode_int * 1.007276))
+            arr[:, 1] += ion_mode_int
+            mass = results_mass + ion_mode_int * 1.007276
     else:  # neutral loss
-        if na_contain:
-            if radical:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[8] += 1
-                    arr[1] = arr[1] - 1 + ion_mode_int
-                    forms.append(Formula(arr, charge=0,
-                                         mass=results_mass[idx] + ion_mode_int * 1.007825 + na_h_delta))
-            else:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[8] += 1
-                    arr[1] -= 1
-                    forms.append(Formula(arr, charge=0, mass=results_mass[idx] + na_h_delta))
-        elif k_contain:
-            if radical:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[6] += 1
-                    arr[1] = arr[1] - 1 + ion_mode_int
-                    forms.append(Formula(arr, charge=0,
-                                         mass=results_mass[idx] + ion_mode_int * 1.007825 + k_h_delta))
-            else:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[6] += 1
-                    arr[1] -= 1
-                    forms.append(Formula(arr, charge=0, mass=results_mass[idx] + k_h_delta))
+        if radical:
+            arr[:, 1] += ion_mode_int
+            mass = results_mass + ion_mode_int * 1.007825
         else:
-            if radical:
-                for idx in all_idx:
-                    arr = results_formula[idx].copy()
-                    arr[1] += ion_mode_int
-                    forms.append(Formula(arr, charge=0, mass=results_mass[idx] + ion_mode_int * 1.007825))
-            else:
-                for idx in all_idx:
-                    forms.append(Formula(results_formula[idx], charge=0, mass=results_mass[idx]))
+            mass = results_mass
+    if convert_mass:
+        mass = mass + convert_mass
 
-    return forms
+    return arr, mass
 
 
 @njit
@@ -552,3 +782,78 @@ def common_nl_from_array(form_arr: np.array, nl_db: np.array) -> bool:
         elif nl[0] > form_arr[0]:
             break
     return False
+
+
+def build_common_frag_index(frag_db: np.array) -> np.array:
+    """
+    build a hash index of the common fragment database, with +/- 1 H neighbor keys
+    the index gives the same result as common_frag_from_array (C is not compared, rows after the early break are
+    not reachable)
+    :param frag_db: common fragment database
+    :return: hash table, see utils.build_key_index
+    """
+    keys = []
+    h_max = None  # max H of previous rows
+    for frag in frag_db:
+        for h_diff in (-1, 0, 1):
+            h = int(frag[1]) + h_diff
+            if h_max is None or h >= h_max - 1:
+                keys.append(_common_frag_key(frag, h))
+        h_max = int(frag[1]) if h_max is None else max(h_max, int(frag[1]))
+    return _build_common_index(keys)
+
+
+def build_common_nl_index(nl_db: np.array) -> np.array:
+    """
+    build a hash index of the common neutral loss database
+    the index gives the same result as common_nl_from_array (rows after the early break are not reachable)
+    :param nl_db: common neutral loss database
+    :return: hash table, see utils.build_key_index
+    """
+    keys = []
+    c_max = None  # max C of previous rows
+    for nl in nl_db:
+        if c_max is None or nl[0] >= c_max:
+            keys.append(form_arr_to_key(np.int64(nl)))
+        c_max = int(nl[0]) if c_max is None else max(c_max, int(nl[0]))
+    return _build_common_index(keys)
+
+
+def _build_common_index(keys: List[int]) -> np.array:
+    keys = np.array(keys, dtype=np.int64)
+    if np.any(keys < 0):
+        raise ValueError("Common fragment / neutral loss database contains formulas that cannot be encoded.")
+    return build_key_index(keys)
+
+
+@njit
+def _common_frag_key(form_arr: np.array, h: int) -> int:
+    """
+    packed key for the common fragment index: C set to 0, H shifted by 1 (H = -1 is allowed)
+    """
+    arr = form_arr.astype(np.int64)
+    arr[0] = 0
+    arr[1] = h + 1
+    return form_arr_to_key(arr)
+
+
+@njit
+def common_frag_from_index(form_arr: np.array, frag_index: np.array) -> bool:
+    """
+    check whether a formula is a common fragment, O(1) hash lookup, numba accelerated
+    :param form_arr: 12-dim array, Na K converted
+    :param frag_index: hash index built by build_common_frag_index
+    :return: True if it is a common fragment, False otherwise
+    """
+    return key_index_contains(frag_index, _common_frag_key(form_arr, form_arr[1]))
+
+
+@njit
+def common_nl_from_index(form_arr: np.array, nl_index: np.array) -> bool:
+    """
+    check whether a formula is a common neutral loss, O(1) hash lookup, numba accelerated
+    :param form_arr: 12-dim array, Na K converted
+    :param nl_index: hash index built by build_common_nl_index
+    :return: True if it is a common neutral loss, False otherwise
+    """
+    return key_index_contains(nl_index, form_arr_to_key(form_arr))
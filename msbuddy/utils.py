@@ -128,6 +128,162 @@ def enumerate_subformula(pre_charged_arr: np.array) -> np.array:
     return subform_arr
 
 
+@njit
+def enumerate_subformula_bounded(pre_charged_arr: np.array, lower_arr: np.array, upper_arr: np.array,
+                                 adduct_charge: int) -> np.array:
+    """
+    Enumerate subformulas of a candidate formula whose mass falls in any of the given mass windows. (Numba version)
+    branch-and-bound: elements are fixed from the last to the first, a branch is pruned if the mass range reachable by
+    the remaining elements does not overlap any window; rows are in the same order as enumerate_subformula
+    :param pre_charged_arr: precursor charged array
+    :param lower_arr: lower bounds of mass windows, sorted, non-overlapping
+    :param upper_arr: upper bounds of mass windows, sorted, non-overlapping
+    :param adduct_charge: adduct charge, for electron mass
+    :return: 2D array, each row is a subformula array
+    """
+    n = len(pre_charged_arr)
+    ele_mass_arr = np.array([12.000000, 1.007825, 78.918336, 34.968853, 18.998403, 126.904473, 38.963707, 14.003074,
+                             22.989769, 15.994915, 30.973762, 31.972071])
+    e_mass = adduct_charge * 0.0005486
+
+    # max mass reachable by elements [0, i)
+    rem_mass_arr = np.zeros(n + 1)
+    for i in range(n):
+        rem_mass_arr[i + 1] = rem_mass_arr[i] + pre_charged_arr[i] * ele_mass_arr[i]
+
+    out_arr = np.zeros((64, n), dtype=np.int16)
+    cnt = 0
+    if len(lower_arr) == 0:
+        return out_arr[:0]
+
+    cur_arr = np.zeros(n, dtype=np.int16)
+    # mass of fixed elements [i, n)
+    partial_mass_arr = np.zeros(n + 1)
+    i = n - 1
+    cur_arr[i] = -1
+    while i < n:
+        cur_arr[i] += 1
+        if cur_arr[i] > pre_charged_arr[i]:
+            i += 1
+            continue
+        partial_mass_arr[i] = partial_mass_arr[i + 1] + cur_arr[i] * ele_mass_arr[i]
+        low_mass = partial_mass_arr[i] - e_mass
+        # larger counts of this element only increase the mass
+        if low_mass > upper_arr[-1]:
+            i += 1
+            continue
+        # first window ending above the lowest reachable mass
+        k = np.searchsorted(upper_arr, low_mass)
+        if k == len(upper_arr) or lower_arr[k] > low_mass + rem_mass_arr[i]:
+            continue
+        if i > 0:
+            i -= 1
+            cur_arr[i] = -1
+            continue
+        # leaf, the full subformula is fixed and within a window
+        if cnt == out_arr.shape[0]:
+            new_out_arr = np.zeros((2 * cnt, n), dtype=np.int16)
+            new_out_arr[:cnt] = out_arr
+            out_arr = new_out_arr
+        out_arr[cnt] = cur_arr
+        cnt += 1
+
+    return out_arr[:cnt]
+
+
+# packed integer key of formula arrays, bit width of each element (63 bits in total)
+form_key_bits = np.array([8, 9, 4, 5, 5, 4, 3, 6, 3, 7, 4, 5], dtype=np.int64)
+form_key_shifts = np.concatenate((np.zeros(1, dtype=np.int64), np.cumsum(form_key_bits)[:-1]))
+form_key_max = (np.int64(1) << form_key_bits) - 1
+
+
+@njit
+def form_arr_to_key(form_arr: np.array) -> int:
+    """
+    Encode a formula array into a packed integer key. (Numba version)
+    :param form_arr: 12-dim formula array
+    :return: packed key; -1 if any element count is negative or exceeds its bit width
+    """
+    key = 0
+    for i in range(len(form_key_bits)):
+        cnt = int(form_arr[i])
+        if cnt < 0 or cnt > form_key_max[i]:
+            return -1
+        key |= cnt << form_key_shifts[i]
+    return key
+
+
+def form_arr_to_key_arr(form_arr: np.array) -> np.array:
+    """
+    Encode formula arrays into packed integer keys. (vectorized version of form_arr_to_key)
+    :param form_arr: 2D array, each row is a 12-dim formula array
+    :return: 1D int64 array of packed keys; -1 for rows with negative or too large element counts
+    """
+    form_arr = np.asarray(form_arr, dtype=np.int64).reshape(-1, 12)
+    valid_bool_arr = np.all((form_arr >= 0) & (form_arr <= form_key_max), axis=1)
+    key_arr = np.sum(np.where(valid_bool_arr[:, None], form_arr, 0) << form_key_shifts, axis=1)
+    key_arr[~valid_bool_arr] = -1
+    return key_arr
+
+
+def key_arr_to_form_arr(key_arr: np.array) -> np.array:
+    """
+    Decode packed integer keys into formula arrays.
+    :param key_arr: 1D array of packed keys (non-negative)
+    :return: 2D int16 array, each row is a 12-dim formula array
+    """
+    key_arr = np.asarray(key_arr, dtype=np.int64).reshape(-1)
+    return ((key_arr[:, None] >> form_key_shifts) & form_key_max).astype(np.int16)
+
+
+@njit
+def _key_hash_slot(key: int, mask: int) -> int:
+    """
+    Hash slot of a packed key in a hash table of size mask + 1. (Numba version)
+    """
+    h = key * 6364136223846793005
+    return (h ^ (h >> 29)) & mask
+
+
+@njit
+def build_key_index(keys: np.array) -> np.array:
+    """
+    Build an open-addressing hash table of packed formula keys, for O(1) membership tests in numba functions.
+    :param keys: 1D int64 array of non-negative packed keys
+    :return: 1D int64 array, hash table (size power of 2, load factor <= 0.5), empty slots are -1
+    """
+    size = 8
+    while size < 2 * len(keys):
+        size *= 2
+    table = np.full(size, -1, dtype=np.int64)
+    mask = size - 1
+    for key in keys:
+        i = _key_hash_slot(key, mask)
+        while table[i] != -1 and table[i] != key:
+            i = (i + 1) & mask
+        table[i] = key
+    return table
+
+
+@njit
+def key_index_contains(table: np.array, key: int) -> bool:
+    """
+    Check whether a packed key is in a hash table built by build_key_index.
+    :param table: hash table
+    :param key: packed key, -1 (not encodable) is never contained
+    :return: True if contained
+    """
+    if key < 0:
+        return False
+    mask = len(table) - 1
+    i = _key_hash_slot(key, mask)
+    while table[i] != -1:
+        if table[i] == key:
+            return True
+        i = (i + 1) & mask
+    return False
+
+
 # for numba
 alphabet_np = np.array(
     [ord(char) for word in ["C", "H", "Br", "Cl", "F", "I", "K", "N", "Na", "O", "P", "S"] for char in word],
@@ -176,6 +332,43 @@ def form_arr_to_str(form_arr) -> str:
     return _ascii_to_str(_form_arr_to_str(form_arr))
 
 
+# per-element token tables for batch conversion, token_table[i][c] is the string of element i with count c
+_form_token_table = [np.array([''], dtype=str) for _ in alphabet]
+
+
+def _get_form_tokens(i: int, max_cnt: int) -> np.array:
+    """
+    Inner func: get the (cached) token table of an element, covering counts 0 to max_cnt
+    :param i: element index
+    :param max_cnt: max element count needed
+    :return: 1D str array
+    """
+    tokens = _form_token_table[i]
+    if len(tokens) <= max_cnt:
+        symbol = alphabet[i]
+        tokens = np.array([''] + [symbol] + [symbol + str(c) for c in range(2, max(max_cnt + 1, 2 * len(tokens)))])
+        _form_token_table[i] = tokens
+    return tokens
+
+
+def form_arr_to_str_batch(form_arr: np.array) -> np.array:
+    """
+    Convert formula arrays to strings in one call. (vectorized version of form_arr_to_str)
+    :param form_arr: 2D array, each row is a 12-dim formula array
+    :return: 1D str array
+    """
+    form_arr = np.asarray(form_arr, dtype=np.int64).reshape(-1, 12)
+    # negative counts are written as the element symbol only, as in form_arr_to_str
+    form_arr = np.where(form_arr < 0, 1, form_arr)
+    out = np.full(len(form_arr), '', dtype=str)
+    for i in range(len(alphabet)):
+        col = form_arr[:, i]
+        if len(col) == 0 or not np.any(col):
+            continue
+        out = np.char.add(out, _get_form_tokens(i, int(np.max(col)))[col])
+    return out
+
+
 def _read_formula_str(x: str) -> dict:
     """
     Read formula string and return a dictionary
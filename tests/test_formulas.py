@@ -2,15 +2,19 @@
 # ver 0.3.0
 
 def test_main():
+    from pathlib import Path
     from msbuddy import Msbuddy, MsbuddyConfig
+    mgf_path = Path(__file__).parent.parent / 'demo' / 'input_file.mgf'
+
     # instantiate a MsbuddyConfig object
     msb_config = MsbuddyConfig(ms_instr='orbitrap', halogen=False)
 
     # instantiate a Msbuddy object
     msb_engine = Msbuddy(msb_config)
 
-    # you can load multiple USIs at once
-    msb_engine.load_mgf('/Users/shipei/Documents/projects/msbuddy/demo/input_file.mgf')
+    # load the demo mgf file
+    msb_engine.load_mgf(mgf_path)
+    identifiers = [mf.identifier for mf in msb_engine.data]
 
     # annotate molecular formula
     msb_engine.annotate_formula()
@@ -19,6 +23,14 @@ def test_main():
     result = msb_engine.get_summary()
 
     print(result)
+    assert [r['identifier'] for r in result] == identifiers
+    assert any(r['formula_rank_1'] is not None for r in result)
+
+    # the parallel pipeline gives the same results
+    with Msbuddy(MsbuddyConfig(ms_instr='orbitrap', halogen=False, parallel=True, n_cpu=2)) as msb_engine:
+        msb_engine.load_mgf(mgf_path)
+        msb_engine.annotate_formula()
+        assert msb_engine.get_summary() == result
 
 
 # test other msbuddy APIs
@@ -38,6 +50,22 @@ def test_formula():
     all_subform_arr = enumerate_subform_arr([10, 20, 0, 0, 0, 0, 0, 0, 0, 5, 0, 0])
     print(all_subform_arr)
 
+    import numpy as np
+    from msbuddy.utils import form_arr_to_key, form_arr_to_key_arr, key_arr_to_form_arr
+
+    key_set = set(form_arr_to_key(arr) for arr in all_subform_arr)
+    assert len(key_set) == len(all_subform_arr)
+    assert form_arr_to_key(np.array([0, 1000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])) == -1
+
+    key_arr = form_arr_to_key_arr(all_subform_arr)
+    assert key_arr.tolist() == [form_arr_to_key(arr) for arr in all_subform_arr]
+    assert np.array_equal(key_arr_to_form_arr(key_arr), all_subform_arr)
+
+    from msbuddy.utils import form_arr_to_str_batch
+
+    form_arr = np.vstack([all_subform_arr, [[0, 120, 1, 0, 2, 0, 0, 0, 1, 13, 0, 0]]])
+    assert form_arr_to_str_batch(form_arr).tolist() == [form_arr_to_str(arr) for arr in form_arr]
+
 
 def test_mass_formula():
     from msbuddy import Msbuddy
@@ -69,6 +97,321 @@ def test_subformula():
     print(len(subformla_list))
 
 
+def test_formula_db_npy(monkeypatch):
+    import tempfile
+    from pathlib import Path
+    import numpy as np
+    import pickle
+    from msbuddy.load import _convert_formula_db_to_npy, _formula_db_npy_exists, formula_db_keys, SharedDBHandle
+
+    mass = np.array([18.010565, 44.009829])
+    formula = np.array([[0, 2, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0], [1, 0, 0, 0, 0, 0, 0, 0, 0, 2, 0, 0]])
+    idx = np.array([0, 0, 1])
+    with tempfile.TemporaryDirectory() as tmp:
+        db_dir = Path(tmp) / 'formula_db'
+        _convert_formula_db_to_npy([[mass, formula, idx], [mass, formula, idx]], db_dir)
+        assert _formula_db_npy_exists(db_dir)
+        # mass buckets are not converted
+        assert not (db_dir / 'basic_db_idx.npy').exists()
+        arr = np.load(db_dir / (formula_db_keys[1] + '.npy'), mmap_mode='r')
+        assert np.array_equal(arr, formula)
+        del arr
+
+        # only paths are pickled, workers attach to the same files
+        handle = pickle.loads(pickle.dumps(SharedDBHandle(db_dir, formula, formula)))
+        gd = handle.attach()
+        assert np.array_equal(gd['halogen_db_mass'], mass)
+        assert 'basic_db_iso' not in gd
+        del gd
+
+        # optional columns are added to an existing conversion from a joblib source having them
+        import joblib
+        from msbuddy.load import _add_optional_formula_db_npy
+        iso = np.array([[1., 0.01, 0.002, 0.], [1., 0.011, 0.004, 0.]])
+        joblib.dump([[mass, formula, idx, iso], [mass, formula, idx, iso]], Path(tmp) / 'formula_db.joblib')
+
+        # read-only database folder: no error, optional columns are not used
+        def _raise_permission_error(*args, **kwargs):
+            raise PermissionError('read-only')
+        with monkeypatch.context() as m:
+            m.setattr(np, 'save', _raise_permission_error)
+            _add_optional_formula_db_npy(db_dir, Path(tmp) / 'formula_db.joblib')
+        assert 'basic_db_iso' not in handle.attach()
+
+        _add_optional_formula_db_npy(db_dir, Path(tmp) / 'formula_db.joblib')
+        gd = handle.attach()
+        assert np.array_equal(gd['basic_db_iso'], iso) and np.array_equal(gd['halogen_db_iso'], iso)
+        del gd
+
+
+def test_iter_mgf():
+    from pathlib import Path
+    from msbuddy.load import load_mgf, iter_mgf
+
+    mgf_path = Path(__file__).parent.parent / 'demo' / 'input_file.mgf'
+    mf_list = load_mgf(mgf_path)
+    mf_stream = list(iter_mgf(mgf_path))
+    assert [mf.identifier for mf in mf_list] == [mf.identifier for mf in mf_stream]
+    assert [mf.mz for mf in mf_list] == [mf.mz for mf in mf_stream]
+
+    # malformed peak lines are not re-paired
+    import pytest
+    from msbuddy.load import _parse_peak_lines
+    with pytest.raises(ValueError):
+        _parse_peak_lines(['100 200 300', '400'])
+
+
+def test_subformula_cache():
+    import numpy as np
+    from msbuddy.cand import SubformulaCache
+
+    cache = SubformulaCache(max_bytes=250)
+    cache.put('a', (np.zeros(100, dtype=np.int8),))
+    cache.put('b', (np.zeros(100, dtype=np.int8),))
+    assert cache.get('a') is not None  # 'a' becomes the most recently used
+    cache.put('c', (np.zeros(100, dtype=np.int8),))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.cur_bytes == 200
+
+    # a precursor not covered by the superset lattice gets its full lattice
+    from msbuddy.cand import _gen_superset_lattice, _get_subform_lattice, subform_cache
+    subform_cache.clear()
+    pre_arr_list = [np.array([4, 8, 0, 0, 0, 0, 0, 1, 0, 2, 0, 0], dtype=np.int16),
+                    np.array([5, 6, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0], dtype=np.int16)]
+    superset = _gen_superset_lattice(pre_arr_list, 1)
+    pre_arr = np.array([3, 6, 0, 0, 0, 0, 0, 0, 0, 2, 0, 1], dtype=np.int16)
+    subform_arr = _get_subform_lattice(pre_arr, 1, np.array([50.]), True, 10, superset)[0]
+    assert len(subform_arr) == np.prod(pre_arr + 1)
+    subform_cache.clear()
+
+
+def test_formula_in_place_conversion():
+    import numpy as np
+    from msbuddy.base import Formula, calc_formula_dbe, calc_formula_mass
+    from msbuddy.query import check_formula_existence, build_common_frag_index, build_common_nl_index
+
+    # fragment C6H5Na+, converted into C6H6 (Na into H, neutral form) in place by the existence check
+    arr = np.array([6, 5, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0])
+    frag = Formula(arr.copy(), 1)
+    db_formula = np.array([[6, 6, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=np.int16)
+    empty_db = np.zeros((0, 12), dtype=np.int16)
+    gd = {'basic_db_mass': np.array([78.04695]), 'basic_db_formula': db_formula,
+          'halogen_db_mass': np.array([78.04695]), 'halogen_db_formula': db_formula,
+          'common_frag_index': build_common_frag_index(empty_db), 'common_loss_index': build_common_nl_index(empty_db)}
+    assert check_formula_existence(frag.array, True, True, gd)[0]
+    assert frag.array[8] == 0
+    # dbe and mass refer to the formula as created
+    assert frag.dbe == calc_formula_dbe(arr) and frag.mass == calc_formula_mass(np.float32(arr), 1, 0)
+
+
+def test_candidate_table():
+    import pickle
+    import numpy as np
+    from msbuddy.base import Formula, MS2Explanation, CandidateFormula, MetaFeature, Spectrum
+
+    mf = MetaFeature(identifier='t', mz=181.0707, charge=1, ms2=Spectrum([100., 120.], [1., 2.]))
+    cf_ls = []
+    for c in range(3):
+        arr = np.array([6 + c, 12, 0, 0, 0, 0, 0, 0, 0, 6, 0, 0])
+        exp = MS2Explanation(np.array([c, 1]), [Formula(arr // 2, 1), None]) if c != 1 else None
+        cf_ls.append(CandidateFormula(Formula(arr, 0), Formula(arr + 1, 1), mz_error=float(c), ms2_raw_explanation=exp))
+    mf.candidate_formula_list = cf_ls
+    assert len(mf.candidate_table) == 3
+    assert mf.candidate_formula_list[1].ms2_raw_explanation is None
+    assert mf.candidate_formula_list[2].ms2_raw_explanation.idx_array.tolist() == [2, 1]
+
+    # writes go to the table; in-place list changes are synced
+    mf.candidate_formula_list[0].estimated_prob = 0.5
+    assert mf.candidate_table.estimated_prob[0] == 0.5
+    mf.candidate_formula_list.reverse()
+    assert mf.candidate_table.mz_error.tolist() == [2., 1., 0.]
+
+    mf = pickle.loads(pickle.dumps(mf))
+    cf = mf.candidate_formula_list[2]
+    assert cf.estimated_prob == 0.5 and cf.estimated_fdr is None
+    assert str(cf.ms2_raw_explanation.explanation_list[0]) == 'C3H6O3'
+
+    # explanation writes, in place or spliced; lists mixing views and new objects keep the explanations of views
+    cf_ls = mf.candidate_formula_list
+    cf_ls[0].ms2_raw_explanation = MS2Explanation(np.array([0]), [None])
+    cf_ls[2].ms2_raw_explanation = MS2Explanation(np.array([1, 0]), [None, Formula(np.ones(12, dtype=int), 1)])
+    cf_ls[1] = CandidateFormula(Formula(np.array([7, 12, 0, 0, 0, 0, 0, 0, 0, 6, 0, 0]), 0))
+    assert mf.candidate_table.exp_cnt().tolist() == [1, 0, 2]
+    exp = mf.candidate_formula_list[2].ms2_raw_explanation
+    assert exp.idx_array.tolist() == [1, 0] and exp.explanation_list[0] is None
+    assert exp.explanation_list[1].array.tolist() == [1] * 12
+
+
+def test_ms2_feature_arr():
+    import copy
+    from pathlib import Path
+    import numpy as np
+    from msbuddy import Msbuddy, MsbuddyConfig
+    import msbuddy.main as main
+    from msbuddy.load import init_ml_models
+    from msbuddy.ml import _gen_ms2_feature, _gen_ms2_feature_arr
+
+    engine = Msbuddy(MsbuddyConfig(ms_instr='orbitrap', halogen=False))
+    engine.load_mgf(Path(__file__).parent.parent / 'demo' / 'input_file.mgf')
+    gd = init_ml_models(main.shared_data_dict)
+    ps = engine.config
+
+    row_cnt = 0
+    for mf in engine.data:
+        mf = main._gen_subformula(main._generate_candidate_formula(mf, ps, gd), ps)
+        if not mf.candidate_formula_list:
+            continue
+        # both versions convert explanation arrays in place, use separate copies
+        mf_batch = copy.deepcopy(mf)
+        single_arr = []
+        for cf in mf.candidate_formula_list:
+            pre_arr = cf.charged_formula.array
+            pre_h2c = pre_arr[1] / pre_arr[0] if pre_arr[0] > 0 else 0
+            single_arr.append(_gen_ms2_feature(mf, cf, cf.charged_formula.dbe, pre_h2c, ps.ppm, ps.ms2_tol, gd))
+        batch_arr = _gen_ms2_feature_arr(mf_batch, mf_batch.candidate_table, ps.ppm, ps.ms2_tol, gd)
+        # same feature matrix as the per-candidate version
+        assert np.array_equal(batch_arr, np.array(single_arr))
+        row_cnt += len(batch_arr)
+    assert row_cnt > 0
+
+
+def test_formula_existence_batch():
+    import numpy as np
+    from msbuddy.query import check_formula_existence, check_formula_existence_batch, build_common_frag_index, \
+        build_common_nl_index
+
+    mass_arr = np.array([12.000000, 1.007825, 78.918336, 34.968853, 18.998403, 126.904473, 38.963707, 14.003074,
+                         22.989769, 15.994915, 30.973762, 31.972071], dtype=np.float32)
+    # the last formula is above 1500 Da
+    db = np.array([[6, 12, 0, 0, 0, 0, 0, 0, 0, 6, 0, 0], [2, 6, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0],
+                   [120, 240, 0, 0, 0, 0, 0, 0, 0, 40, 0, 0], [6, 5, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=np.int16)
+    db_mass = np.array([float(np.sum(f * mass_arr)) for f in db])
+    order = np.argsort(db_mass)
+    basic_idx = order[np.sum(db[order, 2:6], axis=1) == 0]
+    halogen_idx = order[np.sum(db[order, 2:6], axis=1) > 0]
+    gd = {'basic_db_mass': db_mass[basic_idx], 'basic_db_formula': db[basic_idx],
+          'halogen_db_mass': db_mass[halogen_idx], 'halogen_db_formula': db[halogen_idx],
+          'common_frag_index': build_common_frag_index(np.array([[0, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0]])),
+          'common_loss_index': build_common_nl_index(np.array([[0, 2, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0]]))}
+
+    form_arr = np.array([[6, 13, 0, 0, 0, 0, 0, 0, 0, 6, 0, 0], [2, 6, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0],
+                         [0, 2, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0], [6, 5, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0],
+                         [0, 1, 0, 0, 0, 0, 0, 0, 1, 1, 0, 0], [120, 240, 0, 0, 0, 0, 0, 0, 0, 40, 0, 0]],
+                        dtype=np.int16)
+    assert check_formula_existence(form_arr[-1].copy(), True, False, gd)[0]
+    for frag in [True, False]:
+        for pos_mode in [True, False]:
+            single = [check_formula_existence(f.copy(), pos_mode, frag, gd) for f in form_arr]
+            batch_arr = form_arr.copy()
+            db_existed, common = check_formula_existence_batch(batch_arr, pos_mode, frag, gd)
+            assert db_existed.tolist() == [s[0] for s in single]
+            assert common.tolist() == [s[1] for s in single]
+
+
+def test_common_index():
+    import numpy as np
+    from msbuddy.query import build_common_frag_index, build_common_nl_index, common_frag_from_array, \
+        common_nl_from_array, common_frag_from_index, common_nl_from_index
+
+    rng = np.random.default_rng(0)
+    # small random tables, not sorted, so that the early break of the linear scan matters
+    db = rng.integers(0, 3, (30, 12)).astype(np.int16)
+    frag_index = build_common_frag_index(db)
+    nl_index = build_common_nl_index(db)
+    for form in np.vstack([db, rng.integers(-1, 4, (3000, 12)).astype(np.int16)]):
+        assert common_frag_from_index(form, frag_index) == common_frag_from_array(form, db)
+        assert common_nl_from_index(form, nl_index) == common_nl_from_array(form, db)
+
+
+def test_isotope_pattern():
+    import numpy as np
+    from brainpy import isotopic_variants
+    from msbuddy.base import Formula
+    from msbuddy.cand import calc_isotope_pattern, iso_pattern_cache
+
+    rng = np.random.default_rng(0)
+    form_arr = np.vstack([rng.integers(0, 5, (50, 12)) * np.array([10, 20, 1, 1, 1, 1, 1, 3, 1, 5, 1, 1]),
+                          [[0, 0, 0, 2, 0, 0, 0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0]]])
+    pattern_arr, len_arr = iso_pattern_cache.calc_batch(form_arr, 4)
+    for i, form in enumerate(form_arr):
+        iso = isotopic_variants(dict(zip(Formula.alphabet, form.tolist())), npeaks=4)
+        expected = np.array([p.intensity for p in iso], dtype=np.float32)
+        assert np.allclose(pattern_arr[i, :len_arr[i]], expected, atol=1e-6)
+        assert np.array_equal(calc_isotope_pattern(Formula(form, 0), 4), pattern_arr[i, :len_arr[i]])
+
+    # from precomputed neutral isotope abundances (as in the formula database), plus an adduct
+    neutral_arr = form_arr[:50] + np.array([1, 1, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0])  # no zero-abundance peaks
+    net_arr = np.array([0, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0])
+    neutral_pattern_arr, _ = iso_pattern_cache.calc_batch(neutral_arr, 4)
+    pattern_arr, len_arr = iso_pattern_cache.calc_batch_from_abundance(neutral_pattern_arr, net_arr, 4)
+    expected_arr, expected_len_arr = iso_pattern_cache.calc_batch(neutral_arr + net_arr, 4)
+    assert np.array_equal(len_arr, expected_len_arr)
+    assert np.allclose(pattern_arr, expected_arr, atol=1e-6)
+
+
+def test_fragnl_memo(monkeypatch):
+    import numpy as np
+    import msbuddy.query as query
+
+    mass_arr = np.array([12.000000, 1.007825, 78.918336, 34.968853, 18.998403, 126.904473, 38.963707, 14.003074,
+                         22.989769, 15.994915, 30.973762, 31.972071])
+    rng = np.random.default_rng(0)
+    gd = {}
+    for db in ['basic', 'halogen']:
+        form_arr = rng.integers(0, 4, (3000, 12)) * np.array([6, 10, 0, 0, 0, 0, 0, 2, 0, 3, 1, 1])
+        if db == 'halogen':
+            form_arr[:, 3] = 1
+        db_mass = form_arr @ mass_arr
+        order = np.argsort(db_mass)
+        gd[db + '_db_mass'], gd[db + '_db_formula'] = db_mass[order], form_arr[order].astype(np.int16)
+
+    for k in range(20):
+        # repeated masses, with small shifts
+        search_mass_arr = rng.uniform(20, 600, 30) if k % 2 else np.round(rng.uniform(20, 600, 30), 2)
+        for fragment in [True, False]:
+            args = (search_mass_arr, fragment, k % 4 < 2, k % 3 == 0, k % 5 == 0, 10, True, 1, gd)
+            memo_out = query.query_fragnl_mass_batch(*args)
+            with monkeypatch.context() as m:
+                m.setattr(query, 'fragnl_memo_max_mass', 0.)
+                direct_out = query.query_fragnl_mass_batch(*args)
+            assert all(np.array_equal(a, b) for a, b in zip(memo_out, direct_out))
+    assert 0 < len(gd['fragnl_memo'].entries) <= gd['fragnl_memo'].max_entries
+    assert len(memo_out[0]) > 0
+
+    # another database (here empty) in the same process has its own memo
+    other_gd = {key: gd[key][:0] for key in ['basic_db_mass', 'basic_db_formula',
+                                             'halogen_db_mass', 'halogen_db_formula']}
+    assert len(query.query_fragnl_mass_batch(*args[:-1], other_gd)[0]) == 0
+
+
+def test_fragnl_table(monkeypatch):
+    import numpy as np
+    import msbuddy.query as query
+
+    mass_arr = np.array([12.000000, 1.007825, 78.918336, 34.968853, 18.998403, 126.904473, 38.963707, 14.003074,
+                         22.989769, 15.994915, 30.973762, 31.972071])
+    rng = np.random.default_rng(1)
+    gd = {}
+    for db in ['basic', 'halogen']:
+        form_arr = rng.integers(0, 4, (3000, 12)) * np.array([2, 4, 0, 0, 0, 0, 0, 1, 0, 1, 0, 0])
+        if db == 'halogen':
+            form_arr[:, 3] = 1
+        db_mass = form_arr @ mass_arr
+        order = np.argsort(db_mass)
+        gd[db + '_db_mass'], gd[db + '_db_formula'] = db_mass[order], form_arr[order].astype(np.int16)
+    table_gd = dict(gd, fragnl_table=query.build_fragnl_table(gd, 150.))
+    assert query.build_fragnl_table(gd, 0.) is None
+
+    monkeypatch.setattr(query, 'fragnl_memo_max_mass', 0.)
+    for k in range(10):
+        search_mass_arr = rng.uniform(10, 200, 30) if k % 2 else np.round(rng.uniform(10, 200, 30), 3)
+        for fragment in [True, False]:
+            args = (search_mass_arr, fragment, k % 4 < 2, k % 3 == 0, k % 5 == 0, 10, True, 1)
+            table_out = query.query_fragnl_mass_batch(*args, table_gd)
+            direct_out = query.query_fragnl_mass_batch(*args, gd)
+            assert all(np.array_equal(a, b) for a, b in zip(table_out, direct_out))
+    assert len(table_out[0]) > 0
 
 
 if __name__ == '__main__':